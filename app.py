@@ -1,4 +1,4 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, Response
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, Response, g, stream_with_context, send_file, send_from_directory, has_request_context
 import sqlite3
 import hashlib
 from datetime import datetime
@@ -7,20 +7,390 @@ import csv
 import json
 from io import StringIO, BytesIO
 import random
-import qrcode
+import bisect
+import heapq
+import itertools
+import math
+import sys
 import io
 import base64
-from datetime import datetime, timedelta
+import threading
+import atexit
+import time
+import zlib
+import gzip
+import re
+import click
+import urllib.parse
+from functools import lru_cache, wraps
+from collections import Counter, OrderedDict
+from markupsafe import Markup, escape
+from datetime import date, datetime, timedelta, timezone
 
 app = Flask(__name__)
 app.secret_key = "supersecretkey_change_me"  # change in production
+app.logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO'))
+
+# Database settings (override through the environment in production)
+app.config.update(
+    DATABASE=os.environ.get('LIBRARY_DB', 'library.db'),
+    DB_POOL_SIZE=int(os.environ.get('DB_POOL_SIZE', 8)),
+    DB_POOL_ACQUIRE_TIMEOUT=float(os.environ.get('DB_POOL_ACQUIRE_TIMEOUT', 10)),
+    DB_BUSY_TIMEOUT_MS=int(os.environ.get('DB_BUSY_TIMEOUT_MS', 5000)),
+    DB_SYNCHRONOUS=os.environ.get('DB_SYNCHRONOUS', 'NORMAL'),
+    DB_CACHE_SIZE_KB=int(os.environ.get('DB_CACHE_SIZE_KB', 20000)),
+    DB_MMAP_SIZE=int(os.environ.get('DB_MMAP_SIZE', 256 * 1024 * 1024)),
+    DB_STATEMENT_CACHE=int(os.environ.get('DB_STATEMENT_CACHE', 256)),
+    DB_WRITE_BATCH=int(os.environ.get('DB_WRITE_BATCH', 64)),
+    DB_WRITE_TIMEOUT_MS=int(os.environ.get('DB_WRITE_TIMEOUT_MS', 10000)),
+    BOOKS_PAGE_SIZE=int(os.environ.get('BOOKS_PAGE_SIZE', 50)),
+    MAX_PAGE_SIZE=int(os.environ.get('MAX_PAGE_SIZE', 200)),
+    THUMBNAIL_DIR=os.environ.get('THUMBNAIL_DIR', os.path.join(app.root_path, 'cache', 'thumbnails')),
+    QR_CACHE_DIR=os.environ.get('QR_CACHE_DIR', os.path.join(app.root_path, 'cache', 'qr')),
+    SEARCH_HISTORY_BATCH=int(os.environ.get('SEARCH_HISTORY_BATCH', 100)),
+    SEARCH_HISTORY_FLUSH_MS=int(os.environ.get('SEARCH_HISTORY_FLUSH_MS', 500)),
+    SEARCH_HISTORY_QUEUE_MAX=int(os.environ.get('SEARCH_HISTORY_QUEUE_MAX', 10000)),
+    SEARCH_HISTORY_ENQUEUE_WAIT_MS=int(os.environ.get('SEARCH_HISTORY_ENQUEUE_WAIT_MS', 50)),
+    SEARCH_HISTORY_RETENTION_DAYS=int(os.environ.get('SEARCH_HISTORY_RETENTION_DAYS', 90)),
+    SEARCH_HISTORY_KEEP_PER_USER=int(os.environ.get('SEARCH_HISTORY_KEEP_PER_USER', 200)),
+    SEARCH_HISTORY_PRUNE_INTERVAL=int(os.environ.get('SEARCH_HISTORY_PRUNE_INTERVAL', 3600)),
+    SUGGEST_FIELD_MAX_MB=int(os.environ.get('SUGGEST_FIELD_MAX_MB', 320)),
+    SUGGEST_REFRESH_MS=int(os.environ.get('SUGGEST_REFRESH_MS', 1000)),
+    SUGGEST_MAX_AGE=int(os.environ.get('SUGGEST_MAX_AGE', 3600)),
+    LOAN_DAYS=int(os.environ.get('LOAN_DAYS', 14)),
+    FINE_PER_DAY=float(os.environ.get('FINE_PER_DAY', 0.25)),
+    FINE_GRACE_DAYS=int(os.environ.get('FINE_GRACE_DAYS', 0)),
+    FINE_MAX=float(os.environ.get('FINE_MAX', 20.0)),
+    FINE_BATCH_SIZE=int(os.environ.get('FINE_BATCH_SIZE', 5000)),
+    IMPORT_BATCH_SIZE=int(os.environ.get('IMPORT_BATCH_SIZE', 5000)),
+    IMPORT_UPLOAD_BATCH_SIZE=int(os.environ.get('IMPORT_UPLOAD_BATCH_SIZE', 500)),
+    IMPORT_COMMIT_ROWS=int(os.environ.get('IMPORT_COMMIT_ROWS', 50000)),
+    IMPORT_DIR=os.environ.get('IMPORT_DIR', os.path.join(app.root_path, 'cache', 'imports')),
+    CATALOG_VERSION_TTL_MS=int(os.environ.get('CATALOG_VERSION_TTL_MS', 1000)),
+    RESPONSE_CACHE_SIZE=int(os.environ.get('RESPONSE_CACHE_SIZE', 256)),
+    IDEMPOTENCY_KEY_TTL_HOURS=int(os.environ.get('IDEMPOTENCY_KEY_TTL_HOURS', 24)),
+    SLOW_QUERY_MS=float(os.environ.get('SLOW_QUERY_MS', 100)),
+    METRICS_DIR=os.environ.get('METRICS_DIR', os.path.join(app.root_path, 'cache', 'metrics')),
+    METRICS_FLUSH_MS=int(os.environ.get('METRICS_FLUSH_MS', 1000)),
+    RECOMMEND_TOP_K=int(os.environ.get('RECOMMEND_TOP_K', 20)),
+    RECOMMEND_MIN_COUNT=int(os.environ.get('RECOMMEND_MIN_COUNT', 2)),
+    RECOMMEND_MAX_USER_BOOKS=int(os.environ.get('RECOMMEND_MAX_USER_BOOKS', 200)),
+    RECOMMEND_BATCH_SIZE=int(os.environ.get('RECOMMEND_BATCH_SIZE', 5000)),
+    ROLLUP_CHUNK_DAYS=int(os.environ.get('ROLLUP_CHUNK_DAYS', 31)),
+    ROLLUP_BATCH_SIZE=int(os.environ.get('ROLLUP_BATCH_SIZE', 5000)),
+    REPORT_MAX_DAYS=int(os.environ.get('REPORT_MAX_DAYS', 366)),
+)
 
 # -------------------- Database Helpers --------------------
-def get_db():
-    conn = sqlite3.connect('library.db')
+def connect_db(readonly=False):
+    """Open a new tuned connection to the library database
+
+    Read-only connections open the file with mode=ro and also set query_only,
+    so a stray write fails loudly instead of taking the write lock.
+    """
+    if readonly:
+        path = 'file:' + urllib.parse.quote(os.path.abspath(app.config['DATABASE'])) + '?mode=ro'
+    else:
+        path = app.config['DATABASE']
+    conn = sqlite3.connect(path,
+                           timeout=app.config['DB_BUSY_TIMEOUT_MS'] / 1000.0,
+                           cached_statements=app.config['DB_STATEMENT_CACHE'],
+                           check_same_thread=False,
+                           factory=InstrumentedConnection,
+                           uri=readonly)
     conn.row_factory = sqlite3.Row
+    conn.readonly = readonly
+    c = conn.cursor()
+    if readonly:
+        c.execute("PRAGMA query_only=1")
+    else:
+        c.execute("PRAGMA journal_mode=WAL")
+        c.execute(f"PRAGMA synchronous={app.config['DB_SYNCHRONOUS']}")
+    c.execute(f"PRAGMA cache_size=-{int(app.config['DB_CACHE_SIZE_KB'])}")
+    c.execute(f"PRAGMA mmap_size={int(app.config['DB_MMAP_SIZE'])}")
+    c.execute(f"PRAGMA busy_timeout={int(app.config['DB_BUSY_TIMEOUT_MS'])}")
+    c.close()
     return conn
 
+
+class ConnectionPool:
+    """Bounded pool of SQLite connections, one pool per worker process"""
+
+    def __init__(self, size, acquire_timeout, readonly=False):
+        self.size = size
+        self.acquire_timeout = acquire_timeout
+        self.readonly = readonly
+        self.pid = os.getpid()
+        self._idle = []
+        self._open = 0
+        self._cond = threading.Condition()
+        self.stats = {'hits': 0, 'misses': 0, 'waits': 0, 'timeouts': 0, 'discarded': 0}
+
+    def acquire(self):
+        with self._cond:
+            if not self._idle and self._open >= self.size:
+                self.stats['waits'] += 1
+                if not self._cond.wait_for(lambda: self._idle or self._open < self.size,
+                                           timeout=self.acquire_timeout):
+                    self.stats['timeouts'] += 1
+                    raise sqlite3.OperationalError("database is locked (connection pool exhausted)")
+            if self._idle:
+                self.stats['hits'] += 1
+                return self._idle.pop()
+            self.stats['misses'] += 1
+            self._open += 1
+        try:
+            return connect_db(self.readonly)
+        except Exception:
+            with self._cond:
+                self._open -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, conn, discard=False):
+        if not discard:
+            try:
+                if conn.in_transaction:
+                    conn.rollback()
+            except sqlite3.Error:
+                discard = True
+        with self._cond:
+            if discard:
+                self.stats['discarded'] += 1
+                self._open -= 1
+            else:
+                self._idle.append(conn)
+            self._cond.notify()
+        if discard:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+
+    def snapshot(self):
+        with self._cond:
+            return dict(self.stats, size=self.size, open=self._open, idle=len(self._idle))
+
+    def close_idle(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+        for conn in idle:
+            conn.close()
+
+
+_pools = {False: None, True: None}
+_pool_lock = threading.Lock()
+
+def get_pool(readonly=False):
+    """Return this process's read-write or read-only pool, rebuilding it after a fork (gunicorn workers)"""
+    pool = _pools[readonly]
+    if pool is None or pool.pid != os.getpid():
+        with _pool_lock:
+            pool = _pools[readonly]
+            if pool is None or pool.pid != os.getpid():
+                pool = _pools[readonly] = ConnectionPool(app.config['DB_POOL_SIZE'],
+                                                         app.config['DB_POOL_ACQUIRE_TIMEOUT'], readonly)
+    return pool
+
+def close_pool():
+    """Close this process's idle connections, e.g. in the gunicorn master before it forks"""
+    with _pool_lock:
+        pools = [_pools[False], _pools[True]]
+        _pools[False] = _pools[True] = None
+    for pool in pools:
+        if pool is not None and pool.pid == os.getpid():
+            pool.close_idle()
+
+def get_db():
+    """Return the connection bound to the current app context
+
+    Requests get a read-only connection and send their writes through
+    run_write(); CLI commands and migrations get a read-write one.
+    """
+    if 'db' not in g:
+        g.db = get_pool(readonly=has_request_context()).acquire()
+        g.db.observer = g.get('query_stats')
+    return g.db
+
+@app.teardown_appcontext
+def release_db(exc):
+    conn = g.pop('db', None)
+    if conn is not None:
+        conn.observer = None
+        get_pool(conn.readonly).release(conn, discard=isinstance(exc, sqlite3.DatabaseError))
+
+
+class WriteUnit:
+    __slots__ = ('work', 'queued', 'done', 'result', 'error')
+
+    def __init__(self, work):
+        self.work = work
+        self.queued = time.perf_counter()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class WriteQueue:
+    """Single writer per worker process: request writes queue up and share transactions
+
+    Whatever queues while one transaction is open goes into the next one
+    (group commit, up to DB_WRITE_BATCH units), so a burst of writes costs one
+    BEGIN IMMEDIATE and one WAL sync instead of one each. Every unit runs under
+    its own SAVEPOINT, so a unit that raises is rolled back alone and its
+    exception re-raised in the request that submitted it.
+    """
+
+    def __init__(self, batch, timeout_ms):
+        self.pid = os.getpid()
+        self.batch = batch
+        self.timeout = timeout_ms / 1000.0
+        self._queue = []
+        self._closed = False
+        self._thread = None
+        self._conn = None
+        self._cond = threading.Condition()
+        self.stats = {'units': 0, 'failed_units': 0, 'transactions': 0, 'failed_transactions': 0,
+                      'timeouts': 0, 'largest_batch': 0}
+        self.waits = {}                 # 'queue' / 'lock' -> WRITE_WAIT_BUCKETS histogram
+
+    def run(self, work):
+        """Run work(cursor) in the writer and return its result (or raise its exception)"""
+        unit = WriteUnit(work)
+        with self._cond:
+            self._ensure_thread()
+            self._queue.append(unit)
+            self._cond.notify_all()
+        if not unit.done.wait(self.timeout):
+            with self._cond:
+                if unit in self._queue:
+                    # Never started, so it is safe to report and forget
+                    self._queue.remove(unit)
+                    self.stats['timeouts'] += 1
+                    raise sqlite3.OperationalError("database is locked (write queue timeout)")
+            # Already inside a transaction, which the busy timeout bounds
+            unit.done.wait()
+        if unit.error is not None:
+            raise unit.error
+        return unit.result
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._closed or self._queue)
+                if not self._queue:
+                    return
+                units, self._queue = self._queue[:self.batch], self._queue[self.batch:]
+            try:
+                self._commit(units)
+            finally:
+                for unit in units:
+                    unit.done.set()
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = connect_db()
+            self._conn.isolation_level = None
+        return self._conn
+
+    def _discard_connection(self):
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+
+    def _commit(self, units):
+        started = time.perf_counter()
+        try:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+        except sqlite3.Error as e:
+            self._discard_connection()
+            self._fail(units, e)
+            return
+        lock_wait = time.perf_counter() - started
+        c = conn.cursor()
+        for unit in units:
+            conn.execute("SAVEPOINT write_unit")
+            try:
+                unit.result = unit.work(c)
+                conn.execute("RELEASE write_unit")
+            except Exception as e:
+                unit.error = e
+                try:
+                    conn.execute("ROLLBACK TO write_unit")
+                    conn.execute("RELEASE write_unit")
+                except sqlite3.Error:
+                    pass
+        try:
+            conn.commit()
+        except sqlite3.Error as e:
+            try:
+                conn.rollback()
+            except sqlite3.Error:
+                self._discard_connection()
+            self._fail([u for u in units if u.error is None], e)
+            return
+        with self._cond:
+            self.stats['transactions'] += 1
+            self.stats['units'] += len(units)
+            self.stats['failed_units'] += sum(1 for u in units if u.error is not None)
+            self.stats['largest_batch'] = max(self.stats['largest_batch'], len(units))
+            _observe(self.waits, 'lock', WRITE_WAIT_BUCKETS, lock_wait)
+            for unit in units:
+                _observe(self.waits, 'queue', WRITE_WAIT_BUCKETS, started - unit.queued)
+
+    def _fail(self, units, error):
+        app.logger.warning("write transaction of %d units failed: %s", len(units), error)
+        for unit in units:
+            unit.result, unit.error = None, error
+        with self._cond:
+            self.stats['failed_transactions'] += 1
+            self.stats['failed_units'] += len(units)
+
+    def close(self):
+        """Finish queued writes and stop the writer (worker shutdown)"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=self.timeout)
+        self._discard_connection()
+
+    def snapshot(self):
+        with self._cond:
+            return dict(self.stats, pending=len(self._queue),
+                        waits={phase: list(counts) for phase, counts in self.waits.items()})
+
+
+_write_queue = None
+
+def get_write_queue():
+    """Return this process's writer, rebuilding it after a fork like the pool"""
+    global _write_queue
+    if _write_queue is None or _write_queue.pid != os.getpid():
+        with _pool_lock:
+            if _write_queue is None or _write_queue.pid != os.getpid():
+                _write_queue = WriteQueue(app.config['DB_WRITE_BATCH'], app.config['DB_WRITE_TIMEOUT_MS'])
+    return _write_queue
+
+def run_write(work):
+    """Run work(cursor) in this worker's writer transaction and return what it returns"""
+    return get_write_queue().run(work)
+
+@atexit.register
+def close_write_queue():
+    if _write_queue is not None and _write_queue.pid == os.getpid():
+        _write_queue.close()
+
 def init_db():
     conn = get_db()
     c = conn.cursor()
@@ -98,7 +468,9 @@ def init_db():
                          VALUES (?, ?, ?, ?, ?, ?, ?, ?)''', sample_books)
 
     conn.commit()
-    conn.close()
+
+    # Full-text index, secondary indexes and schema_version bookkeeping
+    migrate_database()
 
 
 def login_required():
@@ -108,20 +480,11 @@ def login_required():
     return True
 
 def add_search_history(user_id, search_term, search_by):
-    """Add search to history"""
-    conn = get_db()
-    c = conn.cursor()
-    try:
-        c.execute("INSERT INTO search_history (user_id, search_term, search_by) VALUES (?, ?, ?)",
-                  (user_id, search_term, search_by))
-        conn.commit()
-    except:
-        pass
-    finally:
-        conn.close()
+    """Queue a search for the history log; written in batches off the request path"""
+    return get_history_writer().add(user_id, search_term, search_by)
 
 def get_search_history(user_id, limit=5):
-    """Get user's search history"""
+    """Get user's search history, including searches still waiting to be flushed"""
     conn = get_db()
     c = conn.cursor()
     c.execute("""
@@ -131,14 +494,26 @@ def get_search_history(user_id, limit=5):
         ORDER BY search_date DESC 
         LIMIT ?
     """, (user_id, limit))
-    history = c.fetchall()
-    conn.close()
+    history = [dict(row) for row in c.fetchall()]
+    pending = get_history_writer().pending_for(user_id, limit)
+    if pending:
+        history = sorted(pending + history, key=lambda h: h['search_date'], reverse=True)[:limit]
     return history
 
 # -------------------- Database Migration Helper --------------------
-def migrate_database():
-    """Check and add missing columns to existing database"""
-    conn = get_db()
+# Ordered schema migrations; each runs once and is recorded in schema_version
+MIGRATIONS = []
+
+def migration(version, name):
+    def register(func):
+        MIGRATIONS.append((version, name, func))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return func
+    return register
+
+@migration(1, 'books_columns')
+def migrate_books_columns(conn):
+    """Add columns missing from databases created before cover/description/created_date"""
     c = conn.cursor()
     
     # Get table info to check existing columns
@@ -147,77 +522,3467 @@ def migrate_database():
     
     # Add missing columns one by one
     if 'cover' not in columns:
-        try:
-            c.execute("ALTER TABLE books ADD COLUMN cover TEXT DEFAULT 'default.jpg'")
-            print("✓ Added cover column to books table")
-        except Exception as e:
-            print(f"✗ Error adding cover column: {e}")
+        c.execute("ALTER TABLE books ADD COLUMN cover TEXT DEFAULT 'default.jpg'")
+        print("✓ Added cover column to books table")
     
     if 'description' not in columns:
-        try:
-            c.execute("ALTER TABLE books ADD COLUMN description TEXT")
-            print("✓ Added description column to books table")
-        except Exception as e:
-            print(f"✗ Error adding description column: {e}")
+        c.execute("ALTER TABLE books ADD COLUMN description TEXT")
+        print("✓ Added description column to books table")
     
     if 'created_date' not in columns:
+        # First add the column without default
+        c.execute("ALTER TABLE books ADD COLUMN created_date TIMESTAMP")
+        print("✓ Added created_date column to books table")
+        
+        # Then update existing rows with current timestamp
+        c.execute("UPDATE books SET created_date = datetime('now') WHERE created_date IS NULL")
+        print("✓ Updated existing rows with current timestamp")
+
+@migration(2, 'search_history_table')
+def migrate_search_history_table(conn):
+    c = conn.cursor()
+    c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='search_history'")
+    if not c.fetchone():
+        c.execute('''CREATE TABLE search_history
+                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                      user_id INTEGER,
+                      search_term TEXT,
+                      search_by TEXT,
+                      search_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                      FOREIGN KEY(user_id) REFERENCES users(id))''')
+        print("✓ Created search_history table")
+
+@migration(3, 'books_fts')
+def migrate_books_fts(conn):
+    # Create and backfill the full-text index for databases that predate it
+    ensure_fts_index(conn)
+
+@migration(4, 'secondary_indexes')
+def migrate_secondary_indexes(conn):
+    """Indexes for the filters and sort orders the routes actually use"""
+    c = conn.cursor()
+    indexes = [
+        # Status filter + title sort (search, quick search 'available', availability counts)
+        "CREATE INDEX IF NOT EXISTS idx_books_status_title ON books(status, title)",
+        # SORT_ORDERS walks: rowid is the implicit last column, so these cover the id tie-breaker
+        "CREATE INDEX IF NOT EXISTS idx_books_title ON books(title)",
+        "CREATE INDEX IF NOT EXISTS idx_books_author_title ON books(author, title)",
+        "CREATE INDEX IF NOT EXISTS idx_books_year_sort ON books(IFNULL(published_year, -9999) DESC, title)",
+        "CREATE INDEX IF NOT EXISTS idx_books_added_sort ON books(IFNULL(created_date, ''))",
+        # Year range filters and genre lookups/distinct counts
+        "CREATE INDEX IF NOT EXISTS idx_books_published_year ON books(published_year)",
+        "CREATE INDEX IF NOT EXISTS idx_books_genre ON books(genre)",
+        # Card stats: open loans and outstanding fines per user
+        "CREATE INDEX IF NOT EXISTS idx_borrowings_user_returned ON borrowings(user_id, returned_date)",
+        "CREATE INDEX IF NOT EXISTS idx_borrowings_user_fines ON borrowings(user_id, fine_amount) WHERE fine_amount > 0",
+        "CREATE INDEX IF NOT EXISTS idx_borrowings_book ON borrowings(book_id)",
+        "CREATE INDEX IF NOT EXISTS idx_library_cards_user ON library_cards(user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_search_history_user_date ON search_history(user_id, search_date)",
+    ]
+    for statement in indexes:
+        c.execute(statement)
+    print(f"✓ Created {len(indexes)} secondary indexes")
+
+def migrate_database():
+    """Apply pending migrations in version order"""
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS schema_version
+                 (version INTEGER PRIMARY KEY,
+                  name TEXT,
+                  applied_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    c.execute("SELECT version FROM schema_version")
+    applied = {row['version'] for row in c.fetchall()}
+    
+    for version, name, func in MIGRATIONS:
+        if version in applied:
+            continue
+        try:
+            # One transaction per migration, DDL included (sqlite3 would not open one for
+            # DDL by itself), so a failure leaves neither half a schema nor the version row
+            c.execute("BEGIN")
+            func(conn)
+            c.execute("INSERT INTO schema_version (version, name) VALUES (?, ?)", (version, name))
+            conn.commit()
+            print(f"✓ Applied migration {version}: {name}")
+        except Exception as e:
+            conn.rollback()
+            print(f"✗ Error applying migration {version} ({name}): {e}")
+            raise
+
+def schema_version():
+    c = get_db().cursor()
+    c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='schema_version'")
+    if not c.fetchone():
+        return 0
+    c.execute("SELECT MAX(version) AS version FROM schema_version")
+    return c.fetchone()['version'] or 0
+
+# -------------------- Full-Text Search Index --------------------
+FTS_COLUMNS = ('title', 'author', 'genre', 'description', 'isbn')
+FTS_SEARCH_FIELDS = ('title', 'author', 'genre', 'isbn')
+# bm25() column weights, in FTS_COLUMNS order: title matches count most
+FTS_WEIGHTS = '10.0, 5.0, 2.0, 1.0, 1.0'
+# Match markers for highlight()/snippet(); the highlight filter turns them into <mark>
+MARK_OPEN, MARK_CLOSE = '\x02', '\x03'
+
+_fts5_supported = None
+_fts_ready = {}
+
+def fts5_supported():
+    """Check once whether this SQLite build was compiled with FTS5"""
+    global _fts5_supported
+    if _fts5_supported is None:
+        probe = sqlite3.connect(':memory:')
+        try:
+            probe.execute("CREATE VIRTUAL TABLE fts_probe USING fts5(x)")
+            _fts5_supported = True
+        except sqlite3.OperationalError:
+            _fts5_supported = False
+        finally:
+            probe.close()
+    return _fts5_supported
+
+def ensure_fts_index(conn):
+    """Create the books_fts index and its sync triggers, backfilling existing rows
+
+    Runs inside the caller's transaction (migration 3); the caller commits.
+    """
+    if not fts5_supported():
+        print("✗ SQLite build lacks FTS5, search will use LIKE scans")
+        return False
+
+    c = conn.cursor()
+    cols = ', '.join(FTS_COLUMNS)
+    new_cols = ', '.join('new.' + col for col in FTS_COLUMNS)
+    old_cols = ', '.join('old.' + col for col in FTS_COLUMNS)
+
+    c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='books_fts'")
+    created = not c.fetchone()
+    if created:
+        # External-content table: the text lives in books, the index only stores tokens
+        c.execute(f'''CREATE VIRTUAL TABLE books_fts USING fts5(
+                         {cols}, content='books', content_rowid='id',
+                         tokenize='unicode61 remove_diacritics 2', prefix='2 3')''')
+
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS books_fts_insert AFTER INSERT ON books BEGIN
+                     INSERT INTO books_fts(rowid, {cols}) VALUES (new.id, {new_cols});
+                 END''')
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS books_fts_delete AFTER DELETE ON books BEGIN
+                     INSERT INTO books_fts(books_fts, rowid, {cols}) VALUES ('delete', old.id, {old_cols});
+                 END''')
+    # Only indexed columns re-tokenize; status changes from circulation skip the index
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS books_fts_update AFTER UPDATE OF {cols} ON books BEGIN
+                     INSERT INTO books_fts(books_fts, rowid, {cols}) VALUES ('delete', old.id, {old_cols});
+                     INSERT INTO books_fts(rowid, {cols}) VALUES (new.id, {new_cols});
+                 END''')
+
+    if created:
+        c.execute("INSERT INTO books_fts(books_fts) VALUES('rebuild')")
+        print("✓ Created books_fts full-text index")
+
+    # Not cached here: fts_enabled() looks again once the transaction has committed
+    _fts_ready.pop(app.config['DATABASE'], None)
+    return True
+
+def fts_enabled(conn):
+    """True when the books_fts index exists in the configured database"""
+    db_path = app.config['DATABASE']
+    if db_path not in _fts_ready:
+        c = conn.cursor()
+        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='books_fts'")
+        _fts_ready[db_path] = fts5_supported() and c.fetchone() is not None
+    return _fts_ready[db_path]
+
+def fts_match_expression(term, column=None):
+    """Turn free text into a safe FTS5 prefix query, e.g. 'lord ri' -> title : ("lord"* "ri"*)"""
+    tokens = re.findall(r'\w+', term)
+    if not tokens:
+        return None
+    if column == 'isbn':
+        # ISBNs are stored as one token; drop hyphens and spaces from the term
+        tokens = [''.join(tokens)]
+    expression = ' '.join(f'"{token}"*' for token in tokens)
+    if column:
+        return f'{column} : ({expression})'
+    return expression
+
+def fts_search_query(columns='books.*'):
+    """SELECT over books joined to a ranked FTS match; bind with fts_search_params()"""
+    return (f"SELECT {columns}, f.title_hl, f.snippet, f.relevance FROM books "
+            f"JOIN (SELECT rowid, highlight(books_fts, 0, ?, ?) AS title_hl, "
+            f"snippet(books_fts, 3, ?, ?, '…', 12) AS snippet, "
+            f"bm25(books_fts, {FTS_WEIGHTS}) AS relevance "
+            f"FROM books_fts WHERE books_fts MATCH ?) f ON f.rowid = books.id WHERE 1=1")
+
+def fts_search_params(match):
+    return [MARK_OPEN, MARK_CLOSE, MARK_OPEN, MARK_CLOSE, match]
+
+@app.template_filter('highlight')
+def highlight_filter(text):
+    """Escape FTS highlight/snippet output and wrap matches in <mark>"""
+    escaped = str(escape(text or ''))
+    return Markup(escaped.replace(MARK_OPEN, '<mark>').replace(MARK_CLOSE, '</mark>'))
+
+# -------------------- Catalogue Statistics --------------------
+# Summary tables kept current by triggers on books, so stats reads never aggregate the catalogue
+def _stats_remove_sql(row):
+    """Trigger statements that take `row` (old/new) out of the summary tables"""
+    return f'''
+        UPDATE catalog_stats SET
+            total = total - 1,
+            available = available - ({row}.status IS 'Available'),
+            authors = authors - IFNULL((SELECT cnt = 1 FROM author_counts WHERE author = {row}.author), 0),
+            genres = genres - IFNULL((SELECT cnt = 1 FROM genre_counts WHERE genre = {row}.genre), 0)
+        WHERE id = 1;
+        UPDATE author_counts SET cnt = cnt - 1 WHERE author = {row}.author;
+        DELETE FROM author_counts WHERE author = {row}.author AND cnt <= 0;
+        UPDATE genre_counts SET cnt = cnt - 1 WHERE genre = {row}.genre;
+        DELETE FROM genre_counts WHERE genre = {row}.genre AND cnt <= 0;
+        UPDATE year_counts SET cnt = cnt - 1 WHERE published_year = {row}.published_year;
+        DELETE FROM year_counts WHERE published_year = {row}.published_year AND cnt <= 0;'''
+
+def _stats_add_sql(row):
+    """Trigger statements that add `row` (old/new) to the summary tables"""
+    return f'''
+        UPDATE catalog_stats SET
+            total = total + 1,
+            available = available + ({row}.status IS 'Available'),
+            authors = authors + NOT EXISTS (SELECT 1 FROM author_counts WHERE author = {row}.author),
+            genres = genres + (IFNULL({row}.genre, '') != ''
+                               AND NOT EXISTS (SELECT 1 FROM genre_counts WHERE genre = {row}.genre))
+        WHERE id = 1;
+        INSERT INTO author_counts (author, cnt) SELECT {row}.author, 1 WHERE {row}.author IS NOT NULL
+            ON CONFLICT(author) DO UPDATE SET cnt = cnt + 1;
+        INSERT INTO genre_counts (genre, cnt) SELECT {row}.genre, 1 WHERE IFNULL({row}.genre, '') != ''
+            ON CONFLICT(genre) DO UPDATE SET cnt = cnt + 1;
+        INSERT INTO year_counts (published_year, cnt) SELECT {row}.published_year, 1 WHERE {row}.published_year IS NOT NULL
+            ON CONFLICT(published_year) DO UPDATE SET cnt = cnt + 1;'''
+
+@migration(5, 'catalog_stats')
+def migrate_catalog_stats(conn):
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS catalog_stats
+                 (id INTEGER PRIMARY KEY CHECK (id = 1),
+                  total INTEGER NOT NULL DEFAULT 0,
+                  available INTEGER NOT NULL DEFAULT 0,
+                  genres INTEGER NOT NULL DEFAULT 0,
+                  authors INTEGER NOT NULL DEFAULT 0)''')
+    c.execute("CREATE TABLE IF NOT EXISTS genre_counts (genre TEXT PRIMARY KEY, cnt INTEGER NOT NULL)")
+    c.execute("CREATE TABLE IF NOT EXISTS author_counts (author TEXT PRIMARY KEY, cnt INTEGER NOT NULL)")
+    c.execute("CREATE TABLE IF NOT EXISTS year_counts (published_year INTEGER PRIMARY KEY, cnt INTEGER NOT NULL)")
+
+    c.execute(f"CREATE TRIGGER IF NOT EXISTS books_stats_insert AFTER INSERT ON books BEGIN {_stats_add_sql('new')} END")
+    c.execute(f"CREATE TRIGGER IF NOT EXISTS books_stats_delete AFTER DELETE ON books BEGIN {_stats_remove_sql('old')} END")
+    c.execute(f"""CREATE TRIGGER IF NOT EXISTS books_stats_update AFTER UPDATE OF status, author, genre, published_year ON books
+                  BEGIN {_stats_remove_sql('old')} {_stats_add_sql('new')} END""")
+
+    rebuild_catalog_stats(conn)
+    print("✓ Created catalogue statistics tables")
+
+def compute_catalog_stats(conn):
+    """Aggregate the stats straight from books (the slow path the summary tables replace)"""
+    c = conn.cursor()
+    c.execute("""SELECT COUNT(*) AS total,
+                        IFNULL(SUM(status = 'Available'), 0) AS available,
+                        COUNT(DISTINCT NULLIF(genre, '')) AS genres,
+                        COUNT(DISTINCT author) AS authors
+                 FROM books""")
+    stats = dict(c.fetchone())
+    c.execute("SELECT genre, COUNT(*) AS cnt FROM books WHERE IFNULL(genre, '') != '' GROUP BY genre")
+    stats['genre_counts'] = {row['genre']: row['cnt'] for row in c.fetchall()}
+    c.execute("SELECT author, COUNT(*) AS cnt FROM books WHERE author IS NOT NULL GROUP BY author")
+    stats['author_counts'] = {row['author']: row['cnt'] for row in c.fetchall()}
+    c.execute("SELECT published_year, COUNT(*) AS cnt FROM books WHERE published_year IS NOT NULL GROUP BY published_year")
+    stats['year_counts'] = {row['published_year']: row['cnt'] for row in c.fetchall()}
+    return stats
+
+def rebuild_catalog_stats(conn):
+    """Recompute every summary table from books inside the caller's transaction; the caller commits"""
+    c = conn.cursor()
+    stats = compute_catalog_stats(conn)
+    c.execute("DELETE FROM catalog_stats")
+    c.execute("DELETE FROM genre_counts")
+    c.execute("DELETE FROM author_counts")
+    c.execute("DELETE FROM year_counts")
+    c.execute("INSERT INTO catalog_stats (id, total, available, genres, authors) VALUES (1, ?, ?, ?, ?)",
+              (stats['total'], stats['available'], stats['genres'], stats['authors']))
+    c.executemany("INSERT INTO genre_counts (genre, cnt) VALUES (?, ?)", stats['genre_counts'].items())
+    c.executemany("INSERT INTO author_counts (author, cnt) VALUES (?, ?)", stats['author_counts'].items())
+    c.executemany("INSERT INTO year_counts (published_year, cnt) VALUES (?, ?)", stats['year_counts'].items())
+
+def check_catalog_stats(conn):
+    """Compare the summary tables with a fresh aggregate; returns a list of mismatch descriptions"""
+    c = conn.cursor()
+    expected = compute_catalog_stats(conn)
+    c.execute("SELECT * FROM catalog_stats WHERE id = 1")
+    row = c.fetchone()
+    problems = []
+    for key in ('total', 'available', 'genres', 'authors'):
+        actual = row[key] if row else None
+        if actual != expected[key]:
+            problems.append(f"{key}: stored {actual}, actual {expected[key]}")
+    for table, key in (('genre_counts', 'genre'), ('author_counts', 'author'), ('year_counts', 'published_year')):
+        c.execute(f"SELECT {key}, cnt FROM {table}")
+        stored = {r[key]: r['cnt'] for r in c.fetchall()}
+        if stored != expected[table]:
+            diff = set(stored.items()) ^ set(expected[table].items())
+            problems.append(f"{table}: {len(diff)} differing entries")
+    return problems
+
+def read_catalog_stats(conn):
+    """Catalogue stats from the summary tables: one row lookup plus two PK-ordered probes"""
+    c = conn.cursor()
+    try:
+        c.execute("""SELECT total, available, genres, authors,
+                            (SELECT MIN(published_year) FROM year_counts) AS min_year,
+                            (SELECT MAX(published_year) FROM year_counts) AS max_year
+                     FROM catalog_stats WHERE id = 1""")
+        row = c.fetchone()
+    except sqlite3.OperationalError:
+        row = None
+    if row is None:
+        # Summary tables not migrated yet; fall back to aggregating books
+        stats = compute_catalog_stats(conn)
+        c.execute("SELECT MIN(published_year) AS min_year, MAX(published_year) AS max_year FROM books")
+        stats.update(dict(c.fetchone()))
+        return stats
+    return dict(row)
+
+@app.cli.command('catalog-stats')
+@click.option('--rebuild', is_flag=True, help='Recompute the summary tables even if they match')
+def catalog_stats_command(rebuild):
+    """Check the catalogue summary tables against books and rebuild on drift"""
+    migrate_database()
+    conn = get_db()
+    problems = check_catalog_stats(conn)
+    for problem in problems:
+        print(f"✗ {problem}")
+    if problems or rebuild:
+        rebuild_catalog_stats(conn)
+        conn.commit()
+        print("✓ Rebuilt catalogue statistics")
+    else:
+        print("✓ Catalogue statistics are consistent")
+
+# -------------------- Keyset Pagination --------------------
+# Column projections for listing pages; the edit form and detail API still load full rows
+BOOK_LIST_COLUMNS = 'id, title, author, isbn, published_year, genre, status'
+BOOK_CARD_COLUMNS = 'id, title, author, published_year, genre, status, cover'
+
+# Sort orders as (expression, direction) keys. Every order ends on id so keys are unique,
+# and NULLs are folded to a sentinel so they compare like any other key.
+SORT_ORDERS = {
+    'id_desc': (('id', 'DESC'),),
+    'title': (('title', 'ASC'), ('id', 'ASC')),
+    'title_desc': (('title', 'DESC'), ('id', 'DESC')),
+    'author': (('author', 'ASC'), ('title', 'ASC'), ('id', 'ASC')),
+    'year': (('IFNULL(published_year, -9999)', 'DESC'), ('title', 'ASC'), ('id', 'ASC')),
+    'year_asc': (('IFNULL(published_year, -9999)', 'ASC'), ('title', 'ASC'), ('id', 'ASC')),
+    'added': (("IFNULL(created_date, '')", 'DESC'), ('id', 'DESC')),
+    'relevance': (('f.relevance', 'ASC'), ('id', 'ASC')),
+}
+
+def sort_key_columns(sort_by):
+    """Extra SELECT columns carrying the sort key, used to build the next cursor"""
+    return ', '.join(f'{expr} AS sort_key_{i}' for i, (expr, _) in enumerate(SORT_ORDERS[sort_by]))
+
+def encode_cursor(sort_by, row):
+    keys = [row[f'sort_key_{i}'] for i in range(len(SORT_ORDERS[sort_by]))]
+    payload = json.dumps({'s': sort_by, 'k': keys}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+def decode_cursor(token, sort_by):
+    """Return the key values in a cursor, or None if it is missing or for another sort"""
+    if not token:
+        return None
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        keys = payload['k']
+    except (ValueError, TypeError, KeyError):
+        return None
+    if payload.get('s') != sort_by or not isinstance(keys, list) or len(keys) != len(SORT_ORDERS[sort_by]):
+        return None
+    return keys
+
+def keyset_clause(sort_by):
+    """WHERE fragment selecting rows strictly after a cursor's keys in sort_by order"""
+    order = SORT_ORDERS[sort_by]
+    directions = {direction for _, direction in order}
+    if len(directions) == 1:
+        # Uniform direction: a row-value comparison can walk an index directly
+        op = '>' if 'ASC' in directions else '<'
+        exprs = ', '.join(expr for expr, _ in order)
+        marks = ', '.join('?' * len(order))
+        return f" AND ({exprs}) {op} ({marks})"
+
+    disjuncts = []
+    for i, (expr, direction) in enumerate(order):
+        terms = [f"{order[j][0]} = ?" for j in range(i)]
+        terms.append(f"{expr} {'>' if direction == 'ASC' else '<'} ?")
+        disjuncts.append('(' + ' AND '.join(terms) + ')')
+    return ' AND (' + ' OR '.join(disjuncts) + ')'
+
+def keyset_params(sort_by, keys):
+    """Parameters for keyset_clause(sort_by), in placeholder order"""
+    order = SORT_ORDERS[sort_by]
+    if len({direction for _, direction in order}) == 1:
+        return list(keys)
+    params = []
+    for i in range(len(order)):
+        params.extend(keys[:i + 1])
+    return params
+
+def order_clause(sort_by):
+    return ' ORDER BY ' + ', '.join(f'{expr} {direction}' for expr, direction in SORT_ORDERS[sort_by])
+
+def page_size_arg(value):
+    """Clamp a requested page size to 1..MAX_PAGE_SIZE"""
+    try:
+        size = int(value)
+    except (TypeError, ValueError):
+        return app.config['BOOKS_PAGE_SIZE']
+    return max(1, min(size, app.config['MAX_PAGE_SIZE']))
+
+def book_dict(row):
+    """Row as a dict without the internal sort_key_N columns"""
+    return {key: row[key] for key in row.keys() if not key.startswith('sort_key_')}
+
+# -------------------- Book Query Builder --------------------
+LIKE_ALL_COLUMNS = ('title', 'author', 'genre', 'description')
+
+class BookQuery:
+    """Catalogue filters, sort, limit and cursor compiled to parameterized SQL
+
+    Every listing (search page, export, quick search, /books and /api/books) goes
+    through here. SQL text depends only on the query's shape(), so equal shapes
+    produce identical statements and hit sqlite3's per-connection statement cache.
+    """
+
+    def __init__(self, search_term='', search_by='title', sort_by='title', status=None,
+                 year_from=None, year_to=None, genre_terms=None, columns=BOOK_LIST_COLUMNS,
+                 limit=None, cursor=None):
+        self.search_term = (search_term or '').strip()
+        self.search_by = search_by
+        self.status = list(status or [])
+        self.year_from = int(year_from) if str(year_from or '').isdigit() else None
+        self.year_to = int(year_to) if str(year_to or '').isdigit() else None
+        self.genre_terms = [term for term in (genre_terms or []) if re.search(r'\w', term)]
+        self.columns = columns
+        self.limit = limit
+
+        # Decide once how the term is matched so shape() and params() agree
+        self.match = None
+        self.isbn13 = None
+        self.term_mode = None
+        self.use_fts = fts_enabled(get_db())
+        if self.search_term:
+            if search_by in ('isbn', 'all') and isbn13_enabled(get_db()):
+                # A whole, valid ISBN is an exact lookup on the normalised column
+                self.isbn13 = isbn_search_term(self.search_term)
+            if self.use_fts and search_by in FTS_SEARCH_FIELDS + ('all',) and not self.isbn13:
+                self.match = fts_match_expression(self.search_term, None if search_by == 'all' else search_by)
+            if self.isbn13:
+                self.term_mode = 'isbn13'
+            elif self.match:
+                self.term_mode = 'fts'
+            elif search_by == 'year':
+                self.term_mode = 'year' if self.search_term.isdigit() else None
+            elif search_by == 'all':
+                self.term_mode = 'like_all'
+            elif search_by in FTS_SEARCH_FIELDS:
+                self.term_mode = 'like'
+
+        # Relevance only means something for an index match
+        self.sort_by = sort_by if sort_by in SORT_ORDERS else 'title'
+        if self.sort_by == 'relevance' and self.term_mode != 'fts':
+            self.sort_by = 'title'
+        self.cursor_keys = decode_cursor(cursor, self.sort_by)
+
+    @classmethod
+    def from_filters(cls, filters, **kwargs):
+        """Build from a search_filters_from() dict (the search form or session)"""
+        return cls(search_term=filters.get('search_term', ''),
+                   search_by=filters.get('search_by', 'title'),
+                   sort_by=filters.get('sort_by', 'title'),
+                   status=filters.get('status'),
+                   year_from=filters.get('year_from'),
+                   year_to=filters.get('year_to'),
+                   **kwargs)
+
+    def shape(self):
+        return (self.columns,
+                self.term_mode,
+                self.search_by if self.term_mode == 'like' else None,
+                len(self.status),
+                self.year_from is not None,
+                self.year_to is not None,
+                len(self.genre_terms),
+                self.use_fts,
+                self.sort_by,
+                self.cursor_keys is not None,
+                self.limit is not None)
+
+    def sql(self):
+        return compile_book_query(self.shape())
+
+    def params(self):
+        params = []
+        if self.term_mode == 'fts':
+            params.extend(fts_search_params(self.match))
+        elif self.term_mode == 'like':
+            params.append(f"%{self.search_term}%")
+        elif self.term_mode == 'like_all':
+            params.extend([f"%{self.search_term}%"] * len(LIKE_ALL_COLUMNS))
+        elif self.term_mode == 'year':
+            params.append(int(self.search_term))
+        elif self.term_mode == 'isbn13':
+            params.append(self.isbn13)
+        params.extend(self.status)
+        if self.year_from is not None:
+            params.append(self.year_from)
+        if self.year_to is not None:
+            params.append(self.year_to)
+        if self.genre_terms:
+            if self.use_fts:
+                terms = [''.join(re.findall(r'\w+', term)) for term in self.genre_terms]
+                params.append('genre : (' + ' OR '.join(f'"{term}"*' for term in terms) + ')')
+            else:
+                params.extend(f"%{term}%" for term in self.genre_terms)
+        if self.cursor_keys is not None:
+            params.extend(keyset_params(self.sort_by, self.cursor_keys))
+        if self.limit is not None:
+            params.append(self.limit + 1)  # one extra row tells us whether a next page exists
+        return params
+
+    def execute(self, c):
+        """Run the query on cursor c and return it for row-by-row iteration"""
+        c.execute(self.sql(), self.params())
+        return c
+
+    def fetch_page(self, c):
+        """Fetch one page; returns (rows, next_cursor)"""
+        rows = self.execute(c).fetchall()
+        if self.limit is not None and len(rows) > self.limit:
+            return rows[:self.limit], encode_cursor(self.sort_by, rows[self.limit - 1])
+        return rows, None
+
+
+@lru_cache(maxsize=256)
+def compile_book_query(shape):
+    """SQL text for a BookQuery shape; parameters are bound in BookQuery.params() order"""
+    (columns, term_mode, like_column, status_count, has_year_from, has_year_to,
+     genre_count, use_fts, sort_by, has_cursor, has_limit) = shape
+
+    columns = f"{columns}, {sort_key_columns(sort_by)}"
+    if term_mode == 'fts':
+        query = fts_search_query(columns)
+    else:
+        query = f"SELECT {columns} FROM books WHERE 1=1"
+
+    # Basic search
+    if term_mode == 'like':
+        query += f" AND {like_column} LIKE ?"
+    elif term_mode == 'like_all':
+        query += " AND (" + " OR ".join(f"{col} LIKE ?" for col in LIKE_ALL_COLUMNS) + ")"
+    elif term_mode == 'year':
+        query += " AND published_year = ?"
+    elif term_mode == 'isbn13':
+        query += " AND isbn13 = ?"
+
+    # Status filters
+    if status_count:
+        query += f" AND status IN ({','.join('?' * status_count)})"
+
+    # Year range filter
+    if has_year_from:
+        query += " AND published_year >= ?"
+    if has_year_to:
+        query += " AND published_year <= ?"
+
+    # Genre keywords (any of)
+    if genre_count and use_fts:
+        query += " AND id IN (SELECT rowid FROM books_fts WHERE books_fts MATCH ?)"
+    elif genre_count:
+        query += " AND (" + " OR ".join(["genre LIKE ?"] * genre_count) + ")"
+
+    # Sorting and paging (keyset on the sort key, see SORT_ORDERS)
+    if has_cursor:
+        query += keyset_clause(sort_by)
+    query += order_clause(sort_by)
+    if has_limit:
+        query += " LIMIT ?"
+    return query
+
+# -------------------- Random Sampling & Popularity --------------------
+POPULAR_GENRES = ('Fantasy', 'Mystery', 'Thriller', 'Romance')
+SAMPLE_PROBES_PER_ROW = 4  # probe budget per requested row before giving up on sparse ranges
+
+def sample_books(conn, k, columns=BOOK_CARD_COLUMNS, genres=None, exclude=()):
+    """Pick up to k random books by rowid-range probing instead of ORDER BY RANDOM()
+
+    Each probe jumps to a random id and takes the next existing row, which is one
+    index seek (books' rowid, or idx_books_genre's (genre, rowid) when genres are
+    given), so the cost is O(k log n) regardless of catalogue size. Probes that
+    land on an already-picked row are retried.
+    """
+    c = conn.cursor()
+    ranges = []
+    if genres:
+        # Weight genres by size (from the summary table) so every book is roughly equally likely
+        placeholders = ','.join('?' * len(genres))
+        try:
+            c.execute(f"SELECT genre, cnt FROM genre_counts WHERE genre IN ({placeholders})", list(genres))
+            genre_sizes = [(row['genre'], row['cnt']) for row in c.fetchall()]
+        except sqlite3.OperationalError:
+            genre_sizes = [(genre, 1) for genre in genres]  # summary tables not migrated yet
+        for genre, size in genre_sizes:
+            c.execute("SELECT MIN(id) AS lo, MAX(id) AS hi FROM books WHERE genre = ?", (genre,))
+            bounds = c.fetchone()
+            if bounds['lo'] is not None:
+                ranges.append((genre, bounds['lo'], bounds['hi'], size))
+    else:
+        c.execute("SELECT MIN(id) AS lo, MAX(id) AS hi FROM books")
+        bounds = c.fetchone()
+        if bounds['lo'] is not None:
+            ranges.append((None, bounds['lo'], bounds['hi'], 1))
+    if not ranges:
+        return []
+
+    weights = [r[3] for r in ranges]
+    seen = set(exclude)
+    picked = []
+    for _ in range(k * SAMPLE_PROBES_PER_ROW):
+        if len(picked) >= k:
+            break
+        genre, lo, hi, _ = random.choices(ranges, weights=weights)[0]
+        target = random.randint(lo, hi)
+        if genre is None:
+            c.execute(f"SELECT {columns} FROM books WHERE id >= ? ORDER BY id LIMIT 1", (target,))
+        else:
+            c.execute(f"SELECT {columns} FROM books WHERE genre = ? AND id >= ? ORDER BY id LIMIT 1",
+                      (genre, target))
+        row = c.fetchone()
+        if row is not None and row['id'] not in seen:
+            seen.add(row['id'])
+            picked.append(row)
+    return picked
+
+@migration(6, 'book_borrow_counts')
+def migrate_book_borrow_counts(conn):
+    """Per-book checkout totals kept by triggers on borrowings, indexed for top-k reads"""
+    c = conn.cursor()
+    c.execute("CREATE TABLE IF NOT EXISTS book_borrow_counts (book_id INTEGER PRIMARY KEY, cnt INTEGER NOT NULL)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_book_borrow_counts_cnt ON book_borrow_counts(cnt DESC)")
+    add = '''INSERT INTO book_borrow_counts (book_id, cnt) SELECT new.book_id, 1 WHERE new.book_id IS NOT NULL
+                 ON CONFLICT(book_id) DO UPDATE SET cnt = cnt + 1;'''
+    remove = '''UPDATE book_borrow_counts SET cnt = cnt - 1 WHERE book_id = old.book_id;
+                 DELETE FROM book_borrow_counts WHERE book_id = old.book_id AND cnt <= 0;'''
+    c.execute(f"CREATE TRIGGER IF NOT EXISTS borrowings_count_insert AFTER INSERT ON borrowings BEGIN {add} END")
+    c.execute(f"CREATE TRIGGER IF NOT EXISTS borrowings_count_delete AFTER DELETE ON borrowings BEGIN {remove} END")
+    c.execute(f"CREATE TRIGGER IF NOT EXISTS borrowings_count_update AFTER UPDATE OF book_id ON borrowings BEGIN {remove} {add} END")
+    c.execute("DELETE FROM book_borrow_counts")
+    c.execute('''INSERT INTO book_borrow_counts (book_id, cnt)
+                 SELECT book_id, COUNT(*) FROM borrowings WHERE book_id IS NOT NULL GROUP BY book_id''')
+
+def most_borrowed_books(conn, k, columns=BOOK_CARD_COLUMNS, genres=None):
+    """Most-borrowed books, topped up with random picks while circulation data is thin"""
+    c = conn.cursor()
+    query = f"SELECT {columns} FROM book_borrow_counts p JOIN books ON books.id = p.book_id"
+    params = []
+    if genres:
+        query += f" WHERE genre IN ({','.join('?' * len(genres))})"
+        params.extend(genres)
+    query += " ORDER BY p.cnt DESC, p.book_id ASC LIMIT ?"
+    try:
+        c.execute(query, params + [k])
+        rows = c.fetchall()
+    except sqlite3.OperationalError:
+        rows = []  # book_borrow_counts not migrated yet
+
+    if len(rows) < k:
+        rows += sample_books(conn, k - len(rows), columns, genres, exclude={row['id'] for row in rows})
+    return rows
+
+# -------------------- Search History Logging --------------------
+class SearchHistoryWriter:
+    """Bounded write-behind buffer for search_history, flushed by one thread per worker
+
+    Rows are written with executemany in a single transaction once BATCH rows are
+    queued or FLUSH_MS has passed since the oldest one arrived.
+    """
+
+    def __init__(self, batch, flush_ms, max_queue, enqueue_wait_ms):
+        self.batch = batch
+        self.flush_interval = flush_ms / 1000.0
+        self.max_queue = max_queue
+        self.enqueue_wait = enqueue_wait_ms / 1000.0
+        self.pid = os.getpid()
+        self._queue = []
+        self._in_flight = []
+        self._closed = False
+        self._thread = None
+        self._last_prune = time.monotonic()
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self.stats = {'queued': 0, 'written': 0, 'dropped': 0, 'waits': 0,
+                      'flushes': 0, 'failed_flushes': 0, 'pruned': 0}
+
+    def add(self, user_id, search_term, search_by):
+        """Queue one row; returns False if it had to be dropped"""
+        # Stamp now, not at flush time, so history order matches request order
+        row = (user_id, search_term, search_by, datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S'))
+        with self._cond:
+            if self._closed:
+                self.stats['dropped'] += 1
+                return False
+            self._ensure_thread()
+            if len(self._queue) >= self.max_queue:
+                # Backpressure: wake the flusher and give it a moment to drain
+                self.stats['waits'] += 1
+                self._cond.notify_all()
+                if not self._cond.wait_for(lambda: len(self._queue) < self.max_queue,
+                                           timeout=self.enqueue_wait):
+                    self.stats['dropped'] += 1
+                    return False
+            self._queue.append(row)
+            self.stats['queued'] += 1
+            if len(self._queue) >= self.batch:
+                self._cond.notify_all()
+        return True
+
+    def pending_for(self, user_id, limit):
+        """Newest queued or in-flight rows for one user, shaped like get_search_history rows"""
+        with self._cond:
+            rows = [r for r in self._in_flight + self._queue if r[0] == user_id]
+        return [{'search_term': r[1], 'search_by': r[2], 'search_date': r[3]}
+                for r in reversed(rows[-limit:])]
+
+    def flush(self):
+        """Write everything queued so far; returns the number of rows written"""
+        with self._flush_lock:
+            written = 0
+            while True:
+                with self._cond:
+                    if not self._queue:
+                        return written
+                    self._in_flight, self._queue = self._queue[:self.batch], self._queue[self.batch:]
+                    rows = self._in_flight
+                    self._cond.notify_all()
+                try:
+                    self._write(rows)
+                    written += len(rows)
+                    with self._cond:
+                        self.stats['written'] += len(rows)
+                        self.stats['flushes'] += 1
+                except sqlite3.Error as e:
+                    with self._cond:
+                        self.stats['failed_flushes'] += 1
+                        # Keep the rows for the next attempt unless that would overflow the buffer
+                        room = self.max_queue - len(self._queue)
+                        kept = rows[-room:] if room > 0 else []
+                        self._queue[:0] = kept
+                        self.stats['dropped'] += len(rows) - len(kept)
+                    app.logger.warning("search history flush of %d rows failed: %s", len(rows), e)
+                    return written
+                finally:
+                    with self._cond:
+                        self._in_flight = []
+
+    def _write(self, rows):
+        conn = connect_db()
+        try:
+            with conn:
+                conn.executemany("""INSERT INTO search_history (user_id, search_term, search_by, search_date)
+                                    VALUES (?, ?, ?, ?)""", rows)
+        finally:
+            conn.close()
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='search-history-writer', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._closed or len(self._queue) >= self.batch,
+                                    timeout=self.flush_interval)
+                if self._closed:
+                    return
+            self.flush()
+            self._maybe_prune()
+
+    def _maybe_prune(self):
+        interval = app.config['SEARCH_HISTORY_PRUNE_INTERVAL']
+        if interval <= 0 or time.monotonic() - self._last_prune < interval:
+            return
+        self._last_prune = time.monotonic()
+        conn = connect_db()
+        try:
+            removed = prune_search_history(conn, app.config['SEARCH_HISTORY_RETENTION_DAYS'],
+                                           app.config['SEARCH_HISTORY_KEEP_PER_USER'])
+            with self._cond:
+                self.stats['pruned'] += removed
+        except sqlite3.Error as e:
+            app.logger.warning("search history pruning failed: %s", e)
+        finally:
+            conn.close()
+
+    def close(self):
+        """Stop the flusher and write whatever is left (worker shutdown)"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=5)
+        return self.flush()
+
+    def snapshot(self):
+        with self._cond:
+            return dict(self.stats, pending=len(self._queue) + len(self._in_flight))
+
+
+_history_writer = None
+
+def get_history_writer():
+    """Return this process's writer, rebuilding it after a fork like the pool"""
+    global _history_writer
+    if _history_writer is None or _history_writer.pid != os.getpid():
+        with _pool_lock:
+            if _history_writer is None or _history_writer.pid != os.getpid():
+                _history_writer = SearchHistoryWriter(app.config['SEARCH_HISTORY_BATCH'],
+                                                      app.config['SEARCH_HISTORY_FLUSH_MS'],
+                                                      app.config['SEARCH_HISTORY_QUEUE_MAX'],
+                                                      app.config['SEARCH_HISTORY_ENQUEUE_WAIT_MS'])
+    return _history_writer
+
+@atexit.register
+def flush_search_history():
+    """Flush buffered history on interpreter exit (also wired to gunicorn's worker_exit)"""
+    if _history_writer is not None and _history_writer.pid == os.getpid():
+        written = _history_writer.close()
+        if written:
+            app.logger.info("flushed %d buffered search history rows on exit", written)
+
+@migration(7, 'search_history_rollup')
+def migrate_search_history_rollup(conn):
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS search_history_rollup
+                 (user_id INTEGER,
+                  search_term TEXT,
+                  search_by TEXT,
+                  searches INTEGER NOT NULL,
+                  first_searched TIMESTAMP,
+                  last_searched TIMESTAMP,
+                  PRIMARY KEY (user_id, search_term, search_by))''')
+    print("✓ Created search_history_rollup table")
+
+def prune_search_history(conn, retention_days, keep_per_user):
+    """Fold old history into search_history_rollup and delete it; returns rows removed
+
+    A row goes once it is older than retention_days or beyond the newest
+    keep_per_user rows for its user, so the per-user index range stays short.
+    """
+    if rollups_enabled(conn):
+        # Count rows into the daily search rollup before any of them are deleted
+        update_search_rollups(conn, app.config['ROLLUP_BATCH_SIZE'])
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=retention_days)).strftime('%Y-%m-%d %H:%M:%S')
+    c = conn.cursor()
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        c.execute("DROP TABLE IF EXISTS temp.expired_history")
+        c.execute("""CREATE TEMP TABLE expired_history AS
+                     SELECT id FROM (
+                         SELECT id, search_date,
+                                ROW_NUMBER() OVER (PARTITION BY user_id
+                                                   ORDER BY search_date DESC, id DESC) AS rn
+                         FROM search_history)
+                     WHERE search_date < ? OR rn > ?""", (cutoff, keep_per_user))
+        c.execute("""INSERT INTO search_history_rollup
+                         (user_id, search_term, search_by, searches, first_searched, last_searched)
+                     SELECT user_id, search_term, search_by, COUNT(*), MIN(search_date), MAX(search_date)
+                     FROM search_history
+                     WHERE id IN (SELECT id FROM temp.expired_history)
+                     GROUP BY user_id, search_term, search_by
+                     ON CONFLICT (user_id, search_term, search_by) DO UPDATE SET
+                         searches = searches + excluded.searches,
+                         first_searched = MIN(first_searched, excluded.first_searched),
+                         last_searched = MAX(last_searched, excluded.last_searched)""")
+        c.execute("DELETE FROM search_history WHERE id IN (SELECT id FROM temp.expired_history)")
+        removed = c.rowcount
+        c.execute("DROP TABLE temp.expired_history")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return removed
+
+@app.cli.command('prune-search-history')
+@click.option('--days', type=int, default=None, help='Keep rows newer than this many days')
+@click.option('--keep', type=int, default=None, help='Keep at most this many rows per user')
+def prune_search_history_command(days, keep):
+    """Roll up and delete old search history"""
+    migrate_database()
+    days = app.config['SEARCH_HISTORY_RETENTION_DAYS'] if days is None else days
+    keep = app.config['SEARCH_HISTORY_KEEP_PER_USER'] if keep is None else keep
+    removed = prune_search_history(get_db(), days, keep)
+    print(f"✓ Rolled up and removed {removed} search history rows (older than {days} days or beyond {keep} per user)")
+
+# -------------------- Search Suggestions --------------------
+SUGGEST_FIELDS = ('title', 'author', 'genre')
+SUGGEST_TOP = 20          # most suggestions a single request can ask for
+SUGGEST_SCAN_LIMIT = 256  # prefix ranges larger than this are answered from a cached top list
+SUGGEST_LEADING_ARTICLES = ('the ', 'a ', 'an ')
+SUGGEST_SQL_ROWS = 200    # rows read per spelling of the prefix while the index is building
+# Per-term cost estimate: pointer slots in the key/term lists, entries in the display/books dicts
+_LIST_SLOT_BYTES = 8
+_DICT_ENTRY_BYTES = 48
+SUGGEST_BUDGET_SHARE = 0.9  # of SUGGEST_FIELD_MAX_MB for terms; the rest covers cached top lists
+_KEY_END = '\U0010ffff'
+
+def suggest_term(value):
+    """Normalised form of a catalogue value: lower case, single spaces"""
+    return ' '.join(str(value).split()).lower() if value else ''
+
+def suggest_keys(field, term):
+    """Prefix keys for a term: the term itself plus the word users usually start typing"""
+    keys = [term]
+    if field == 'title':
+        for article in SUGGEST_LEADING_ARTICLES:
+            if term.startswith(article) and len(term) > len(article):
+                keys.append(term[len(article):])
+                break
+    elif field == 'author' and ' ' in term:
+        keys.append(term.rsplit(' ', 1)[1])
+    return keys
+
+
+class PrefixIndex:
+    """Sorted-array prefix index over the distinct values of one books column
+
+    _keys/_terms are parallel lists sorted by key, so a prefix is a bisect range.
+    Ranges wider than SUGGEST_SCAN_LIMIT keep a cached top list, built bottom-up
+    from their children's lists and patched in place as weights change.
+    Terms are admitted, heaviest first, while their estimated size fits max_bytes.
+    """
+
+    def __init__(self, field, max_bytes):
+        self.field = field
+        self.max_bytes = max_bytes
+        self.display = {}    # term -> value as first seen in books
+        self.books = {}      # term -> number of books carrying it
+        self.searches = {}   # term -> times it was searched for
+        self._keys = []
+        self._terms = []
+        self._top = {}
+        self.bytes = 0       # term_bytes() summed over the indexed terms
+        self.over_budget = 0
+
+    def term_bytes(self, term, display):
+        """Estimated memory one term costs: its strings, list slots per key and dict entries"""
+        size = sys.getsizeof(term) + sys.getsizeof(display) + 2 * _DICT_ENTRY_BYTES
+        for key in suggest_keys(self.field, term):
+            size += 2 * _LIST_SLOT_BYTES + (sys.getsizeof(key) if key != term else 0)
+        return size
+
+    @classmethod
+    def build(cls, field, values, searches, max_bytes):
+        """values: {term: [display, books]} as aggregated from the books table"""
+        index = cls(field, max_bytes)
+        costs = {term: index.term_bytes(term, display) for term, (display, _) in values.items()}
+        budget = max_bytes * SUGGEST_BUDGET_SHARE
+        if sum(costs.values()) > budget:
+            keep, used = [], 0
+            for term in sorted(values, key=lambda t: values[t][1] + searches.get(t, 0), reverse=True):
+                if used + costs[term] > budget:
+                    break
+                keep.append(term)
+                used += costs[term]
+            index.over_budget = len(values) - len(keep)
+            values = {t: values[t] for t in keep}
+        index.searches = {t: n for t, n in searches.items() if t in values}
+        index.bytes = sum(costs[t] for t in values)
+        pairs = []
+        for term, (display, books) in values.items():
+            index.display[term] = display
+            index.books[term] = books
+            pairs.extend((key, term) for key in suggest_keys(field, term))
+        pairs.sort()
+        index._keys = [k for k, _ in pairs]
+        index._terms = [t for _, t in pairs]
+        index._warm('', 0, len(index._keys))
+        return index
+
+    def weight(self, term):
+        return self.books[term] + self.searches.get(term, 0)
+
+    def _range(self, prefix):
+        lo = bisect.bisect_left(self._keys, prefix)
+        return lo, bisect.bisect_left(self._keys, prefix + _KEY_END, lo)
+
+    def _top_of(self, lo, hi, limit):
+        # dict.fromkeys keeps key order, so equal weights come out alphabetically
+        return heapq.nlargest(limit, dict.fromkeys(self._terms[lo:hi]), key=self.weight)
+
+    def _children(self, prefix, lo, hi):
+        """Split a prefix range into the terms keyed exactly by it and (child, lo, hi) subranges"""
+        exact, children = [], []
+        i, length = lo, len(prefix) + 1
+        while i < hi and len(self._keys[i]) < length:
+            exact.append(self._terms[i])
+            i += 1
+        while i < hi:
+            child = self._keys[i][:length]
+            j = bisect.bisect_left(self._keys, child + _KEY_END, i, hi)
+            children.append((child, i, j))
+            i = j
+        return exact, children
+
+    def _warm(self, prefix, lo, hi):
+        """Top list for a range, caching it and every crowded range below it"""
+        if hi - lo <= SUGGEST_SCAN_LIMIT:
+            return self._top_of(lo, hi, SUGGEST_TOP)
+        candidates, children = self._children(prefix, lo, hi)
+        for child, i, j in children:
+            candidates.extend(self._warm(child, i, j))
+        top = heapq.nlargest(SUGGEST_TOP, dict.fromkeys(candidates), key=self.weight)
+        if prefix:
+            self._top[prefix] = top
+        return top
+
+    def _merge_children(self, prefix):
+        """Recompute one cached top list from its children after a term dropped out"""
+        lo, hi = self._range(prefix)
+        if hi - lo <= SUGGEST_SCAN_LIMIT:
+            self._top.pop(prefix, None)
+            return
+        candidates, children = self._children(prefix, lo, hi)
+        for child, i, j in children:
+            candidates.extend(self._top[child] if child in self._top else self._terms[i:j])
+        live = (t for t in dict.fromkeys(candidates) if t in self.books)
+        self._top[prefix] = heapq.nlargest(SUGGEST_TOP, live, key=self.weight)
+
+    def _update_tops(self, term, increased):
+        """Patch cached top lists along the term's key paths, deepest prefix first"""
+        for key in suggest_keys(self.field, term):
+            for end in range(len(key), 0, -1):
+                prefix = key[:end]
+                top = self._top.get(prefix)
+                if top is None:
+                    continue
+                if increased:
+                    if term in top or len(top) < SUGGEST_TOP or self.weight(term) > self.weight(top[-1]):
+                        merged = sorted(dict.fromkeys(top + [term]), key=self.weight, reverse=True)
+                        self._top[prefix] = merged[:SUGGEST_TOP]
+                elif term in top:
+                    self._merge_children(prefix)
+
+    def suggest(self, prefix, limit):
+        lo, hi = self._range(prefix)
+        if hi - lo <= SUGGEST_SCAN_LIMIT:
+            return self._top_of(lo, hi, limit)
+        top = self._top.get(prefix)
+        if top is None:
+            # Became crowded through edits since the last build
+            top = self._warm(prefix, lo, hi)
+        return top[:limit]
+
+    def add(self, value):
+        term = suggest_term(value)
+        if not term:
+            return
+        if term in self.books:
+            self.books[term] += 1
+        else:
+            display = ' '.join(str(value).split())
+            cost = self.term_bytes(term, display)
+            if self.bytes + cost > self.max_bytes * SUGGEST_BUDGET_SHARE:
+                self.over_budget += 1
+                return
+            self.bytes += cost
+            self.display[term] = display
+            self.books[term] = 1
+            for key in suggest_keys(self.field, term):
+                i = bisect.bisect_left(self._keys, key)
+                while i < len(self._keys) and self._keys[i] == key and self._terms[i] < term:
+                    i += 1
+                self._keys.insert(i, key)
+                self._terms.insert(i, term)
+        self._update_tops(term, increased=True)
+
+    def remove(self, value):
+        term = suggest_term(value)
+        if term not in self.books:
+            return
+        self.books[term] -= 1
+        if self.books[term] == 0:
+            self.bytes -= self.term_bytes(term, self.display[term])
+            del self.books[term], self.display[term]
+            self.searches.pop(term, None)
+            for key in suggest_keys(self.field, term):
+                lo, hi = bisect.bisect_left(self._keys, key), bisect.bisect_right(self._keys, key)
+                i = self._terms.index(term, lo, hi)
+                del self._keys[i], self._terms[i]
+        self._update_tops(term, increased=False)
+
+    def approx_bytes(self):
+        """Measured size of the index structures; walks every term, so not for request paths"""
+        size = sys.getsizeof(self._keys) + sys.getsizeof(self._terms)
+        size += sum(sys.getsizeof(d) for d in (self.display, self.books, self.searches, self._top))
+        size += sum(sys.getsizeof(t) for t in self.books)
+        size += sum(sys.getsizeof(d) for t, d in self.display.items() if d is not t)
+        size += sum(sys.getsizeof(k) for k, t in zip(self._keys, self._terms) if k is not t)
+        size += sum(sys.getsizeof(top) for top in self._top.values())
+        return size
+
+
+class SuggestIndex:
+    """Per-worker suggestion indexes for title/author/genre
+
+    Book edits from any worker are replayed from the book_changes log (see
+    migration 8); a full rebuild every SUGGEST_MAX_AGE seconds picks up
+    search popularity and runs in the background while the old index serves.
+    The first build is in the background too (started by gunicorn's
+    post_worker_init or the first request); until it lands /api/suggest
+    answers from sql_suggestions().
+    """
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.fields = {}
+        self.change_id = 0
+        self.built_at = 0.0
+        self.build_seconds = 0.0
+        self._checked_at = 0.0
+        self._rebuilding = False
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self.stats = {'queries': 0, 'changes_applied': 0, 'rebuilds': 0}
+
+    def _load(self, conn):
+        """Aggregate the catalogue and search popularity from one read snapshot"""
+        c = conn.cursor()
+        c.execute("BEGIN")
+        try:
+            try:
+                c.execute("SELECT COALESCE(MAX(id), 0) AS id FROM book_changes")
+                change_id = c.fetchone()['id']
+            except sqlite3.OperationalError:
+                change_id = 0
+            values = {field: {} for field in SUGGEST_FIELDS}
+            c.execute("SELECT title, author, genre FROM books")
+            for row in c:
+                for field in SUGGEST_FIELDS:
+                    term = suggest_term(row[field])
+                    if term:
+                        entry = values[field].get(term)
+                        if entry is None:
+                            values[field][term] = [' '.join(row[field].split()), 1]
+                        else:
+                            entry[1] += 1
+            searches = {field: {} for field in SUGGEST_FIELDS}
+            history = ["SELECT search_by, search_term, COUNT(*) AS n FROM search_history GROUP BY search_by, search_term"]
+            try:
+                c.execute("SELECT 1 FROM search_history_rollup LIMIT 1")
+                history.append("SELECT search_by, search_term, SUM(searches) FROM search_history_rollup GROUP BY search_by, search_term")
+            except sqlite3.OperationalError:
+                pass
+            c.execute(" UNION ALL ".join(history))
+            for search_by, search_term, n in c:
+                term = suggest_term(search_term)
+                for field in (SUGGEST_FIELDS if search_by == 'all' else (search_by,)):
+                    if field in searches and term:
+                        searches[field][term] = searches[field].get(term, 0) + n
+        finally:
+            conn.commit()
+        return change_id, values, searches
+
+    def rebuild(self, conn):
+        started = time.perf_counter()
+        change_id, values, searches = self._load(conn)
+        max_bytes = app.config['SUGGEST_FIELD_MAX_MB'] * 2**20
+        fields = {field: PrefixIndex.build(field, values[field], searches[field], max_bytes)
+                  for field in SUGGEST_FIELDS}
+        with self._lock:
+            self.fields = fields
+            self.change_id = change_id
+            self.built_at = time.time()
+            self.build_seconds = time.perf_counter() - started
+            self.stats['rebuilds'] += 1
+        # Changes logged while we were aggregating
+        self.apply_changes(conn)
+        try:
+            conn.execute("DELETE FROM book_changes WHERE changed_at < datetime('now', '-1 day')")
+            conn.commit()
+        except sqlite3.OperationalError:
+            conn.rollback()
+
+    def _rebuild_in_background(self):
+        conn = connect_db()
+        try:
+            self.rebuild(conn)
+        except sqlite3.Error as e:
+            app.logger.warning("suggestion index rebuild failed: %s", e)
+        finally:
+            conn.close()
+            self._rebuilding = False
+
+    def apply_changes(self, conn):
+        """Replay book_changes rows newer than the last one applied
+
+        An all-NULL row marks a bulk load (see import_books); rather than
+        replaying it row by row the index is rebuilt in the background.
+        """
+        c = conn.cursor()
+        try:
+            c.execute("SELECT * FROM book_changes WHERE id > ? ORDER BY id", (self.change_id,))
+            changes = c.fetchall()
+        except sqlite3.OperationalError:
+            return 0
+        with self._lock:
+            for change in changes:
+                if change['id'] <= self.change_id:
+                    continue
+                if all(change[f'{side}_{field}'] is None for side in ('old', 'new') for field in SUGGEST_FIELDS):
+                    self._start_rebuild()
+                    break
+                for field, index in self.fields.items():
+                    old, new = change[f'old_{field}'], change[f'new_{field}']
+                    if suggest_term(old) != suggest_term(new):
+                        index.remove(old)
+                        index.add(new)
+                self.change_id = change['id']
+                self.stats['changes_applied'] += 1
+        return len(changes)
+
+    def warm(self):
+        """Start the first build in the background unless the index is built or building"""
+        if self.pid != os.getpid():
+            # Forked: the arrays are shared copy-on-write, the lock and thread state are not
+            self.pid = os.getpid()
+            self._lock = threading.Lock()
+            self._build_lock = threading.Lock()
+            self._rebuilding = False
+        if not self.built_at:
+            self._start_rebuild()
+
+    def refresh(self, conn, force=False):
+        """Poll the change log at most every SUGGEST_REFRESH_MS once built; start the build if not"""
+        self.warm()
+        if not self.built_at:
+            return
+        now = time.monotonic()
+        if force or now - self._checked_at >= app.config['SUGGEST_REFRESH_MS'] / 1000.0:
+            self._checked_at = now
+            self.apply_changes(conn)
+        if time.time() - self.built_at > app.config['SUGGEST_MAX_AGE']:
+            self._start_rebuild()
+
+    def _start_rebuild(self):
+        with self._build_lock:
+            if self._rebuilding:
+                return
+            self._rebuilding = True
+        threading.Thread(target=self._rebuild_in_background, name='suggest-rebuild', daemon=True).start()
+
+    def suggest(self, prefix, field, limit):
+        term = suggest_term(prefix)
+        if not term:
+            return []
+        fields = SUGGEST_FIELDS if field == 'all' else (field,)
+        with self._lock:
+            self.stats['queries'] += 1
+            found = []
+            for name in fields:
+                index = self.fields[name]
+                found.extend({'text': index.display[t], 'field': name, 'weight': index.weight(t)}
+                             for t in index.suggest(term, limit))
+        if len(fields) > 1:
+            found.sort(key=lambda s: -s['weight'])
+        return found[:limit]
+
+    def snapshot(self):
+        with self._lock:
+            fields = {name: {'terms': len(index.books), 'keys': len(index._keys),
+                             'cached_prefixes': len(index._top), 'over_budget': index.over_budget,
+                             'estimated_bytes': index.bytes, 'max_bytes': index.max_bytes}
+                      for name, index in self.fields.items()}
+            return dict(self.stats, fields=fields, change_id=self.change_id, ready=bool(self.built_at),
+                        age_seconds=round(time.time() - self.built_at, 1) if self.built_at else None,
+                        build_seconds=round(self.build_seconds, 3))
+
+
+_suggest_index = SuggestIndex()
+
+def refresh_suggestions(conn):
+    """Pick up this request's book edits straight away; no-op until the index is first used"""
+    if _suggest_index.built_at:
+        _suggest_index.refresh(conn, force=True)
+
+def warm_suggestions():
+    """Start building this worker's suggestion index; gunicorn's post_worker_init calls this"""
+    _suggest_index.warm()
+
+def sql_suggestions(conn, prefix, field, limit):
+    """Prefix suggestions read from the column indexes, for requests before the index is built
+
+    One bounded range scan per spelling of the prefix (as typed, lower, capitalised,
+    title case, and after a leading article for titles), so the cost does not grow
+    with the catalogue. Author surnames are not matched, and weights only count the
+    books read.
+    """
+    term = suggest_term(prefix)
+    if not term:
+        return []
+    spellings = dict.fromkeys([' '.join(prefix.split()), term, term.capitalize(), term.title()])
+    c = conn.cursor()
+    found = []
+    for name in (SUGGEST_FIELDS if field == 'all' else (field,)):
+        starts = list(spellings)
+        if name == 'title':
+            starts += [article.capitalize() + s for article in SUGGEST_LEADING_ARTICLES for s in spellings]
+        counts, display = Counter(), {}
+        for start in dict.fromkeys(starts):
+            c.execute(f"SELECT {name} FROM books WHERE {name} >= ? AND {name} < ? ORDER BY {name} LIMIT ?",
+                      (start, start + _KEY_END, SUGGEST_SQL_ROWS))
+            for (value,) in c.fetchall():
+                value_term = suggest_term(value)
+                counts[value_term] += 1
+                display.setdefault(value_term, ' '.join(value.split()))
+        found.extend({'text': display[t], 'field': name, 'weight': n} for t, n in counts.items())
+    found.sort(key=lambda s: (-s['weight'], s['text'].lower()))
+    return found[:limit]
+
+@migration(8, 'book_changes_log')
+def migrate_book_changes_log(conn):
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS book_changes
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  old_title TEXT, old_author TEXT, old_genre TEXT,
+                  new_title TEXT, new_author TEXT, new_genre TEXT,
+                  changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    c.execute("""CREATE TRIGGER IF NOT EXISTS books_changes_insert AFTER INSERT ON books BEGIN
+                     INSERT INTO book_changes (new_title, new_author, new_genre)
+                     VALUES (new.title, new.author, new.genre);
+                 END""")
+    c.execute("""CREATE TRIGGER IF NOT EXISTS books_changes_delete AFTER DELETE ON books BEGIN
+                     INSERT INTO book_changes (old_title, old_author, old_genre)
+                     VALUES (old.title, old.author, old.genre);
+                 END""")
+    c.execute("""CREATE TRIGGER IF NOT EXISTS books_changes_update AFTER UPDATE OF title, author, genre ON books
+                 WHEN old.title IS NOT new.title OR old.author IS NOT new.author OR old.genre IS NOT new.genre BEGIN
+                     INSERT INTO book_changes (old_title, old_author, old_genre, new_title, new_author, new_genre)
+                     VALUES (old.title, old.author, old.genre, new.title, new.author, new.genre);
+                 END""")
+    print("✓ Created book_changes log for the suggestion index")
+
+# -------------------- Fuzzy Matching --------------------
+# Typo-tolerant title/author search over a trigger-maintained (field, trigram, book_id) table
+FUZZY_FIELDS = {'title': 't', 'author': 'a'}
+FUZZY_MAX_CHARS = 200         # trigrams are indexed for the first this-many characters
+FUZZY_MAX_POSTINGS = 20000    # posting rows read per query, rarest trigrams first
+FUZZY_CANDIDATES = 200        # books scored per query
+FUZZY_MIN_SIMILARITY = 0.3
+_ASCII_LOWER = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')
+
+def trigram_set(text):
+    """Trigrams of ' text ', lower-cased the way SQLite's lower() does it"""
+    padded = f" {text.translate(_ASCII_LOWER)} "
+    return {padded[i:i + 3] for i in range(min(len(padded) - 2, FUZZY_MAX_CHARS))}
+
+def trigram_similarity(query, value):
+    """Dice coefficient of trigram sets, best over the whole value and its query-sized word windows"""
+    grams = trigram_set(query)
+    if not grams or not value:
+        return 0.0
+    def dice(text):
+        other = trigram_set(text)
+        return 2.0 * len(grams & other) / (len(grams) + len(other))
+    best = dice(value)
+    words, n = value.split(), len(query.split())
+    for i in range(len(words) - n + 1 if len(words) > n else 0):
+        best = max(best, dice(' '.join(words[i:i + n])))
+    return best
+
+def fuzzy_candidates(c, term, field):
+    """Book ids sharing the most trigrams with term, reading at most FUZZY_MAX_POSTINGS postings"""
+    grams = sorted(trigram_set(term))
+    if not grams:
+        return []
+    tag = FUZZY_FIELDS[field]
+    c.execute(f"""SELECT trigram, cnt FROM trigram_counts
+                  WHERE field = ? AND cnt > 0 AND trigram IN ({', '.join('?' * len(grams))})""",
+              [tag] + grams)
+    frequencies = sorted(((row['cnt'], row['trigram']) for row in c.fetchall()))
+    
+    # Rarest trigrams carry the most signal; common ones get a capped share of the budget
+    per_gram = max(1, FUZZY_MAX_POSTINGS // len(grams))
+    chosen, budget = [], FUZZY_MAX_POSTINGS
+    for cnt, gram in frequencies:
+        if budget <= 0:
+            break
+        take = min(cnt, per_gram, budget)
+        chosen.append((gram, take))
+        budget -= take
+    if not chosen:
+        return []
+    postings = " UNION ALL ".join(
+        ["SELECT * FROM (SELECT book_id FROM book_trigrams WHERE field = ? AND trigram = ? LIMIT ?)"] * len(chosen))
+    params = []
+    for gram, take in chosen:
+        params.extend([tag, gram, take])
+    c.execute(f"""SELECT book_id, COUNT(*) AS shared FROM ({postings})
+                  GROUP BY book_id ORDER BY shared DESC LIMIT ?""", params + [FUZZY_CANDIDATES])
+    return [row['book_id'] for row in c.fetchall()]
+
+def fuzzy_search(conn, term, field, status=None, year_from=None, year_to=None,
+                 columns=BOOK_LIST_COLUMNS, limit=50):
+    """Close title/author matches ranked by trigram similarity; [] before migration 9 has run"""
+    c = conn.cursor()
+    try:
+        ids = fuzzy_candidates(c, term, field)
+    except sqlite3.OperationalError:
+        return []
+    if not ids:
+        return []
+    where = [f"id IN ({', '.join('?' * len(ids))})"]
+    params = list(ids)
+    if status:
+        where.append(f"status IN ({', '.join('?' * len(status))})")
+        params.extend(status)
+    if str(year_from or '').isdigit():
+        where.append("published_year >= ?")
+        params.append(int(year_from))
+    if str(year_to or '').isdigit():
+        where.append("published_year <= ?")
+        params.append(int(year_to))
+    c.execute(f"SELECT {columns} FROM books WHERE {' AND '.join(where)}", params)
+    
+    scored = []
+    for row in c.fetchall():
+        score = trigram_similarity(term, row[field])
+        if score >= FUZZY_MIN_SIMILARITY:
+            scored.append((-score, row[field] or '', dict(row, similarity=round(score, 3))))
+    scored.sort(key=lambda s: s[:2])
+    return [book for _, _, book in scored[:limit]]
+
+def _trigram_insert_sql(ref):
+    return ''.join(f"""
+            INSERT OR IGNORE INTO book_trigrams (field, trigram, book_id)
+            SELECT '{tag}', substr(' ' || lower({ref}.{field}) || ' ', n, 3), {ref}.id
+            FROM trigram_positions WHERE n <= length({ref}.{field});""" for field, tag in FUZZY_FIELDS.items())
+
+@migration(9, 'book_trigrams')
+def migrate_book_trigrams(conn):
+    c = conn.cursor()
+    c.execute("CREATE TABLE IF NOT EXISTS trigram_positions (n INTEGER PRIMARY KEY)")
+    c.executemany("INSERT OR IGNORE INTO trigram_positions (n) VALUES (?)",
+                  [(n,) for n in range(1, FUZZY_MAX_CHARS + 1)])
+    c.execute('''CREATE TABLE IF NOT EXISTS book_trigrams
+                 (field TEXT NOT NULL,
+                  trigram TEXT NOT NULL,
+                  book_id INTEGER NOT NULL,
+                  PRIMARY KEY (field, trigram, book_id)) WITHOUT ROWID''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_book_trigrams_book ON book_trigrams(book_id)")
+    c.execute('''CREATE TABLE IF NOT EXISTS trigram_counts
+                 (field TEXT NOT NULL,
+                  trigram TEXT NOT NULL,
+                  cnt INTEGER NOT NULL,
+                  PRIMARY KEY (field, trigram)) WITHOUT ROWID''')
+    
+    # Backfill before the count triggers exist, then count in one pass
+    for field, tag in FUZZY_FIELDS.items():
+        c.execute(f"""INSERT OR IGNORE INTO book_trigrams (field, trigram, book_id)
+                      SELECT '{tag}', substr(' ' || lower(books.{field}) || ' ', n, 3), books.id
+                      FROM books JOIN trigram_positions ON n <= length(books.{field})""")
+    c.execute("""INSERT OR REPLACE INTO trigram_counts (field, trigram, cnt)
+                 SELECT field, trigram, COUNT(*) FROM book_trigrams GROUP BY field, trigram""")
+    
+    c.execute("""CREATE TRIGGER IF NOT EXISTS book_trigrams_count_insert AFTER INSERT ON book_trigrams BEGIN
+                     INSERT INTO trigram_counts (field, trigram, cnt) VALUES (new.field, new.trigram, 1)
+                     ON CONFLICT(field, trigram) DO UPDATE SET cnt = cnt + 1;
+                 END""")
+    c.execute("""CREATE TRIGGER IF NOT EXISTS book_trigrams_count_delete AFTER DELETE ON book_trigrams BEGIN
+                     UPDATE trigram_counts SET cnt = cnt - 1 WHERE field = old.field AND trigram = old.trigram;
+                 END""")
+    c.execute(f"""CREATE TRIGGER IF NOT EXISTS books_trigrams_insert AFTER INSERT ON books BEGIN
+                      {_trigram_insert_sql('new')}
+                  END""")
+    c.execute("""CREATE TRIGGER IF NOT EXISTS books_trigrams_delete AFTER DELETE ON books BEGIN
+                     DELETE FROM book_trigrams WHERE book_id = old.id;
+                 END""")
+    c.execute(f"""CREATE TRIGGER IF NOT EXISTS books_trigrams_update AFTER UPDATE OF title, author ON books
+                  WHEN old.title IS NOT new.title OR old.author IS NOT new.author BEGIN
+                      DELETE FROM book_trigrams WHERE book_id = old.id;
+                      {_trigram_insert_sql('new')}
+                  END""")
+    print("✓ Created trigram index for fuzzy title/author search")
+
+# -------------------- Circulation --------------------
+# Borrow/return as compare-and-set status updates inside BEGIN IMMEDIATE transactions
+AVAILABLE_STATUS = 'Available'
+ON_LOAN_STATUS = 'Checked Out'
+MAX_RETURN_BATCH = 500
+
+@migration(10, 'circulation')
+def migrate_circulation(conn):
+    c = conn.cursor()
+    # At most one open loan per book, whatever the application does
+    c.execute("""CREATE UNIQUE INDEX IF NOT EXISTS idx_borrowings_open_book
+                 ON borrowings(book_id) WHERE returned_date IS NULL""")
+    # Checkouts recorded before this (status only, no loan row) are left as they are;
+    # `flask circulation-check` lists them for staff to check in
+    c.execute('''CREATE TABLE IF NOT EXISTS idempotency_keys
+                 (key TEXT PRIMARY KEY,
+                  status INTEGER NOT NULL,
+                  response TEXT NOT NULL,
+                  created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created ON idempotency_keys(created_date)")
+    print("✓ Created circulation constraints and idempotency_keys table")
+
+def circulation_mismatches(conn):
+    """Books whose status disagrees with their open loan, as (id, title, status, loan id)"""
+    c = conn.cursor()
+    c.execute("""SELECT books.id, books.title, books.status, borrowings.id AS loan_id
+                 FROM books LEFT JOIN borrowings
+                      ON borrowings.book_id = books.id AND borrowings.returned_date IS NULL
+                 WHERE (books.status = ? AND borrowings.id IS NULL)
+                    OR (books.status != ? AND borrowings.id IS NOT NULL)
+                 ORDER BY books.id""", (ON_LOAN_STATUS, ON_LOAN_STATUS))
+    return c.fetchall()
+
+@app.cli.command('circulation-check')
+@click.option('--check-in', 'check_in', type=int, multiple=True,
+              help='Make this checked-out book with no loan on record available (repeatable)')
+def circulation_check_command(check_in):
+    """List books whose status disagrees with the loans table"""
+    migrate_database()
+    conn = get_db()
+    if check_in:
+        c = conn.cursor()
+        open_loan = "SELECT 1 FROM borrowings WHERE book_id = books.id AND returned_date IS NULL"
+        for book_id in check_in:
+            c.execute(f"UPDATE books SET status = ? WHERE id = ? AND status = ? AND NOT EXISTS ({open_loan})",
+                      (AVAILABLE_STATUS, book_id, ON_LOAN_STATUS))
+            if c.rowcount:
+                print(f"✓ Checked in book {book_id}")
+            else:
+                print(f"✗ Book {book_id} is not checked out without a loan; use /api/return for real loans")
+        conn.commit()
+    mismatches = circulation_mismatches(conn)
+    for book in mismatches:
+        if book['loan_id'] is None:
+            print(f"✗ Book {book['id']} ({book['title']}) is {ON_LOAN_STATUS} with no loan on record")
+        else:
+            print(f"✗ Book {book['id']} ({book['title']}) is {book['status']} but loan {book['loan_id']} is open")
+    if mismatches:
+        print(f"{len(mismatches)} book(s) to review; --check-in ID makes a checked-out book available")
+    else:
+        print("✓ Book status matches open loans")
+
+@migration(11, 'fine_accrual')
+def migrate_fine_accrual(conn):
+    c = conn.cursor()
+    # Open loans in id order: the accrual job's watermark walk never touches returned rows
+    c.execute("""CREATE INDEX IF NOT EXISTS idx_borrowings_open_id_due
+                 ON borrowings(id, due_date) WHERE returned_date IS NULL""")
+    c.execute('''CREATE TABLE IF NOT EXISTS job_watermarks
+                 (job TEXT PRIMARY KEY,
+                  run_key TEXT,
+                  last_id INTEGER NOT NULL DEFAULT 0,
+                  rows INTEGER NOT NULL DEFAULT 0,
+                  started_date TIMESTAMP,
+                  updated_date TIMESTAMP,
+                  finished_date TIMESTAMP)''')
+    print("✓ Created job_watermarks table and open-loan index")
+
+@migration(16, 'idempotency_request_hash')
+def migrate_idempotency_request_hash(conn):
+    c = conn.cursor()
+    c.execute("PRAGMA table_info(idempotency_keys)")
+    if 'request_hash' not in {row[1] for row in c.fetchall()}:
+        c.execute("ALTER TABLE idempotency_keys ADD COLUMN request_hash TEXT")
+    print("✓ Added idempotency_keys.request_hash")
+
+def overdue_fine(due_date, returned_on):
+    """Fine owed on returned_on (a date) for a loan due on due_date ('YYYY-MM-DD')
+
+    Same policy as fine_sql(): FINE_PER_DAY after FINE_GRACE_DAYS, capped at
+    FINE_MAX (0 means uncapped).
+    """
+    try:
+        days_late = (returned_on - datetime.strptime(due_date, '%Y-%m-%d').date()).days
+    except (TypeError, ValueError):
+        return 0.0
+    fine = max(days_late - app.config['FINE_GRACE_DAYS'], 0) * app.config['FINE_PER_DAY']
+    if app.config['FINE_MAX'] > 0:
+        fine = min(fine, app.config['FINE_MAX'])
+    return round(fine, 2)
+
+def fine_sql():
+    """overdue_fine() as a SQL expression over due_date; takes (as_of, grace_days, per_day[, cap])"""
+    fine = "MAX(CAST(julianday(?) - julianday(due_date) AS INTEGER) - ?, 0) * ?"
+    if app.config['FINE_MAX'] > 0:
+        fine = f"MIN({fine}, ?)"
+    return f"ROUND({fine}, 2)"
+
+def fine_params(as_of):
+    params = [as_of.isoformat(), app.config['FINE_GRACE_DAYS'], app.config['FINE_PER_DAY']]
+    if app.config['FINE_MAX'] > 0:
+        params.append(app.config['FINE_MAX'])
+    return params
+
+def borrow_book(c, book_id, user_id, today):
+    """Check a book out; the conditional UPDATE is what makes two concurrent checkouts lose cleanly"""
+    c.execute("UPDATE books SET status = ? WHERE id = ? AND status = ?",
+              (ON_LOAN_STATUS, book_id, AVAILABLE_STATUS))
+    if c.rowcount == 0:
+        c.execute("SELECT status FROM books WHERE id = ?", (book_id,))
+        book = c.fetchone()
+        if book is None:
+            return {'error': 'Book not found', 'book_id': book_id}, 404
+        return {'error': f"Book is not available ({book['status']})", 'book_id': book_id,
+                'status': book['status']}, 409
+    due_date = today + timedelta(days=app.config['LOAN_DAYS'])
+    try:
+        c.execute("""INSERT INTO borrowings (user_id, book_id, borrowed_date, due_date)
+                     VALUES (?, ?, ?, ?)""", (user_id, book_id, today.isoformat(), due_date.isoformat()))
+    except sqlite3.IntegrityError:
+        # idx_borrowings_open_book: the book said Available but a loan is still open.
+        # The UPDATE above stands, so the status is back in line with the loan.
+        return {'error': f"Book is not available ({ON_LOAN_STATUS})", 'book_id': book_id,
+                'status': ON_LOAN_STATUS}, 409
+    return {'borrowing_id': c.lastrowid, 'book_id': book_id, 'user_id': user_id,
+            'borrowed_date': today.isoformat(), 'due_date': due_date.isoformat()}, 201
+
+def return_book(c, book_id, today):
+    """Close the open loan on a book, charge any overdue fine and make it available again"""
+    c.execute("SELECT id, user_id, due_date FROM borrowings WHERE book_id = ? AND returned_date IS NULL",
+              (book_id,))
+    loan = c.fetchone()
+    if loan is None:
+        return {'error': 'Book is not checked out', 'book_id': book_id}, 409
+    fine = overdue_fine(loan['due_date'], today)
+    c.execute("UPDATE borrowings SET returned_date = ?, fine_amount = ? WHERE id = ? AND returned_date IS NULL",
+              (today.isoformat(), fine, loan['id']))
+    c.execute("UPDATE books SET status = ? WHERE id = ? AND status = ?",
+              (AVAILABLE_STATUS, book_id, ON_LOAN_STATUS))
+    return {'borrowing_id': loan['id'], 'book_id': book_id, 'user_id': loan['user_id'],
+            'returned_date': today.isoformat(), 'fine_amount': fine}, 200
+
+def circulation_payload():
+    """The JSON object or form a circulation request was sent with; None for any other JSON body"""
+    payload = request.get_json(silent=True)
+    if payload is None:
+        return request.form
+    return payload if isinstance(payload, dict) else None
+
+def circulation_transaction(endpoint, payload, work):
+    """Run work(cursor) -> (body, status) as one unit of the worker's write transaction
+
+    With an Idempotency-Key header (or idempotency_key field) the response is
+    stored in the same transaction, with a hash of the request, and a retried scan
+    gets it back unchanged. Reusing the key for a different request is a 422.
+    """
+    key = request.headers.get('Idempotency-Key') or payload.get('idempotency_key')
+    scoped_key = f"{endpoint}:{session['user_id']}:{key}" if key else None
+    fields = payload.to_dict(flat=False) if hasattr(payload, 'to_dict') else payload
+    request_hash = hashlib.sha256(json.dumps({k: v for k, v in fields.items() if k != 'idempotency_key'},
+                                             sort_keys=True, default=str).encode()).hexdigest()
+    
+    def transaction(c):
+        if scoped_key:
+            c.execute("DELETE FROM idempotency_keys WHERE created_date < datetime('now', ?)",
+                      (f"-{app.config['IDEMPOTENCY_KEY_TTL_HOURS']} hours",))
+            c.execute("SELECT status, response, request_hash FROM idempotency_keys WHERE key = ?", (scoped_key,))
+            stored = c.fetchone()
+            if stored and stored['request_hash'] not in (None, request_hash):
+                return {'error': 'Idempotency-Key was already used for a different request'}, 422, False
+            if stored:
+                return stored['response'], stored['status'], True
+        body, status = work(c)
+        if scoped_key:
+            c.execute("INSERT INTO idempotency_keys (key, status, response, request_hash) VALUES (?, ?, ?, ?)",
+                      (scoped_key, status, json.dumps(body), request_hash))
+        return body, status, False
+    
+    body, status, replayed = run_write(transaction)
+    if replayed:
+        response = Response(body, status=status, mimetype='application/json')
+        response.headers['Idempotent-Replayed'] = 'true'
+        return response
+    expire_catalog_version()
+    return jsonify(body), status
+
+def book_ids_arg(value):
+    """Parse a book id (or list of ids) from JSON or a form; None if malformed"""
+    values = value if isinstance(value, list) else [value]
+    try:
+        ids = [int(v) for v in values]
+    except (TypeError, ValueError):
+        return None
+    return ids if ids and all(i > 0 for i in ids) else None
+
+@app.route('/api/borrow', methods=['POST'])
+def api_borrow():
+    """Check a book out to the logged-in user
+
+    There are no staff accounts yet, so user_id, if sent, must be the caller's own;
+    lending on a patron's behalf waits for a librarian role.
+    """
+    if not login_required():
+        return jsonify({'error': 'Login required'}), 401
+    payload = circulation_payload()
+    if payload is None:
+        return jsonify({'error': 'Request body must be a JSON object or a form'}), 400
+    book_ids = book_ids_arg(payload.get('book_id'))
+    if not book_ids or len(book_ids) != 1:
+        return jsonify({'error': 'book_id is required'}), 400
+    try:
+        user_id = int(payload.get('user_id') or session['user_id'])
+    except (TypeError, ValueError):
+        return jsonify({'error': 'user_id must be an integer'}), 400
+    if user_id != session['user_id']:
+        return jsonify({'error': 'You can only borrow books for yourself'}), 403
+    
+    c = get_db().cursor()
+    c.execute("SELECT id FROM users WHERE id = ?", (user_id,))
+    if not c.fetchone():
+        return jsonify({'error': 'User not found'}), 404
+    
+    today = datetime.now().date()
+    return circulation_transaction('borrow', payload, lambda c: borrow_book(c, book_ids[0], user_id, today))
+
+@app.route('/api/return', methods=['POST'])
+def api_return():
+    """Check in one book (book_id) or a whole returns bin (book_ids) in a single transaction"""
+    if not login_required():
+        return jsonify({'error': 'Login required'}), 401
+    payload = circulation_payload()
+    if payload is None:
+        return jsonify({'error': 'Request body must be a JSON object or a form'}), 400
+    batch = 'book_ids' in payload
+    book_ids = book_ids_arg(payload.get('book_ids') if batch else payload.get('book_id'))
+    if not book_ids:
+        return jsonify({'error': 'book_id or book_ids is required'}), 400
+    if len(book_ids) > MAX_RETURN_BATCH:
+        return jsonify({'error': f'At most {MAX_RETURN_BATCH} books per batch'}), 400
+    
+    today = datetime.now().date()
+    if not batch:
+        return circulation_transaction('return', payload, lambda c: return_book(c, book_ids[0], today))
+    
+    def return_all(c):
+        # Books that were not on loan are reported, not fatal: the rest of the bin still checks in
+        results = []
+        for book_id in dict.fromkeys(book_ids):
+            body, status = return_book(c, book_id, today)
+            results.append(dict(body, ok=status == 200))
+        returned = sum(1 for r in results if r['ok'])
+        fines = round(sum(r.get('fine_amount', 0) for r in results), 2)
+        return {'returned': returned, 'failed': len(results) - returned,
+                'fines_total': fines, 'results': results}, 200
+    return circulation_transaction('return_batch', payload, return_all)
+
+def accrue_fines(conn, as_of, batch_size, restart=False, progress=None):
+    """Bring fine_amount on every overdue open loan up to date as of a date
+
+    Works through open loans in id order, one BEGIN IMMEDIATE transaction per
+    batch_size rows, recording the last id in job_watermarks so an interrupted
+    run for the same date picks up where it stopped. Returns a stats dict.
+    """
+    run_key = f"{as_of.isoformat()}:{app.config['FINE_PER_DAY']}:{app.config['FINE_GRACE_DAYS']}:{app.config['FINE_MAX']}"
+    cutoff = (as_of - timedelta(days=app.config['FINE_GRACE_DAYS'])).isoformat()
+    c = conn.cursor()
+    
+    c.execute("SELECT run_key, last_id, rows, finished_date FROM job_watermarks WHERE job = 'accrue_fines'")
+    state = c.fetchone()
+    if state and state['run_key'] == run_key and not restart:
+        if state['finished_date']:
+            return {'as_of': as_of.isoformat(), 'scanned': 0, 'updated': 0, 'resumed_from': state['last_id'],
+                    'seconds': 0.0, 'rows_per_sec': 0, 'already_done': True}
+        last_id, scanned = state['last_id'], state['rows']
+    else:
+        last_id, scanned = 0, 0
+        c.execute("""INSERT INTO job_watermarks (job, run_key, last_id, rows, started_date, updated_date, finished_date)
+                     VALUES ('accrue_fines', ?, 0, 0, datetime('now'), datetime('now'), NULL)
+                     ON CONFLICT(job) DO UPDATE SET run_key = excluded.run_key, last_id = 0, rows = 0,
+                         started_date = excluded.started_date, updated_date = excluded.updated_date,
+                         finished_date = NULL""", (run_key,))
+        conn.commit()
+    resumed_from, resumed_rows = last_id, scanned
+    
+    fine = fine_sql()
+    updated = 0
+    started = time.perf_counter()
+    while True:
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            c.execute("""SELECT MAX(id) AS hi, COUNT(*) AS n FROM (
+                             SELECT id FROM borrowings
+                             WHERE returned_date IS NULL AND id > ? AND due_date < ?
+                             ORDER BY id LIMIT ?)""", (last_id, cutoff, batch_size))
+            chunk = c.fetchone()
+            if not chunk['n']:
+                c.execute("""UPDATE job_watermarks SET updated_date = datetime('now'), finished_date = datetime('now')
+                             WHERE job = 'accrue_fines'""")
+                conn.commit()
+                break
+            # One set-based UPDATE per id range; unchanged fines are not rewritten
+            c.execute(f"""UPDATE borrowings SET fine_amount = {fine}
+                          WHERE returned_date IS NULL AND id > ? AND id <= ? AND due_date < ?
+                            AND fine_amount IS NOT {fine}""",
+                      fine_params(as_of) + [last_id, chunk['hi'], cutoff] + fine_params(as_of))
+            updated += c.rowcount
+            scanned += chunk['n']
+            last_id = chunk['hi']
+            c.execute("""UPDATE job_watermarks SET last_id = ?, rows = ?, updated_date = datetime('now')
+                         WHERE job = 'accrue_fines'""", (last_id, scanned))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        if progress:
+            progress(scanned, updated, time.perf_counter() - started)
+    
+    seconds = time.perf_counter() - started
+    processed = scanned - resumed_rows
+    return {'as_of': as_of.isoformat(), 'scanned': processed, 'updated': updated, 'resumed_from': resumed_from,
+            'seconds': round(seconds, 3), 'rows_per_sec': int(processed / seconds) if seconds > 0 else 0,
+            'already_done': False}
+
+@app.cli.command('accrue-fines')
+@click.option('--as-of', 'as_of', default=None, help='Accrue as of this date (YYYY-MM-DD, default today)')
+@click.option('--batch-size', type=int, default=None, help='Loans per transaction')
+@click.option('--restart', is_flag=True, help='Ignore the watermark of an interrupted run')
+def accrue_fines_command(as_of, batch_size, restart):
+    """Recompute fines on overdue open loans; run daily from cron"""
+    migrate_database()
+    try:
+        as_of = datetime.strptime(as_of, '%Y-%m-%d').date() if as_of else datetime.now().date()
+    except ValueError:
+        raise click.BadParameter('expected YYYY-MM-DD', param_hint='--as-of')
+    batch_size = batch_size or app.config['FINE_BATCH_SIZE']
+    
+    def progress(scanned, updated, seconds):
+        print(f"  … {scanned} loans scanned, {updated} fines changed ({int(scanned / seconds) if seconds else 0} rows/sec)")
+    
+    stats = accrue_fines(get_db(), as_of, batch_size, restart=restart, progress=progress)
+    if stats['already_done']:
+        print(f"✓ Fines already accrued as of {stats['as_of']} (use --restart to run again)")
+        return
+    resumed = f", resumed after id {stats['resumed_from']}" if stats['resumed_from'] else ''
+    print(f"✓ Accrued fines as of {stats['as_of']}: {stats['scanned']} overdue loans, {stats['updated']} changed "
+          f"in {stats['seconds']}s ({stats['rows_per_sec']} rows/sec{resumed})")
+    app.logger.info("fine accrual %s", json.dumps(stats))
+
+# -------------------- Recommendations --------------------
+# "Readers also borrowed": cosine similarity over the binary reader x book matrix,
+# co-readers(a, b) / sqrt(readers(a) * readers(b)). The pair and reader counts are
+# stored, so new borrowings only add to them and re-rank the books they touch;
+# book_recommendations holds the top RECOMMEND_TOP_K neighbours per book for
+# primary-key reads. Only a reader's first RECOMMEND_MAX_USER_BOOKS distinct books
+# count, which keeps one heavy borrower from costing O(n^2) pairs.
+RECOMMEND_HOME_PICKS = 6
+RECOMMEND_SEED_BOOKS = 10  # a reader's most recent distinct books that home-page picks start from
+
+@migration(13, 'book_recommendations')
+def migrate_book_recommendations(conn):
+    c = conn.cursor()
+    # Per-reader lookups for the incremental job and home-page picks
+    c.execute("CREATE INDEX IF NOT EXISTS idx_borrowings_user_book ON borrowings(user_id, book_id)")
+    c.execute("CREATE TABLE IF NOT EXISTS book_readers (book_id INTEGER PRIMARY KEY, readers INTEGER NOT NULL)")
+    c.execute('''CREATE TABLE IF NOT EXISTS book_cooccurrence
+                 (book_id INTEGER NOT NULL,
+                  other_id INTEGER NOT NULL,
+                  cnt INTEGER NOT NULL,
+                  PRIMARY KEY (book_id, other_id)) WITHOUT ROWID''')
+    c.execute('''CREATE TABLE IF NOT EXISTS book_recommendations
+                 (book_id INTEGER NOT NULL,
+                  rank INTEGER NOT NULL,
+                  recommended_id INTEGER NOT NULL,
+                  score REAL NOT NULL,
+                  PRIMARY KEY (book_id, rank)) WITHOUT ROWID''')
+    print("✓ Created recommendation tables (fill them with `flask recommendations`)")
+
+@migration(17, 'recommendations_book_delete')
+def migrate_recommendations_book_delete(conn):
+    c = conn.cursor()
+    # Counts are symmetric, so the deleted book's own rows name every neighbour to clean up
+    c.execute("""CREATE TRIGGER IF NOT EXISTS books_recommendations_delete AFTER DELETE ON books BEGIN
+                     DELETE FROM book_recommendations WHERE recommended_id = old.id AND book_id IN
+                         (SELECT other_id FROM book_cooccurrence WHERE book_id = old.id);
+                     DELETE FROM book_cooccurrence WHERE other_id = old.id AND book_id IN
+                         (SELECT other_id FROM book_cooccurrence WHERE book_id = old.id);
+                     DELETE FROM book_cooccurrence WHERE book_id = old.id;
+                     DELETE FROM book_recommendations WHERE book_id = old.id;
+                     DELETE FROM book_readers WHERE book_id = old.id;
+                 END""")
+    # Books deleted before the trigger existed
+    c.execute("DELETE FROM book_readers WHERE book_id NOT IN (SELECT id FROM books)")
+    c.execute("""DELETE FROM book_cooccurrence WHERE book_id NOT IN (SELECT id FROM books)
+                                                OR other_id NOT IN (SELECT id FROM books)""")
+    c.execute("""DELETE FROM book_recommendations WHERE book_id NOT IN (SELECT id FROM books)
+                                                   OR recommended_id NOT IN (SELECT id FROM books)""")
+    print("✓ Recommendation counts now follow book deletes")
+
+def recommendation_score(together, readers_a, readers_b):
+    return round(together / math.sqrt(readers_a * readers_b), 6)
+
+def top_neighbours(candidates, k):
+    """Best k (other_id, score) pairs, ties broken by the lower id"""
+    return heapq.nsmallest(k, candidates, key=lambda pair: (-pair[1], pair[0]))
+
+def recommendations_run_key():
+    return f"{app.config['RECOMMEND_TOP_K']}:{app.config['RECOMMEND_MIN_COUNT']}:{app.config['RECOMMEND_MAX_USER_BOOKS']}"
+
+def bump_catalog_version(c):
+    # Cached pages (home-page picks, /similar) are tagged with the catalogue version
+    try:
+        c.execute("UPDATE catalog_version SET version = version + 1, updated_date = CURRENT_TIMESTAMP WHERE id = 1")
+    except sqlite3.OperationalError:
+        pass
+
+def build_recommendations(conn, progress=None):
+    """Recompute every count and neighbour list from borrowings in one pass"""
+    k, min_count = app.config['RECOMMEND_TOP_K'], app.config['RECOMMEND_MIN_COUNT']
+    max_books = app.config['RECOMMEND_MAX_USER_BOOKS']
+    started = time.perf_counter()
+    c = conn.cursor()
+    
+    # Read from one snapshot; borrowings after last_id are left for the next incremental run
+    c.execute("BEGIN")
+    try:
+        c.execute("SELECT COALESCE(MAX(id), 0) AS id FROM borrowings")
+        last_id = c.fetchone()['id']
+        c.execute("""SELECT user_id, book_id, MIN(id) AS first_id FROM borrowings
+                     WHERE id <= ? AND user_id IS NOT NULL AND book_id IN (SELECT id FROM books)
+                     GROUP BY user_id, book_id ORDER BY user_id, first_id""", (last_id,))
+        pairs, readers = Counter(), Counter()
+        for _, group in itertools.groupby(c, key=lambda row: row[0]):
+            books = sorted(row[1] for row in itertools.islice(group, max_books))
+            readers.update(books)
+            pairs.update(itertools.combinations(books, 2))
+    finally:
+        conn.commit()
+    if progress:
+        progress(f"{len(readers)} books, {len(pairs)} co-borrowed pairs")
+    
+    neighbours = {}
+    for (a, b), together in pairs.items():
+        if together >= min_count:
+            score = recommendation_score(together, readers[a], readers[b])
+            neighbours.setdefault(a, []).append((b, score))
+            neighbours.setdefault(b, []).append((a, score))
+    recommendations = [(book_id, rank, other_id, score)
+                       for book_id, candidates in neighbours.items()
+                       for rank, (other_id, score) in enumerate(top_neighbours(candidates, k), 1)]
+    
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        c.execute("DELETE FROM book_readers")
+        c.execute("DELETE FROM book_cooccurrence")
+        c.execute("DELETE FROM book_recommendations")
+        c.executemany("INSERT INTO book_readers (book_id, readers) VALUES (?, ?)", readers.items())
+        c.executemany("INSERT INTO book_cooccurrence (book_id, other_id, cnt) VALUES (?, ?, ?)",
+                      ((a, b, n) for (a, b), n in pairs.items()))
+        c.executemany("INSERT INTO book_cooccurrence (book_id, other_id, cnt) VALUES (?, ?, ?)",
+                      ((b, a, n) for (a, b), n in pairs.items()))
+        c.executemany("""INSERT INTO book_recommendations (book_id, rank, recommended_id, score)
+                         VALUES (?, ?, ?, ?)""", recommendations)
+        c.execute("""INSERT INTO job_watermarks (job, run_key, last_id, rows, started_date, updated_date, finished_date)
+                     VALUES ('recommendations', ?, ?, ?, datetime('now'), datetime('now'), datetime('now'))
+                     ON CONFLICT(job) DO UPDATE SET run_key = excluded.run_key, last_id = excluded.last_id,
+                         rows = excluded.rows, started_date = excluded.started_date,
+                         updated_date = excluded.updated_date, finished_date = excluded.finished_date""",
+                  (recommendations_run_key(), last_id, sum(readers.values())))
+        bump_catalog_version(c)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return {'mode': 'rebuild', 'borrowings': sum(readers.values()), 'pairs': len(pairs),
+            'books_ranked': len(neighbours), 'last_id': last_id, 'seconds': round(time.perf_counter() - started, 3)}
+
+def rerank_books(c, book_ids, k, min_count):
+    """Rewrite the neighbour lists of the given books from the stored counts"""
+    for book_id in book_ids:
+        c.execute("SELECT readers FROM book_readers WHERE book_id = ?", (book_id,))
+        row = c.fetchone()
+        if row is None:
+            # Deleted since its counts were stored; nothing left to rank
+            c.execute("DELETE FROM book_recommendations WHERE book_id = ?", (book_id,))
+            continue
+        readers = row['readers']
+        c.execute("""SELECT co.other_id, co.cnt, r.readers FROM book_cooccurrence co
+                     JOIN book_readers r ON r.book_id = co.other_id
+                     WHERE co.book_id = ? AND co.cnt >= ?""", (book_id, min_count))
+        candidates = [(row[0], recommendation_score(row[1], readers, row[2])) for row in c.fetchall()]
+        c.execute("DELETE FROM book_recommendations WHERE book_id = ?", (book_id,))
+        c.executemany("INSERT INTO book_recommendations (book_id, rank, recommended_id, score) VALUES (?, ?, ?, ?)",
+                      [(book_id, rank, other_id, score)
+                       for rank, (other_id, score) in enumerate(top_neighbours(candidates, k), 1)])
+
+def update_recommendations(conn, batch_size, rebuild=False, progress=None):
+    """Fold borrowings newer than the watermark into the counts and re-rank the books they touch
+
+    Runs build_recommendations() instead on the first run, with rebuild=True, or when
+    the RECOMMEND_* settings changed. A book is re-ranked when one of its own pair
+    counts changes. A neighbour's reader count changing alone does not re-rank it, so
+    scores drift slightly between rebuilds (also the only way deleted loans drop out).
+    """
+    c = conn.cursor()
+    c.execute("SELECT run_key, last_id FROM job_watermarks WHERE job = 'recommendations'")
+    state = c.fetchone()
+    if rebuild or state is None or state['run_key'] != recommendations_run_key():
+        return build_recommendations(conn, progress)
+    
+    k, min_count = app.config['RECOMMEND_TOP_K'], app.config['RECOMMEND_MIN_COUNT']
+    max_books = app.config['RECOMMEND_MAX_USER_BOOKS']
+    last_id, resumed_from = state['last_id'], state['last_id']
+    started = time.perf_counter()
+    scanned = counted = pairs = reranked = 0
+    while True:
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            c.execute("SELECT id, user_id, book_id FROM borrowings WHERE id > ? ORDER BY id LIMIT ?",
+                      (last_id, batch_size))
+            rows = c.fetchall()
+            if not rows:
+                c.execute("""UPDATE job_watermarks SET updated_date = datetime('now'), finished_date = datetime('now')
+                             WHERE job = 'recommendations'""")
+                if reranked:
+                    bump_catalog_version(c)
+                conn.commit()
+                break
+            touched = set()
+            for row in rows:
+                if row['user_id'] is None or row['book_id'] is None:
+                    continue
+                # Loans of deleted books stay in borrowings but no longer count
+                c.execute("SELECT 1 FROM books WHERE id = ?", (row['book_id'],))
+                if c.fetchone() is None:
+                    continue
+                c.execute("""SELECT DISTINCT book_id FROM borrowings
+                             WHERE user_id = ? AND id < ? AND book_id IN (SELECT id FROM books)""",
+                          (row['user_id'], row['id']))
+                earlier = [r[0] for r in c.fetchall()]
+                # A re-borrow adds nothing, and past the cap the reader's books no longer count
+                if row['book_id'] in earlier or len(earlier) >= max_books:
+                    continue
+                c.execute("""INSERT INTO book_readers (book_id, readers) VALUES (?, 1)
+                             ON CONFLICT(book_id) DO UPDATE SET readers = readers + 1""", (row['book_id'],))
+                c.executemany("""INSERT INTO book_cooccurrence (book_id, other_id, cnt) VALUES (?, ?, 1)
+                                 ON CONFLICT(book_id, other_id) DO UPDATE SET cnt = cnt + 1""",
+                              [(row['book_id'], other) for other in earlier] + [(other, row['book_id']) for other in earlier])
+                counted += 1
+                pairs += len(earlier)
+                if earlier:
+                    touched.add(row['book_id'])
+                    touched.update(earlier)
+            rerank_books(c, sorted(touched), k, min_count)
+            reranked += len(touched)
+            scanned += len(rows)
+            last_id = rows[-1]['id']
+            c.execute("""UPDATE job_watermarks SET last_id = ?, rows = rows + ?, updated_date = datetime('now')
+                         WHERE job = 'recommendations'""", (last_id, counted))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        if progress:
+            progress(f"{scanned} borrowings scanned, {reranked} books re-ranked")
+    return {'mode': 'incremental', 'borrowings': scanned, 'counted': counted, 'pairs': pairs,
+            'books_ranked': reranked, 'resumed_from': resumed_from, 'last_id': last_id,
+            'seconds': round(time.perf_counter() - started, 3)}
+
+@app.cli.command('recommendations')
+@click.option('--rebuild', is_flag=True, help='Recompute from all borrowings instead of the new ones')
+@click.option('--batch-size', type=int, default=None, help='Borrowings per transaction')
+def recommendations_command(rebuild, batch_size):
+    """Update "readers also borrowed" lists from new borrowings; run from cron"""
+    migrate_database()
+    stats = update_recommendations(get_db(), batch_size or app.config['RECOMMEND_BATCH_SIZE'], rebuild=rebuild,
+                                   progress=lambda message: print(f"  … {message}"))
+    if stats['mode'] == 'rebuild':
+        print(f"✓ Rebuilt recommendations: {stats['borrowings']} reader/book pairs, {stats['pairs']} co-borrowed "
+              f"pairs, {stats['books_ranked']} books ranked in {stats['seconds']}s")
+    else:
+        print(f"✓ Updated recommendations: {stats['borrowings']} new borrowings after id {stats['resumed_from']}, "
+              f"{stats['books_ranked']} books re-ranked in {stats['seconds']}s")
+    app.logger.info("recommendations %s", json.dumps(stats))
+
+def similar_books(conn, book_id, k, columns=BOOK_CARD_COLUMNS):
+    """Precomputed neighbours of one book, best first"""
+    try:
+        return conn.execute(f"""SELECT {columns}, r.score FROM book_recommendations r
+                                JOIN books ON books.id = r.recommended_id
+                                WHERE r.book_id = ? ORDER BY r.rank LIMIT ?""", (book_id, k)).fetchall()
+    except sqlite3.OperationalError:
+        return []  # not migrated yet
+
+def recommended_for_user(conn, user_id, k, columns=BOOK_CARD_COLUMNS):
+    """Neighbours of the reader's most recent books they have not borrowed, scores summed"""
+    c = conn.cursor()
+    c.execute("""SELECT book_id FROM borrowings WHERE user_id = ? AND book_id IS NOT NULL
+                 GROUP BY book_id ORDER BY MAX(id) DESC LIMIT ?""", (user_id, RECOMMEND_SEED_BOOKS))
+    seeds = [row[0] for row in c.fetchall()]
+    if not seeds:
+        return []
+    try:
+        c.execute(f"""SELECT {columns}, ROUND(SUM(r.score), 6) AS score FROM book_recommendations r
+                      JOIN books ON books.id = r.recommended_id
+                      WHERE r.book_id IN ({','.join('?' * len(seeds))})
+                        AND NOT EXISTS (SELECT 1 FROM borrowings b WHERE b.user_id = ? AND b.book_id = r.recommended_id)
+                      GROUP BY r.recommended_id ORDER BY score DESC, r.recommended_id LIMIT ?""",
+                  seeds + [user_id, k])
+    except sqlite3.OperationalError:
+        return []
+    return c.fetchall()
+
+# -------------------- Circulation Reports --------------------
+# Reports read small daily rollup tables, so staff queries never GROUP BY over
+# borrowings or search_history on the database the web workers use.
+# - Circulation rollups (per day, per genre, per book, overdue aging) are recomputed
+#   chunk_days days at a time, one transaction per chunk. The 'rollup_circulation'
+#   watermark keeps the last final day as a date ordinal in last_id: loans and returns
+#   are written with today's date, so earlier days don't change and each run redoes
+#   only the days since the last one. Backdated rows need `flask rollups backfill --since`.
+# - search_history is append-only, so 'rollup_search' folds rows past an id watermark
+#   into per-day term counts. Pruning runs it first, so no search is deleted uncounted.
+ROLLUP_CIRCULATION_TABLES = ('rollup_circulation_daily', 'rollup_genre_daily', 'rollup_book_daily',
+                             'rollup_overdue_daily')
+OVERDUE_BUCKETS = (('1-7', 7), ('8-14', 14), ('15-30', 30), ('31+', None))  # days overdue at the end of a day
+REPORT_DEFAULT_DAYS = 30
+REPORT_MAX_ROWS = 100
+_rollups_ready = set()
+
+@migration(15, 'circulation_rollups')
+def migrate_circulation_rollups(conn):
+    c = conn.cursor()
+    # Day-range reads for the rollup job
+    c.execute("CREATE INDEX IF NOT EXISTS idx_borrowings_borrowed_date ON borrowings(borrowed_date)")
+    c.execute("""CREATE INDEX IF NOT EXISTS idx_borrowings_returned_date
+                 ON borrowings(returned_date) WHERE returned_date IS NOT NULL""")
+    c.execute('''CREATE TABLE IF NOT EXISTS rollup_circulation_daily
+                 (day TEXT PRIMARY KEY,
+                  checkouts INTEGER NOT NULL,
+                  returns INTEGER NOT NULL,
+                  borrowers INTEGER NOT NULL,
+                  fines REAL NOT NULL)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS rollup_genre_daily
+                 (day TEXT NOT NULL,
+                  genre TEXT NOT NULL,
+                  checkouts INTEGER NOT NULL,
+                  returns INTEGER NOT NULL,
+                  PRIMARY KEY (day, genre)) WITHOUT ROWID''')
+    c.execute('''CREATE TABLE IF NOT EXISTS rollup_book_daily
+                 (day TEXT NOT NULL,
+                  book_id INTEGER NOT NULL,
+                  checkouts INTEGER NOT NULL,
+                  returns INTEGER NOT NULL,
+                  PRIMARY KEY (day, book_id)) WITHOUT ROWID''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_rollup_book_daily_book ON rollup_book_daily(book_id, day)")
+    c.execute('''CREATE TABLE IF NOT EXISTS rollup_overdue_daily
+                 (day TEXT NOT NULL,
+                  bucket TEXT NOT NULL,
+                  loans INTEGER NOT NULL,
+                  PRIMARY KEY (day, bucket)) WITHOUT ROWID''')
+    c.execute('''CREATE TABLE IF NOT EXISTS rollup_search_daily
+                 (day TEXT NOT NULL,
+                  search_by TEXT NOT NULL,
+                  search_term TEXT NOT NULL,
+                  searches INTEGER NOT NULL,
+                  PRIMARY KEY (day, search_by, search_term)) WITHOUT ROWID''')
+    print("✓ Created report rollup tables (fill them with `flask rollups backfill`)")
+
+def rollups_enabled(conn):
+    """True once migration 15 has created the rollup tables"""
+    db_path = app.config['DATABASE']
+    if db_path not in _rollups_ready:
+        c = conn.cursor()
+        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='rollup_search_daily'")
+        if c.fetchone() is not None:
+            _rollups_ready.add(db_path)
+    return db_path in _rollups_ready
+
+def rollup_run_key():
+    # Changing the aging buckets invalidates every stored overdue row
+    return ','.join(label for label, _ in OVERDUE_BUCKETS)
+
+def overdue_bucket_sql(days_late):
+    cases = ' '.join(f"WHEN {days_late} <= {limit} THEN '{label}'" for label, limit in OVERDUE_BUCKETS if limit)
+    return f"CASE {cases} ELSE '{OVERDUE_BUCKETS[-1][0]}' END"
+
+# Checkouts and returns in [?, ?) by day; substr() keeps any time-of-day suffix out of the day
+ROLLUP_EVENTS_SQL = """SELECT substr(borrowed_date, 1, 10) AS day, book_id, user_id,
+                              1 AS checkouts, 0 AS returns, 0 AS fines
+                       FROM borrowings WHERE borrowed_date >= ? AND borrowed_date < ?
+                       UNION ALL
+                       SELECT substr(returned_date, 1, 10), book_id, NULL, 0, 1, IFNULL(fine_amount, 0)
+                       FROM borrowings WHERE returned_date >= ? AND returned_date < ?"""
+
+# Loans that can be overdue on some day in [first, last]: due before last and still out after first.
+# The unary + keeps the planner on the small open-loan index instead of a borrowed_date range.
+ROLLUP_LOANS_SQL = """SELECT substr(borrowed_date, 1, 10) AS borrowed, substr(due_date, 1, 10) AS due,
+                             NULL AS returned
+                      FROM borrowings WHERE returned_date IS NULL AND due_date < ? AND +borrowed_date < ?
+                      UNION ALL
+                      SELECT substr(borrowed_date, 1, 10), substr(due_date, 1, 10), substr(returned_date, 1, 10)
+                      FROM borrowings WHERE returned_date > ? AND due_date < ? AND borrowed_date < ?"""
+
+def rollup_circulation_days(c, first, last):
+    """Recompute every circulation rollup for the days first..last inside the caller's transaction"""
+    lo, hi = first.isoformat(), (last + timedelta(days=1)).isoformat()
+    for table in ROLLUP_CIRCULATION_TABLES:
+        c.execute(f"DELETE FROM {table} WHERE day >= ? AND day < ?", (lo, hi))
+    c.execute("DROP TABLE IF EXISTS temp.rollup_events")
+    c.execute(f"CREATE TEMP TABLE rollup_events AS {ROLLUP_EVENTS_SQL}", (lo, hi, lo, hi))
+    c.execute("""INSERT INTO rollup_circulation_daily (day, checkouts, returns, borrowers, fines)
+                 SELECT day, SUM(checkouts), SUM(returns), COUNT(DISTINCT user_id), ROUND(SUM(fines), 2)
+                 FROM temp.rollup_events GROUP BY day""")
+    c.execute("""INSERT INTO rollup_genre_daily (day, genre, checkouts, returns)
+                 SELECT e.day, IFNULL(b.genre, ''), SUM(e.checkouts), SUM(e.returns)
+                 FROM temp.rollup_events e LEFT JOIN books b ON b.id = e.book_id
+                 GROUP BY e.day, IFNULL(b.genre, '')""")
+    c.execute("""INSERT INTO rollup_book_daily (day, book_id, checkouts, returns)
+                 SELECT day, book_id, SUM(checkouts), SUM(returns)
+                 FROM temp.rollup_events WHERE book_id IS NOT NULL GROUP BY day, book_id""")
+    c.execute("DROP TABLE temp.rollup_events")
+    
+    # Aging is a snapshot at the end of each day: borrowed by then, due before it, not yet back
+    c.execute("DROP TABLE IF EXISTS temp.rollup_loans")
+    c.execute(f"CREATE TEMP TABLE rollup_loans AS {ROLLUP_LOANS_SQL}", (last.isoformat(), hi, lo, last.isoformat(), hi))
+    days_late = "CAST(julianday(d.day) - julianday(l.due) AS INTEGER)"
+    c.execute(f"""INSERT INTO rollup_overdue_daily (day, bucket, loans)
+                  WITH RECURSIVE days(day) AS (
+                      SELECT ? UNION ALL SELECT date(day, '+1 day') FROM days WHERE day < ?)
+                  SELECT d.day, {overdue_bucket_sql(days_late)}, COUNT(*)
+                  FROM days d JOIN temp.rollup_loans l
+                    ON l.due < d.day AND l.borrowed <= d.day AND (l.returned IS NULL OR l.returned > d.day)
+                  GROUP BY 1, 2""", (lo, last.isoformat()))
+    c.execute("DROP TABLE temp.rollup_loans")
+
+def first_loan_day(c):
+    c.execute("SELECT MIN(borrowed_date) FROM borrowings")
+    first = c.fetchone()[0]
+    try:
+        return datetime.strptime(first[:10], '%Y-%m-%d').date()
+    except (TypeError, ValueError):
+        return None
+
+def update_circulation_rollups(conn, today, chunk_days, since=None, rebuild=False, max_chunks=None,
+                               pause=0.0, progress=None):
+    """Recompute circulation rollups from the day after the watermark (or since) through today
+
+    One BEGIN IMMEDIATE transaction per chunk_days days, moving the watermark each
+    time, so an interrupted or --max-chunks run carries on from the next chunk.
+    Without a watermark (or with rebuild) it starts at the first loan. Returns a stats dict.
+    """
+    c = conn.cursor()
+    c.execute("SELECT run_key, last_id FROM job_watermarks WHERE job = 'rollup_circulation'")
+    state = c.fetchone()
+    if rebuild or (state is not None and state['run_key'] != rollup_run_key()):
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            for table in ROLLUP_CIRCULATION_TABLES:
+                c.execute(f"DELETE FROM {table}")
+            c.execute("DELETE FROM job_watermarks WHERE job = 'rollup_circulation'")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        state = None
+    if since is not None:
+        first = since
+    elif state is not None:
+        first = date.fromordinal(state['last_id'] + 1)
+    else:
+        first = first_loan_day(c) or today
+    first = min(first, today)
+    
+    stats = {'first_day': first.isoformat(), 'last_day': None, 'days': 0, 'chunks': 0, 'complete': False}
+    started = time.perf_counter()
+    while first <= today:
+        if max_chunks is not None and stats['chunks'] >= max_chunks:
+            break
+        last = min(first + timedelta(days=chunk_days - 1), today)
+        # Today is still being written to, so the watermark stops at yesterday
+        final = min(last, today - timedelta(days=1))
+        days = (last - first).days + 1
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            rollup_circulation_days(c, first, last)
+            c.execute("""INSERT INTO job_watermarks (job, run_key, last_id, rows, started_date, updated_date)
+                         VALUES ('rollup_circulation', ?, ?, ?, datetime('now'), datetime('now'))
+                         ON CONFLICT(job) DO UPDATE SET run_key = excluded.run_key, last_id = excluded.last_id,
+                             rows = rows + excluded.rows, updated_date = excluded.updated_date,
+                             finished_date = NULL""", (rollup_run_key(), final.toordinal(), days))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        stats['days'] += days
+        stats['chunks'] += 1
+        stats['last_day'] = last.isoformat()
+        if progress:
+            progress(f"circulation rolled up through {last.isoformat()} ({stats['days']} days)")
+        first = last + timedelta(days=1)
+        if pause and first <= today:
+            time.sleep(pause)
+    if first > today:
+        c.execute("""UPDATE job_watermarks SET finished_date = datetime('now')
+                     WHERE job = 'rollup_circulation'""")
+        conn.commit()
+        stats['complete'] = True
+    stats['seconds'] = round(time.perf_counter() - started, 3)
+    return stats
+
+def update_search_rollups(conn, batch_size, rebuild=False, progress=None):
+    """Fold search_history rows past the 'rollup_search' watermark into rollup_search_daily
+
+    The watermark is re-read inside each batch's transaction, so pruning and the
+    cron job can both run this without counting a row twice. Rows already pruned
+    survive only in the undated search_history_rollup, so a rebuild can't recount them.
+    """
+    c = conn.cursor()
+    if rebuild:
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            c.execute("DELETE FROM rollup_search_daily")
+            c.execute("DELETE FROM job_watermarks WHERE job = 'rollup_search'")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    stats = {'searches': 0, 'batches': 0, 'last_id': 0}
+    started = time.perf_counter()
+    while True:
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            c.execute("SELECT last_id FROM job_watermarks WHERE job = 'rollup_search'")
+            state = c.fetchone()
+            last_id = state['last_id'] if state else 0
+            c.execute("""SELECT MAX(id) AS hi, COUNT(*) AS n FROM (
+                             SELECT id FROM search_history WHERE id > ? ORDER BY id LIMIT ?)""",
+                      (last_id, batch_size))
+            chunk = c.fetchone()
+            if not chunk['n']:
+                c.execute("""UPDATE job_watermarks SET updated_date = datetime('now'), finished_date = datetime('now')
+                             WHERE job = 'rollup_search'""")
+                conn.commit()
+                stats['last_id'] = last_id
+                break
+            c.execute("""INSERT INTO rollup_search_daily (day, search_by, search_term, searches)
+                         SELECT substr(search_date, 1, 10), IFNULL(search_by, ''), lower(trim(search_term)), COUNT(*)
+                         FROM search_history
+                         WHERE id > ? AND id <= ? AND trim(IFNULL(search_term, '')) != ''
+                         GROUP BY 1, 2, 3
+                         ON CONFLICT (day, search_by, search_term) DO UPDATE SET
+                             searches = searches + excluded.searches""", (last_id, chunk['hi']))
+            c.execute("""INSERT INTO job_watermarks (job, run_key, last_id, rows, started_date, updated_date)
+                         VALUES ('rollup_search', NULL, ?, ?, datetime('now'), datetime('now'))
+                         ON CONFLICT(job) DO UPDATE SET last_id = excluded.last_id, rows = rows + excluded.rows,
+                             updated_date = excluded.updated_date, finished_date = NULL""",
+                      (chunk['hi'], chunk['n']))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        stats['searches'] += chunk['n']
+        stats['batches'] += 1
+        if progress:
+            progress(f"{stats['searches']} searches rolled up")
+    stats['seconds'] = round(time.perf_counter() - started, 3)
+    return stats
+
+@app.cli.group('rollups')
+def rollups_cli():
+    """Daily report rollups over borrowings and search history"""
+
+def print_rollup_stats(circulation, searches):
+    if circulation['chunks']:
+        print(f"✓ Rolled up circulation for {circulation['first_day']}..{circulation['last_day']} "
+              f"({circulation['days']} days in {circulation['chunks']} chunks, {circulation['seconds']}s)")
+    if not circulation['complete']:
+        print("  … stopped before today; `flask rollups update` carries on from here")
+    print(f"✓ Rolled up {searches['searches']} searches (through search_history id {searches['last_id']}, "
+          f"{searches['seconds']}s)")
+    app.logger.info("rollups %s", json.dumps({'circulation': circulation, 'searches': searches}))
+
+@rollups_cli.command('update')
+@click.option('--chunk-days', type=int, default=None, help='Days per transaction')
+def rollups_update_command(chunk_days):
+    """Fold new loans, returns and searches into the rollups; run from cron"""
+    migrate_database()
+    conn = get_db()
+    progress = lambda message: print(f"  … {message}")
+    circulation = update_circulation_rollups(conn, datetime.now().date(),
+                                             chunk_days or app.config['ROLLUP_CHUNK_DAYS'], progress=progress)
+    searches = update_search_rollups(conn, app.config['ROLLUP_BATCH_SIZE'], progress=progress)
+    print_rollup_stats(circulation, searches)
+
+@rollups_cli.command('backfill')
+@click.option('--since', default=None, help='First day to recompute (YYYY-MM-DD, default the first loan)')
+@click.option('--rebuild', is_flag=True, help='Clear the rollups first, including the search counts')
+@click.option('--chunk-days', type=int, default=None, help='Days per transaction')
+@click.option('--max-chunks', type=int, default=None, help='Stop after this many chunks')
+@click.option('--pause-ms', type=int, default=0, help='Sleep between chunks so web writes get the lock')
+def rollups_backfill_command(since, rebuild, chunk_days, max_chunks, pause_ms):
+    """Recompute the rollups over historical loans and searches in bounded chunks"""
+    migrate_database()
+    try:
+        since = datetime.strptime(since, '%Y-%m-%d').date() if since else None
+    except ValueError:
+        raise click.BadParameter('expected YYYY-MM-DD', param_hint='--since')
+    conn = get_db()
+    progress = lambda message: print(f"  … {message}")
+    circulation = update_circulation_rollups(conn, datetime.now().date(),
+                                             chunk_days or app.config['ROLLUP_CHUNK_DAYS'],
+                                             since=since or first_loan_day(conn.cursor()), rebuild=rebuild,
+                                             max_chunks=max_chunks, pause=pause_ms / 1000.0, progress=progress)
+    searches = update_search_rollups(conn, app.config['ROLLUP_BATCH_SIZE'], rebuild=rebuild, progress=progress)
+    print_rollup_stats(circulation, searches)
+
+def report_range():
+    """(first, last) days from ?from=&to= (YYYY-MM-DD, default the last REPORT_DEFAULT_DAYS); ValueError if invalid"""
+    def day_arg(name):
+        value = request.args.get(name)
+        if not value:
+            return None
+        try:
+            return datetime.strptime(value, '%Y-%m-%d').date()
+        except ValueError:
+            raise ValueError(f"Invalid '{name}' date: {value} (expected YYYY-MM-DD)")
+    last = day_arg('to') or datetime.now().date()
+    first = day_arg('from') or last - timedelta(days=REPORT_DEFAULT_DAYS - 1)
+    if first > last:
+        raise ValueError("'from' is after 'to'")
+    if (last - first).days >= app.config['REPORT_MAX_DAYS']:
+        raise ValueError(f"At most {app.config['REPORT_MAX_DAYS']} days per report")
+    return first, last
+
+def rollup_freshness(c):
+    """How current the rollups are, reported with every response"""
+    c.execute("""SELECT job, last_id, updated_date FROM job_watermarks
+                 WHERE job IN ('rollup_circulation', 'rollup_search')""")
+    jobs = {row['job']: row for row in c.fetchall()}
+    circulation, searches = jobs.get('rollup_circulation'), jobs.get('rollup_search')
+    return {'circulation_final_through': date.fromordinal(circulation['last_id']).isoformat() if circulation else None,
+            'circulation_updated': circulation['updated_date'] if circulation else None,
+            'searches_updated': searches['updated_date'] if searches else None}
+
+def report_limit():
+    return min(max(request.args.get('limit', 20, type=int), 1), REPORT_MAX_ROWS)
+
+def report_response(c, first, last, **body):
+    return jsonify({'from': first.isoformat(), 'to': last.isoformat(), **body, 'rollup': rollup_freshness(c)})
+
+@app.route('/api/reports/circulation')
+def report_circulation():
+    """Checkouts, returns, distinct borrowers and fines charged per day (days with activity only)"""
+    if not login_required():
+        return jsonify({'error': 'Login required'}), 401
+    try:
+        first, last = report_range()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    c = get_db().cursor()
+    c.execute("""SELECT day, checkouts, returns, borrowers, fines FROM rollup_circulation_daily
+                 WHERE day BETWEEN ? AND ? ORDER BY day""", (first.isoformat(), last.isoformat()))
+    days = [dict(row) for row in c.fetchall()]
+    totals = {'checkouts': sum(d['checkouts'] for d in days), 'returns': sum(d['returns'] for d in days),
+              'fines': round(sum(d['fines'] for d in days), 2)}
+    return report_response(c, first, last, days=days, totals=totals)
+
+@app.route('/api/reports/genres')
+def report_genres():
+    """Checkouts and returns per genre over the range, busiest first"""
+    if not login_required():
+        return jsonify({'error': 'Login required'}), 401
+    try:
+        first, last = report_range()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    c = get_db().cursor()
+    c.execute("""SELECT genre, SUM(checkouts) AS checkouts, SUM(returns) AS returns FROM rollup_genre_daily
+                 WHERE day BETWEEN ? AND ? GROUP BY genre ORDER BY checkouts DESC, genre""",
+              (first.isoformat(), last.isoformat()))
+    genres = [dict(row, genre=row['genre'] or None) for row in c.fetchall()]
+    return report_response(c, first, last, genres=genres)
+
+@app.route('/api/reports/books')
+def report_books():
+    """Most borrowed books over the range (?limit=, at most REPORT_MAX_ROWS)"""
+    if not login_required():
+        return jsonify({'error': 'Login required'}), 401
+    try:
+        first, last = report_range()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    c = get_db().cursor()
+    c.execute("""SELECT r.book_id, books.title, books.author, r.checkouts, r.returns FROM (
+                     SELECT book_id, SUM(checkouts) AS checkouts, SUM(returns) AS returns FROM rollup_book_daily
+                     WHERE day BETWEEN ? AND ? GROUP BY book_id
+                     ORDER BY checkouts DESC, book_id LIMIT ?) r
+                 LEFT JOIN books ON books.id = r.book_id
+                 ORDER BY r.checkouts DESC, r.book_id""", (first.isoformat(), last.isoformat(), report_limit()))
+    return report_response(c, first, last, books=[dict(row) for row in c.fetchall()])
+
+@app.route('/api/reports/books/<int:book_id>')
+def report_book(book_id):
+    """One book's checkouts and returns per day (days with activity only)"""
+    if not login_required():
+        return jsonify({'error': 'Login required'}), 401
+    try:
+        first, last = report_range()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    c = get_db().cursor()
+    c.execute("""SELECT day, checkouts, returns FROM rollup_book_daily
+                 WHERE book_id = ? AND day BETWEEN ? AND ? ORDER BY day""",
+              (book_id, first.isoformat(), last.isoformat()))
+    days = [dict(row) for row in c.fetchall()]
+    totals = {'checkouts': sum(d['checkouts'] for d in days), 'returns': sum(d['returns'] for d in days)}
+    return report_response(c, first, last, book_id=book_id, days=days, totals=totals)
+
+@app.route('/api/reports/overdue')
+def report_overdue():
+    """Loans overdue at the end of each day, by how many days late"""
+    if not login_required():
+        return jsonify({'error': 'Login required'}), 401
+    try:
+        first, last = report_range()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    c = get_db().cursor()
+    c.execute("""SELECT day, bucket, loans FROM rollup_overdue_daily
+                 WHERE day BETWEEN ? AND ? ORDER BY day""", (first.isoformat(), last.isoformat()))
+    labels = [label for label, _ in OVERDUE_BUCKETS]
+    days = {}
+    for row in c.fetchall():
+        day = days.setdefault(row['day'], {'day': row['day'], 'total': 0, 'buckets': dict.fromkeys(labels, 0)})
+        day['buckets'][row['bucket']] = row['loans']
+        day['total'] += row['loans']
+    return report_response(c, first, last, buckets=labels, days=list(days.values()))
+
+@app.route('/api/reports/searches')
+def report_searches():
+    """Top search terms per search_by over the range (?search_by= for one, ?limit= per list)"""
+    if not login_required():
+        return jsonify({'error': 'Login required'}), 401
+    try:
+        first, last = report_range()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    search_by = request.args.get('search_by')
+    c = get_db().cursor()
+    c.execute("""SELECT search_by, search_term, searches FROM (
+                     SELECT search_by, search_term, searches,
+                            ROW_NUMBER() OVER (PARTITION BY search_by
+                                               ORDER BY searches DESC, search_term) AS rn
+                     FROM (SELECT search_by, search_term, SUM(searches) AS searches FROM rollup_search_daily
+                           WHERE day BETWEEN ? AND ? AND (? IS NULL OR search_by = ?)
+                           GROUP BY search_by, search_term))
+                 WHERE rn <= ? ORDER BY search_by, rn""",
+              (first.isoformat(), last.isoformat(), search_by, search_by, report_limit()))
+    terms = {}
+    for row in c.fetchall():
+        terms.setdefault(row['search_by'] or None, []).append({'term': row['search_term'],
+                                                                'searches': row['searches']})
+    return report_response(c, first, last, searches=terms)
+
+# -------------------- Bulk Import --------------------
+IMPORT_FORMATS = ('csv', 'jsonl', 'marc')
+IMPORT_EXTENSIONS = {'.csv': 'csv', '.jsonl': 'jsonl', '.ndjson': 'jsonl', '.mrk': 'marc', '.marc': 'marc'}
+IMPORT_FIELDS = ('title', 'author', 'isbn', 'published_year', 'genre', 'status', 'description', 'cover')
+IMPORT_ALIASES = {'year': 'published_year'}
+BOOK_STATUSES = ('Available', 'Checked Out', 'Reserved', 'Lost')
+ISBN13 = 8  # position of isbn13 in normalize_import_row()'s tuple
+# MARC-lite: "TAG value" lines (MarcEdit's "=245  10$a..." also works), blank line between records
+MARC_TAGS = {'020': 'isbn', '100': 'author', '245': 'title', '260': 'published_year',
+             '264': 'published_year', '520': 'description', '650': 'genre'}
+# Per-row insert triggers a CLI import drops and replaces with set-based work at the end.
+# Only safe while nothing else writes books: an edit in the window reaches the FTS and
+# trigram update triggers for rows they never indexed, so web uploads keep them.
+DEFERRED_BOOK_TRIGGERS = ('books_fts_insert', 'books_stats_insert', 'books_changes_insert', 'books_trigrams_insert',
+                          'books_version_insert')
+
+
+class ImportInProgress(RuntimeError):
+    pass
+
+
+def normalize_isbn(value):
+    """ISBN-13 for an ISBN-10 or ISBN-13 in any punctuation, None if blank; ValueError if invalid"""
+    raw = re.sub(r'[\s-]', '', str(value or '')).upper()
+    if not raw:
+        return None
+    if re.fullmatch(r'\d{9}[\dX]', raw):
+        if sum((10 - i) * (10 if ch == 'X' else int(ch)) for i, ch in enumerate(raw)) % 11:
+            raise ValueError(f"bad ISBN-10 check digit: {value}")
+        raw = '978' + raw[:9]
+        return raw + str(-sum(int(ch) * (3 if i % 2 else 1) for i, ch in enumerate(raw)) % 10)
+    if re.fullmatch(r'\d{13}', raw):
+        if sum(int(ch) * (3 if i % 2 else 1) for i, ch in enumerate(raw)) % 10:
+            raise ValueError(f"bad ISBN-13 check digit: {value}")
+        return raw
+    raise ValueError(f"not an ISBN: {value}")
+
+def normalize_import_row(record):
+    """Validate one parsed record into an INSERT tuple; raises ValueError with the reason
+
+    The ISBN goes in as given (like add/edit book) and normalize_isbn() of it last, for isbn13.
+    """
+    if not isinstance(record, dict):
+        raise ValueError('record is not an object')
+    row = {}
+    for key, value in record.items():
+        if key is None or value is None or value == '':
+            continue
+        name = str(key).strip().lower()
+        name = IMPORT_ALIASES.get(name, name)
+        if name in IMPORT_FIELDS:
+            row[name] = str(value).strip() if name == 'description' else ' '.join(str(value).split())
+    if not row.get('title') or not row.get('author'):
+        raise ValueError('title and author are required')
+    
+    year = row.get('published_year')
+    if year is not None:
+        if not re.fullmatch(r'-?\d{1,4}', year):
+            raise ValueError(f"bad published_year: {year}")
+        year = int(year)
+    statuses = {s.lower(): s for s in BOOK_STATUSES}
+    status = statuses.get(row.get('status', 'Available').lower())
+    if status is None:
+        raise ValueError(f"unknown status: {row['status']}")
+    return (row['title'], row['author'], row.get('isbn'), year, row.get('genre'),
+            status, row.get('description'), row.get('cover') or 'default.jpg', normalize_isbn(row.get('isbn')))
+
+def parse_csv_records(stream):
+    reader = csv.DictReader(stream)
+    for record in reader:
+        yield reader.line_num, record, None
+
+def parse_jsonl_records(stream):
+    for line_no, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            yield line_no, json.loads(line), None
+        except ValueError as e:
+            yield line_no, line.rstrip('\n'), f"bad JSON: {e}"
+
+def parse_marc_records(stream):
+    record, start = {}, None
+    for line_no, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            if record:
+                yield start, record, None
+            record, start = {}, None
+            continue
+        match = re.match(r'=?(\d{3})\s+(.*)', line)
+        if not match:
+            yield line_no, line, 'unrecognised MARC-lite line'
+            continue
+        tag, value = match.groups()
+        field = MARC_TAGS.get(tag)
+        if field is None or field in record:
+            continue
+        subfield = re.search(r'\$a([^$]*)', value)
+        value = (subfield.group(1) if subfield else value).strip(' /:;,')
+        if field == 'published_year':
+            year = re.search(r'\d{4}', value)
+            value = year.group(0) if year else value
+        start = start or line_no
+        record[field] = value
+    if record:
+        yield start, record, None
+
+IMPORT_PARSERS = {'csv': parse_csv_records, 'jsonl': parse_jsonl_records, 'marc': parse_marc_records}
+
+def defer_book_triggers(conn):
+    """Drop the per-row insert triggers and record what to restore; returns the first id to backfill from"""
+    c = conn.cursor()
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        c.execute("SELECT finished_date FROM job_watermarks WHERE job = 'import_books'")
+        state = c.fetchone()
+        if state and not state['finished_date']:
+            raise ImportInProgress("another import is running (or crashed: run 'flask import-books --recover')")
+        c.execute(f"""SELECT name, sql FROM sqlite_master WHERE type = 'trigger'
+                      AND name IN ({', '.join('?' * len(DEFERRED_BOOK_TRIGGERS))})""", DEFERRED_BOOK_TRIGGERS)
+        triggers = {row['name']: row['sql'] for row in c.fetchall()}
+        for name in triggers:
+            c.execute(f"DROP TRIGGER {name}")
+        c.execute("SELECT COALESCE(MAX(id), 0) AS id FROM books")
+        start_id = c.fetchone()['id']
+        c.execute("""INSERT INTO job_watermarks (job, run_key, last_id, rows, started_date, updated_date, finished_date)
+                     VALUES ('import_books', ?, ?, 0, datetime('now'), datetime('now'), NULL)
+                     ON CONFLICT(job) DO UPDATE SET run_key = excluded.run_key, last_id = excluded.last_id,
+                         rows = 0, started_date = excluded.started_date, updated_date = excluded.updated_date,
+                         finished_date = NULL""", (json.dumps(triggers), start_id))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return start_id
+
+def restore_book_triggers(conn):
+    """Backfill FTS, trigrams, stats and the change log for rows added since the import began,
+    then recreate the dropped triggers. Returns False if no import was pending."""
+    c = conn.cursor()
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        c.execute("SELECT run_key, last_id, finished_date FROM job_watermarks WHERE job = 'import_books'")
+        state = c.fetchone()
+        if not state or state['finished_date']:
+            conn.commit()
+            return False
+        triggers, start_id = json.loads(state['run_key']), state['last_id']
+        
+        if 'books_fts_insert' in triggers:
+            cols = ', '.join(FTS_COLUMNS)
+            c.execute(f"INSERT INTO books_fts(rowid, {cols}) SELECT id, {cols} FROM books WHERE id > ?", (start_id,))
+        if 'books_trigrams_insert' in triggers:
+            # Count the new postings in one GROUP BY instead of one upsert per trigram row
+            c.execute("SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = 'book_trigrams_count_insert'")
+            count_trigger = c.fetchone()
+            if count_trigger:
+                c.execute("DROP TRIGGER book_trigrams_count_insert")
+            for field, tag in FUZZY_FIELDS.items():
+                c.execute(f"""INSERT OR IGNORE INTO book_trigrams (field, trigram, book_id)
+                              SELECT '{tag}', substr(' ' || lower(books.{field}) || ' ', n, 3), books.id
+                              FROM books JOIN trigram_positions ON n <= length(books.{field})
+                              WHERE books.id > ?""", (start_id,))
+            c.execute("""INSERT INTO trigram_counts (field, trigram, cnt)
+                         SELECT field, trigram, COUNT(*) FROM book_trigrams WHERE book_id > ? GROUP BY field, trigram
+                         ON CONFLICT(field, trigram) DO UPDATE SET cnt = cnt + excluded.cnt""", (start_id,))
+            if count_trigger:
+                c.execute(count_trigger['sql'])
+        if 'books_changes_insert' in triggers:
+            # All-NULL marker: suggestion indexes rebuild instead of replaying every row
+            c.execute("INSERT INTO book_changes DEFAULT VALUES")
+        if 'books_version_insert' in triggers:
+            c.execute("UPDATE catalog_version SET version = version + 1, updated_date = CURRENT_TIMESTAMP WHERE id = 1")
+        for sql in triggers.values():
+            c.execute(sql)
+        c.execute("""UPDATE job_watermarks SET updated_date = datetime('now'), finished_date = datetime('now')
+                     WHERE job = 'import_books'""")
+        if 'books_stats_insert' in triggers:
+            rebuild_catalog_stats(conn)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return True
+
+def insert_import_batch(c, batch):
+    """INSERT one batch of (line_no, row, record), skipping ISBNs already in the catalogue
+
+    Returns (inserted, conflicts, skipped): conflicts are rows the unique indexes
+    turned away, skipped the batch entries whose ISBN was already there.
+    """
+    isbns = [row[ISBN13] for _, row, _ in batch if row[ISBN13]]
+    existing = set()
+    if isbns:
+        c.execute("SELECT isbn13 FROM books WHERE isbn13 IN (SELECT value FROM json_each(?))", (json.dumps(isbns),))
+        existing = {r['isbn13'] for r in c.fetchall()}
+    rows, skipped = [], []
+    for line_no, row, record in batch:
+        if row[ISBN13] in existing:
+            skipped.append((line_no, row, record))
+        else:
+            rows.append(row)
+    c.executemany("""INSERT INTO books (title, author, isbn, published_year, genre, status, description, cover, created_date, isbn13)
+                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, datetime('now'), ?)
+                     ON CONFLICT DO NOTHING""", rows)
+    return c.rowcount, len(rows) - c.rowcount, skipped
+
+def import_books(records, errors_out=None, progress=None, defer_triggers=True):
+    """Bulk-load (line_no, record, parse_error) tuples into books
+
+    ISBNs are stored as given, normalised to ISBN-13 into isbn13 and deduplicated
+    on that against the file and the catalogue. Rejected rows are written to errors_out as CSV (line, error, record).
+    With defer_triggers (CLI only, see DEFERRED_BOOK_TRIGGERS) rows go in through
+    executemany, IMPORT_BATCH_SIZE at a time, committing every IMPORT_COMMIT_ROWS on
+    a connection with synchronous=OFF, and the per-row insert triggers are swapped
+    for a backfill at the end. Web uploads instead send each IMPORT_UPLOAD_BATCH_SIZE
+    batch through the writer queue, so other requests' writes go in between batches
+    rather than waiting behind the whole file. Returns a stats dict.
+    """
+    conn = None
+    if defer_triggers:
+        conn = connect_db()
+        conn.execute("PRAGMA synchronous=OFF")
+        conn.execute("PRAGMA temp_store=MEMORY")
+    batch_size = app.config['IMPORT_BATCH_SIZE' if defer_triggers else 'IMPORT_UPLOAD_BATCH_SIZE']
+    errors = csv.writer(errors_out) if errors_out is not None else None
+    if errors:
+        errors.writerow(['line', 'error', 'record'])
+    stats = {'read': 0, 'inserted': 0, 'rejected': 0, 'duplicates': 0}
+    seen = {}
+    batch = []
+    started = time.perf_counter()
+    
+    def reject(line_no, reason, record):
+        stats['rejected'] += 1
+        if errors:
+            errors.writerow([line_no, reason, record if isinstance(record, str) else json.dumps(record, default=str)])
+    
+    def flush():
+        rows = list(batch)
+        batch.clear()
+        if defer_triggers:
+            inserted, conflicts, skipped = insert_import_batch(conn.cursor(), rows)
+        else:
+            inserted, conflicts, skipped = run_write(lambda c: insert_import_batch(c, rows))
+        stats['inserted'] += inserted
+        stats['duplicates'] += conflicts + len(skipped)
+        for line_no, row, record in skipped:
+            reject(line_no, f"ISBN {row[ISBN13]} is already in the catalogue", record)
+    
+    try:
+        start_id = defer_book_triggers(conn) if defer_triggers else None
+        try:
+            pending = 0
+            for line_no, record, error in records:
+                stats['read'] += 1
+                if error:
+                    reject(line_no, error, record)
+                    continue
+                try:
+                    row = normalize_import_row(record)
+                except ValueError as e:
+                    reject(line_no, str(e), record)
+                    continue
+                isbn = row[ISBN13]
+                if isbn:
+                    if isbn in seen:
+                        stats['duplicates'] += 1
+                        reject(line_no, f"duplicate ISBN {isbn} (first on line {seen[isbn]})", record)
+                        continue
+                    seen[isbn] = line_no
+                batch.append((line_no, row, record))
+                if len(batch) >= batch_size:
+                    pending += len(batch)
+                    flush()
+                    if defer_triggers and pending >= app.config['IMPORT_COMMIT_ROWS']:
+                        conn.commit()
+                        pending = 0
+                    if progress:
+                        progress(stats, time.perf_counter() - started)
+            if batch:
+                flush()
+        finally:
+            if defer_triggers:
+                if conn.in_transaction:
+                    conn.commit()
+                loaded = time.perf_counter()
+                restore_book_triggers(conn)
+    finally:
+        if conn is not None:
+            conn.close()
+    
+    if defer_triggers:
+        stats['start_id'] = start_id
+        stats['backfill_seconds'] = round(time.perf_counter() - loaded, 3)
+    stats['seconds'] = round(time.perf_counter() - started, 3)
+    stats['rows_per_sec'] = int(stats['read'] / stats['seconds']) if stats['seconds'] else 0
+    return stats
+
+def import_format_for(filename, default=None):
+    name = (filename or '').lower()
+    if name.endswith('.gz'):
+        name = name[:-3]
+    return IMPORT_EXTENSIONS.get(os.path.splitext(name)[1], default)
+
+@app.route('/api/import_books', methods=['POST'])
+def api_import_books():
+    """Stream a CSV / JSON Lines / MARC-lite catalogue into books (raw body or a 'file' upload)"""
+    if not login_required():
+        return jsonify({'error': 'Login required'}), 401
+    upload = request.files.get('file')
+    fmt = request.args.get('format') or import_format_for(upload.filename if upload else None, 'csv')
+    if fmt not in IMPORT_FORMATS:
+        return jsonify({'error': f"format must be one of {', '.join(IMPORT_FORMATS)}"}), 400
+    
+    # Parsed as it arrives; the body is never held in memory whole
+    raw = upload.stream if upload else io.BufferedReader(request.stream)
+    stream = io.TextIOWrapper(raw, encoding='utf-8-sig', newline='' if fmt == 'csv' else None)
+    
+    os.makedirs(app.config['IMPORT_DIR'], exist_ok=True)
+    # The uploader's id leads the name so /imports/<name> can check who is asking
+    errors_name = f"import-{session['user_id']}-{datetime.now().strftime('%Y%m%d-%H%M%S')}-{os.urandom(4).hex()}.errors.csv"
+    errors_path = os.path.join(app.config['IMPORT_DIR'], errors_name)
+    try:
+        with open(errors_path, 'w', newline='', encoding='utf-8') as errors_out:
+            stats = import_books(IMPORT_PARSERS[fmt](stream), errors_out, defer_triggers=False)
+        catalog_changed(get_db())
+    except UnicodeDecodeError:
+        os.remove(errors_path)
+        return jsonify({'error': 'Upload must be UTF-8 text'}), 400
+    
+    app.logger.info("import of %s rows via upload: %s", stats['read'], json.dumps(stats))
+    if stats['rejected']:
+        stats['errors_url'] = url_for('import_errors', name=errors_name)
+    else:
+        os.remove(errors_path)
+    return jsonify(stats)
+
+@app.route('/imports/<name>')
+def import_errors(name):
+    """Per-row error file from one of the current user's uploads"""
+    if not login_required():
+        return jsonify({'error': 'Login required'}), 401
+    if not name.startswith(f"import-{session['user_id']}-"):
+        return jsonify({'error': 'Page not found'}), 404
+    return send_from_directory(app.config['IMPORT_DIR'], name, mimetype='text/csv', as_attachment=True)
+
+@app.cli.command('import-books')
+@click.argument('path', required=False, type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(IMPORT_FORMATS), default=None,
+              help='Input format (default: from the file extension)')
+@click.option('--errors', 'errors_path', default=None, help='Per-row error CSV (default: PATH.errors.csv)')
+@click.option('--recover', is_flag=True, help='Finish an import that crashed: backfill indexes and restore triggers')
+def import_books_command(path, fmt, errors_path, recover):
+    """Bulk-load books from CSV, JSON Lines or MARC-lite (optionally .gz)"""
+    migrate_database()
+    if recover:
+        conn = connect_db()
+        try:
+            done = restore_book_triggers(conn)
+        finally:
+            conn.close()
+        print("✓ Restored triggers and backfilled indexes" if done else "✓ No interrupted import to recover")
+        return
+    if not path:
+        raise click.UsageError('PATH is required unless --recover is given')
+    fmt = fmt or import_format_for(path)
+    if fmt is None:
+        raise click.UsageError('cannot tell the format from the extension; pass --format')
+    errors_path = errors_path or f"{path}.errors.csv"
+    
+    def progress(stats, seconds):
+        print(f"  … {stats['read']} read, {stats['inserted']} inserted, {stats['rejected']} rejected "
+              f"({int(stats['read'] / seconds) if seconds else 0} rows/sec)")
+    
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8-sig', newline='' if fmt == 'csv' else None) as stream, \
+            open(errors_path, 'w', newline='', encoding='utf-8') as errors_out:
+        try:
+            stats = import_books(IMPORT_PARSERS[fmt](stream), errors_out, progress)
+        except ImportInProgress as e:
+            raise click.ClickException(str(e))
+    
+    print(f"✓ Imported {stats['inserted']} of {stats['read']} records in {stats['seconds']}s "
+          f"({stats['rows_per_sec']} rows/sec, {stats['backfill_seconds']}s of it rebuilding indexes), "
+          f"{stats['rejected']} rejected")
+    if stats['rejected']:
+        print(f"✗ Rejected rows written to {errors_path}")
+    else:
+        os.remove(errors_path)
+
+# -------------------- ISBN Lookup --------------------
+# books.isbn keeps the ISBN as it was entered; books.isbn13 holds normalize_isbn() of it,
+# set by every write path and uniquely indexed, so scans, searches and duplicate checks
+# match whatever the punctuation or ISBN-10/13 form.
+ISBN_LOOKUP_MAX = 500
+ISBN_TERM = re.compile(r'[\dXx][\dXx\s-]{8,20}')
+_isbn13_ready = set()
+
+@migration(14, 'isbn13')
+def migrate_isbn13(conn):
+    c = conn.cursor()
+    c.execute("PRAGMA table_info(books)")
+    if 'isbn13' not in {row[1] for row in c.fetchall()}:
+        c.execute("ALTER TABLE books ADD COLUMN isbn13 TEXT")
+    c.execute("SELECT isbn13 FROM books WHERE isbn13 IS NOT NULL")
+    seen = {row[0] for row in c.fetchall()}
+    c.execute("SELECT id, isbn FROM books WHERE isbn IS NOT NULL AND isbn13 IS NULL ORDER BY id")
+    updates, invalid, duplicates = [], [], []
+    for book_id, isbn in c.fetchall():
+        try:
+            isbn13 = normalize_isbn(isbn)
+        except ValueError:
+            invalid.append(book_id)
+            continue
+        if isbn13 in seen:
+            # Same book entered twice in different forms; the older row keeps the ISBN
+            duplicates.append(book_id)
+            continue
+        seen.add(isbn13)
+        updates.append((isbn13, book_id))
+    c.executemany("UPDATE books SET isbn13 = ? WHERE id = ?", updates)
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_books_isbn13 ON books(isbn13)")
+    print(f"✓ Normalised {len(updates)} ISBNs into books.isbn13")
+    if invalid:
+        print(f"✗ {len(invalid)} books have an invalid ISBN, left without isbn13 (ids {', '.join(map(str, invalid[:20]))})")
+    if duplicates:
+        print(f"✗ {len(duplicates)} books repeat an earlier book's ISBN, left without isbn13 (ids {', '.join(map(str, duplicates[:20]))})")
+
+def isbn13_enabled(conn):
+    """True once migration 14 has added books.isbn13"""
+    db_path = app.config['DATABASE']
+    if db_path not in _isbn13_ready:
+        c = conn.cursor()
+        c.execute("PRAGMA table_info(books)")
+        if 'isbn13' in {row[1] for row in c.fetchall()}:
+            _isbn13_ready.add(db_path)
+    return db_path in _isbn13_ready
+
+def isbn_search_term(term):
+    """ISBN-13 of a search term that is a valid ISBN, else None (search falls back to text matching)"""
+    if not ISBN_TERM.fullmatch(term):
+        return None
+    try:
+        return normalize_isbn(term)
+    except ValueError:
+        return None
+
+@app.route('/api/isbn/lookup', methods=['GET', 'POST'])
+def isbn_lookup():
+    """Resolve a batch of scanned ISBN/EAN codes (?codes=a,b or JSON/form "codes") in one query"""
+    if not login_required():
+        return jsonify({'error': 'Login required'}), 401
+    if request.method == 'POST':
+        payload = request.get_json(silent=True)
+        codes = payload.get('codes') if isinstance(payload, dict) else request.form.getlist('codes')
+    else:
+        codes = [code for value in request.args.getlist('codes') for code in value.split(',')]
+    if not isinstance(codes, list) or not codes:
+        return jsonify({'error': 'codes is required'}), 400
+    if len(codes) > ISBN_LOOKUP_MAX:
+        return jsonify({'error': f'At most {ISBN_LOOKUP_MAX} codes per lookup'}), 400
+    
+    results = []
+    for code in codes:
+        result = {'code': code}
+        try:
+            isbn13 = normalize_isbn(code)
+        except (TypeError, ValueError) as e:
+            result['error'] = str(e)
+        else:
+            if isbn13:
+                result['isbn13'] = isbn13
+            else:
+                result['error'] = 'empty code'
+        results.append(result)
+    wanted = sorted({r['isbn13'] for r in results if r.get('isbn13')})
+    books = {}
+    if wanted:
+        c = get_db().cursor()
+        c.execute(f"SELECT {BOOK_LIST_COLUMNS}, isbn13 FROM books WHERE isbn13 IN (SELECT value FROM json_each(?))",
+                  (json.dumps(wanted),))
+        books = {row['isbn13']: book_dict(row) for row in c.fetchall()}
+    for result in results:
+        if 'error' not in result:
+            result['book'] = books.get(result['isbn13'])
+    found = sum(1 for r in results if r.get('book'))
+    invalid = sum(1 for r in results if 'error' in r)
+    return jsonify({'results': results, 'found': found, 'missing': len(results) - found - invalid,
+                    'invalid': invalid})
+
+# -------------------- Cover Thumbnails --------------------
+COVER_DIR = os.path.join(app.root_path, 'static', 'covers')
+THUMBNAIL_WIDTHS = (160, 320, 480)
+DEFAULT_THUMBNAIL_WIDTH = 320
+# format -> (Pillow encoder, mimetype, encoder options)
+THUMBNAIL_FORMATS = {
+    'webp': ('WEBP', 'image/webp', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', 'image/jpeg', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+_cover_digests = {}
+
+def cover_source_path(cover):
+    """Resolve a books.cover value to a file under static/covers, or None"""
+    if not cover:
+        return None
+    name = cover.split('covers/')[-1]
+    path = os.path.normpath(os.path.join(COVER_DIR, name))
+    if not path.startswith(COVER_DIR + os.sep) or not os.path.isfile(path):
+        return None
+    return path
+
+def cover_digest(path):
+    """Content hash of a cover file, re-read only when its mtime or size changes"""
+    st = os.stat(path)
+    cached = _cover_digests.get(path)
+    if cached and cached[0] == (st.st_mtime_ns, st.st_size):
+        return cached[1]
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    digest = sha.hexdigest()[:16]
+    _cover_digests[path] = ((st.st_mtime_ns, st.st_size), digest)
+    return digest
+
+def render_thumbnail(path, digest, width, fmt):
+    """Path of the cached thumbnail for (digest, width, fmt), encoding it on first use"""
+    encoder, _, options = THUMBNAIL_FORMATS[fmt]
+    thumb_dir = app.config['THUMBNAIL_DIR']
+    out = os.path.join(thumb_dir, f"{digest}-{width}.{fmt}")
+    if os.path.exists(out):
+        return out
+
+    # Pillow is imported on first use so workers that never resize don't load it
+    from PIL import Image, ImageOps
+
+    os.makedirs(thumb_dir, exist_ok=True)
+    with Image.open(path) as img:
+        img.draft('RGB', (width, width * 3))  # JPEG sources decode at a reduced scale
+        img = ImageOps.exif_transpose(img)
+        if img.mode in ('RGBA', 'LA', 'P'):
+            # Flatten transparency onto white; JPEG has no alpha channel
+            img = img.convert('RGBA')
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            background.paste(img, mask=img.getchannel('A'))
+            img = background
+        elif img.mode != 'RGB':
+            img = img.convert('RGB')
+        img.thumbnail((width, width * 3), Image.LANCZOS)  # keeps aspect ratio, never upscales
+        # Write then rename so concurrent requests never serve a half-written file
+        tmp = f"{out}.{os.getpid()}.{threading.get_ident()}.tmp"
+        img.save(tmp, encoder, **options)
+    os.replace(tmp, out)
+    return out
+
+def generate_cover_thumbnails(cover):
+    """Encode every width/format for one cover; returns the number of files written"""
+    path = cover_source_path(cover)
+    if not path:
+        return 0
+    digest = cover_digest(path)
+    written = 0
+    for width in THUMBNAIL_WIDTHS:
+        for fmt in THUMBNAIL_FORMATS:
+            if not os.path.exists(os.path.join(app.config['THUMBNAIL_DIR'], f"{digest}-{width}.{fmt}")):
+                render_thumbnail(path, digest, width, fmt)
+                written += 1
+    return written
+
+def warm_cover_thumbnails(cover):
+    """Pre-generate a cover's thumbnails off the request path"""
+    def run():
+        try:
+            generate_cover_thumbnails(cover)
+        except Exception as e:
+            app.logger.warning("Thumbnail generation failed for %s: %s", cover, e)
+    threading.Thread(target=run, daemon=True).start()
+
+@app.template_global()
+def cover_url(cover, width=DEFAULT_THUMBNAIL_WIDTH):
+    """Versioned thumbnail URL for a cover, or the original file when it can't be thumbnailed"""
+    if cover and cover.startswith(('http://', 'https://')):
+        return cover
+    path = cover_source_path(cover)
+    if not path:
+        cover = cover or 'default.jpg'
+        return url_for('static', filename=cover if 'covers/' in cover else 'covers/' + cover)
+    return url_for('cover_thumbnail', width=width, cover=os.path.basename(path), v=cover_digest(path))
+
+@app.template_global()
+def cover_srcset(cover):
+    if not cover_source_path(cover):
+        return ''
+    return ', '.join(f"{cover_url(cover, width)} {width}w" for width in THUMBNAIL_WIDTHS)
+
+@app.route('/covers/<int:width>/<path:cover>')
+def cover_thumbnail(width, cover):
+    """Resized cover, WebP when the browser accepts it, JPEG otherwise"""
+    if width not in THUMBNAIL_WIDTHS:
+        return jsonify({'error': 'Unsupported thumbnail width'}), 404
+    path = cover_source_path(cover)
+    if not path:
+        return jsonify({'error': 'Cover not found'}), 404
+
+    # Only an explicit image/webp counts; accept_mimetypes[...] is also truthy for */* and image/*
+    fmt = 'webp' if any(m == 'image/webp' for m, _ in request.accept_mimetypes) else 'jpeg'
+    digest = cover_digest(path)
+    etag = f"{digest}-{width}-{fmt}"
+    # URLs carrying the current content hash never change, so caches may keep them forever
+    versioned = request.args.get('v') == digest
+    max_age = IMMUTABLE_MAX_AGE if versioned else 3600
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+    else:
+        response = send_file(render_thumbnail(path, digest, width, fmt),
+                             mimetype=THUMBNAIL_FORMATS[fmt][1], etag=etag, conditional=True,
+                             max_age=max_age)
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    if versioned:
+        response.cache_control.immutable = True
+    response.vary.add('Accept')
+    return response
+
+@app.cli.command('thumbnails')
+def thumbnails_command():
+    """Pre-generate thumbnails for static/covers and every cover referenced by books"""
+    covers = set(os.listdir(COVER_DIR)) if os.path.isdir(COVER_DIR) else set()
+    c = get_db().cursor()
+    c.execute("SELECT DISTINCT cover FROM books WHERE cover IS NOT NULL")
+    covers.update(row['cover'] for row in c.fetchall())
+
+    started = time.perf_counter()
+    written = 0
+    for cover in sorted(covers):
+        written += generate_cover_thumbnails(cover)
+    print(f"✓ Wrote {written} thumbnails for {len(covers)} covers in {time.perf_counter() - started:.1f}s")
+
+# -------------------- Index Advisor --------------------
+def route_queries():
+    """Representative statements per route as (label, sql, params, scan_expected)"""
+    queries = [
+        ('index.popular', "SELECT id, title, cover FROM book_borrow_counts p JOIN books ON books.id = p.book_id ORDER BY p.cnt DESC, p.book_id ASC LIMIT ?", [6], False),
+        ('sample_books.probe', "SELECT id, title, cover FROM books WHERE id >= ? ORDER BY id LIMIT 1", [1], False),
+        ('sample_books.genre_probe', "SELECT id, title, cover FROM books WHERE genre = ? AND id >= ? ORDER BY id LIMIT 1", ['Fantasy', 1], False),
+        ('edit_book/get_book_details', "SELECT * FROM books WHERE id=?", [1], False),
+        ('search_stats', "SELECT total, available, genres, authors, (SELECT MIN(published_year) FROM year_counts) AS min_year, (SELECT MAX(published_year) FROM year_counts) AS max_year FROM catalog_stats WHERE id = 1", [], False),
+        ('get_search_history', "SELECT search_term, search_by, search_date FROM search_history WHERE user_id = ? ORDER BY search_date DESC LIMIT ?", [1, 5], False),
+        ('circulation.open_loan', "SELECT id, user_id, due_date FROM borrowings WHERE book_id = ? AND returned_date IS NULL", [1], False),
+        ('card_stats.borrowed', "SELECT COUNT(*) as cnt FROM borrowings WHERE user_id=? AND returned_date IS NULL", [1], False),
+        ('card_stats.fines', "SELECT SUM(fine_amount) as total_fines FROM borrowings WHERE user_id=? AND fine_amount > 0", [1], False),
+        ('library_card', "SELECT * FROM library_cards WHERE user_id=?", [1], False),
+        ('login', "SELECT * FROM users WHERE username=? AND password=?", ['', ''], False),
+        ('rollups.events', ROLLUP_EVENTS_SQL, ['2024-01-01', '2024-02-01'] * 2, False),
+        ('rollups.overdue_loans', ROLLUP_LOANS_SQL, ['2024-01-31', '2024-02-01', '2024-01-01', '2024-01-31', '2024-02-01'], False),
+        ('reports.book', "SELECT day, checkouts, returns FROM rollup_book_daily WHERE book_id = ? AND day BETWEEN ? AND ? ORDER BY day", [1, '2024-01-01', '2024-01-31'], False),
+    ]
+
+    # id_desc reads the rowid b-tree backwards and stops at LIMIT, which EXPLAIN reports as "SCAN books"
+    book_queries = [(f'books_query.sort={sort_by}', BookQuery(sort_by=sort_by, limit=50), sort_by == 'id_desc')
+                    for sort_by in SORT_ORDERS if sort_by != 'relevance']
+    book_queries += [
+        ('search.status', BookQuery(status=['Available'], limit=50), False),
+        ('search.year_range', BookQuery(year_from=1990, year_to=2000, sort_by='year', limit=50), False),
+        ('search.year', BookQuery(search_term='1949', search_by='year', limit=50), False),
+        ('search.title', BookQuery(search_term='lord', search_by='title', sort_by='relevance', limit=50), False),
+        ('quick_search.fiction', BookQuery(genre_terms=['Fiction', 'Novel'], limit=20), False),
+    ]
+    for label, query, scan_expected in book_queries:
+        # LIKE fallbacks (no FTS5) can only scan
+        scan_expected = scan_expected or query.term_mode in ('like', 'like_all') or \
+            (query.genre_terms and not query.use_fts)
+        queries.append((label, query.sql(), query.params(), scan_expected))
+    return queries
+
+def explain_route_queries():
+    """Run EXPLAIN QUERY PLAN over route_queries(); returns one report dict per query"""
+    c = get_db().cursor()
+    report = []
+    for label, sql, params, scan_expected in route_queries():
+        c.execute("EXPLAIN QUERY PLAN " + sql, params)
+        plan = [row['detail'] for row in c.fetchall()]
+        # "SCAN books" is a full table scan; "SCAN books USING INDEX ..." walks an index in order
+        full_scans = [step for step in plan
+                      if step.startswith('SCAN ') and ' USING ' not in step and 'VIRTUAL TABLE' not in step]
+        report.append({
+            'label': label,
+            'plan': plan,
+            'full_scans': full_scans,
+            'temp_sort': any('TEMP B-TREE' in step for step in plan),
+            'scan_expected': scan_expected,
+        })
+    return report
+
+def print_index_report(report):
+    """Print the advisor report; returns the number of unexpected full scans"""
+    flagged = 0
+    for entry in report:
+        if entry['full_scans'] and not entry['scan_expected']:
+            flagged += 1
+            status = '✗ FULL SCAN'
+        elif entry['full_scans']:
+            status = '~ scan (expected)'
+        else:
+            status = '✓'
+        note = ' (temp b-tree sort)' if entry['temp_sort'] else ''
+        print(f"{status:<18} {entry['label']}{note}")
+        for step in entry['plan']:
+            print(f"{'':<18}   {step}")
+    print(f"{flagged} unexpected full scan(s)")
+    return flagged
+
+@app.cli.command('check-indexes')
+def check_indexes_command():
+    """Flag route queries whose plans fall back to full table scans"""
+    migrate_database()
+    if print_index_report(explain_route_queries()):
+        raise SystemExit(1)
+
+# -------------------- HTTP Caching --------------------
+# Read pages and JSON APIs are tagged with a catalogue version that triggers bump on
+# every books write. Workers cache the number for CATALOG_VERSION_TTL_MS, so most
+# conditional requests are answered with 304 before the view or the database runs.
+_catalog_version = (None, None, 0.0)   # (version, last modified, monotonic time read)
+_response_cache = OrderedDict()
+_response_cache_lock = threading.Lock()
+_response_cache_stats = {'hits': 0, 'misses': 0, 'not_modified': 0}
+
+@migration(12, 'catalog_version')
+def migrate_catalog_version(conn):
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS catalog_version
+                 (id INTEGER PRIMARY KEY CHECK (id = 1),
+                  version INTEGER NOT NULL,
+                  updated_date TIMESTAMP NOT NULL)''')
+    c.execute("INSERT OR IGNORE INTO catalog_version (id, version, updated_date) VALUES (1, 1, CURRENT_TIMESTAMP)")
+    bump = "UPDATE catalog_version SET version = version + 1, updated_date = CURRENT_TIMESTAMP WHERE id = 1;"
+    c.execute(f"CREATE TRIGGER IF NOT EXISTS books_version_insert AFTER INSERT ON books BEGIN {bump} END")
+    c.execute(f"CREATE TRIGGER IF NOT EXISTS books_version_delete AFTER DELETE ON books BEGIN {bump} END")
+    c.execute(f"CREATE TRIGGER IF NOT EXISTS books_version_update AFTER UPDATE ON books BEGIN {bump} END")
+    print("✓ Created catalog_version counter")
+
+def catalog_version():
+    """(version, last_modified) of the catalogue, re-read at most every CATALOG_VERSION_TTL_MS
+
+    Returns (None, None) before migration 12, which turns conditional handling off.
+    """
+    global _catalog_version
+    version, modified, read_at = _catalog_version
+    if version is None or time.monotonic() - read_at > app.config['CATALOG_VERSION_TTL_MS'] / 1000.0:
         try:
-            # First add the column without default
-            c.execute("ALTER TABLE books ADD COLUMN created_date TIMESTAMP")
-            print("✓ Added created_date column to books table")
-            
-            # Then update existing rows with current timestamp
-            c.execute("UPDATE books SET created_date = datetime('now') WHERE created_date IS NULL")
-            print("✓ Updated existing rows with current timestamp")
-        except Exception as e:
-            print(f"✗ Error adding created_date column: {e}")
-    
-    conn.commit()
-    
-    # Check and create search_history table if needed
-    c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='search_history'")
-    if not c.fetchone():
-        c.execute('''CREATE TABLE search_history
-                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                      user_id INTEGER,
-                      search_term TEXT,
-                      search_by TEXT,
-                      search_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                      FOREIGN KEY(user_id) REFERENCES users(id))''')
-        print("✓ Created search_history table")
-    
-    conn.commit()
-    conn.close()
+            c = get_db().cursor()
+            c.execute("SELECT version, updated_date FROM catalog_version WHERE id = 1")
+            row = c.fetchone()
+        except sqlite3.OperationalError:
+            row = None
+        if row is None:
+            return None, None
+        version = row['version']
+        modified = datetime.strptime(row['updated_date'], '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+        _catalog_version = (version, modified, time.monotonic())
+    return version, modified
+
+def expire_catalog_version():
+    """Make this worker re-read the version after its own write"""
+    global _catalog_version
+    _catalog_version = (None, None, 0.0)
+
+def catalog_changed(conn):
+    """Post-commit hook for routes that write books"""
+    expire_catalog_version()
+    refresh_suggestions(conn)
+
+def catalog_cached(per_user=False):
+    """Tag GET responses with the catalogue version and answer If-None-Match /
+    If-Modified-Since with 304; with RESPONSE_CACHE_SIZE > 0, rendered bodies are
+    also kept in-process, keyed by (route, view args, query args, version[, user])."""
+    def decorate(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            # Pending flash messages make the page one-off
+            if request.method != 'GET' or session.get('_flashes'):
+                return view(*args, **kwargs)
+            version, modified = catalog_version()
+            if version is None:
+                return view(*args, **kwargs)
+            etag = f"cat{version}-u{session.get('user_id', 0)}" if per_user else f"cat{version}"
+            if request.if_none_match:
+                unchanged = request.if_none_match.contains(etag)
+            else:
+                unchanged = request.if_modified_since is not None and modified <= request.if_modified_since
+            if unchanged:
+                with _response_cache_lock:
+                    _response_cache_stats['not_modified'] += 1
+                response = Response(status=304)
+            else:
+                key = (request.endpoint, tuple(sorted(kwargs.items())), tuple(sorted(request.args.items(multi=True))), etag)
+                with _response_cache_lock:
+                    cached = _response_cache.get(key)
+                    if cached is not None:
+                        _response_cache.move_to_end(key)
+                        _response_cache_stats['hits'] += 1
+                if cached is not None:
+                    response = Response(cached[0], mimetype=cached[1])
+                else:
+                    response = app.make_response(view(*args, **kwargs))
+                    if response.status_code != 200 or session.get('_flashes'):
+                        return response
+                    limit = app.config['RESPONSE_CACHE_SIZE']
+                    body = response.get_data() if limit > 0 and not response.is_streamed else None
+                    with _response_cache_lock:
+                        _response_cache_stats['misses'] += 1
+                        if body is not None:
+                            _response_cache[key] = (body, response.mimetype)
+                            while len(_response_cache) > limit:
+                                _response_cache.popitem(last=False)
+            response.set_etag(etag)
+            response.last_modified = modified
+            response.cache_control.no_cache = True
+            if per_user:
+                response.cache_control.private = True
+            return response
+        return wrapper
+    return decorate
+
+def response_cache_snapshot():
+    with _response_cache_lock:
+        return dict(_response_cache_stats, size=len(_response_cache),
+                    version=_catalog_version[0])
 
 # -------------------- Routes --------------------
 @app.route('/')
+@catalog_cached(per_user=True)
 def index():
     conn = get_db()
-    c = conn.cursor()
-    c.execute("SELECT * FROM books ORDER BY RANDOM() LIMIT 6")
-    rows = c.fetchall()
+    popular = most_borrowed_books(conn, 6, columns='id, title, cover')
+    picks = []
+    if 'user_id' in session:
+        picks = recommended_for_user(conn, session['user_id'], RECOMMEND_HOME_PICKS, columns='id, title, cover')
     
     # Convert to list of dictionaries and ensure cover field exists
-    popular_books = []
-    for row in rows:
-        book = dict(row)
-        # Ensure cover field exists, use default if not
-        if not book.get('cover') or book['cover'] is None:
-            cover_num = random.randint(1, 6)
-            book['cover'] = f'book{cover_num}.jpg'
-        popular_books.append(book)
-    
-    conn.close()
-    return render_template('index.html', popular_books=popular_books)
+    popular_books, recommended_books = [], []
+    for rows, books in ((popular, popular_books), (picks, recommended_books)):
+        for row in rows:
+            book = dict(row)
+            # Ensure cover field exists, use default if not
+            if not book.get('cover') or book['cover'] is None:
+                cover_num = random.randint(1, 6)
+                book['cover'] = f'book{cover_num}.jpg'
+            books.append(book)
+    
+    return render_template('index.html', popular_books=popular_books, recommended_books=recommended_books)
 
 @app.route('/books')
+@catalog_cached(per_user=True)
 def books():
     conn = get_db()
     c = conn.cursor()
-    c.execute("SELECT * FROM books ORDER BY id DESC")
-    rows = c.fetchall()
-    conn.close()
-    return render_template('books.html', books=rows)
+    cursor = request.args.get('cursor')
+    limit = page_size_arg(request.args.get('limit'))
+    rows, next_cursor = BookQuery(sort_by='id_desc', limit=limit, cursor=cursor).fetch_page(c)
+    return render_template('books.html', books=rows, next_cursor=next_cursor,
+                           is_first_page=not cursor, limit=limit)
+
+@app.route('/api/books')
+def api_books():
+    """Keyset-paginated book listing: ?sort=&limit=&cursor="""
+    sort_by = request.args.get('sort', 'id_desc')
+    if sort_by not in SORT_ORDERS or sort_by == 'relevance':
+        return jsonify({'error': 'Invalid sort'}), 400
+    limit = page_size_arg(request.args.get('limit'))
+
+    conn = get_db()
+    c = conn.cursor()
+    query = BookQuery(sort_by=sort_by, columns=BOOK_CARD_COLUMNS, limit=limit,
+                      cursor=request.args.get('cursor'))
+    rows, next_cursor = query.fetch_page(c)
+    return jsonify({'books': [book_dict(row) for row in rows], 'next_cursor': next_cursor, 'limit': limit})
 
 @app.route('/add_book', methods=['GET', 'POST'])
 def add_book():
@@ -234,19 +3999,21 @@ def add_book():
         # Cover field is optional, default will be used if not provided
         cover = request.form.get('cover', '').strip() or 'default.jpg'
 
-        conn = get_db()
-        c = conn.cursor()
         try:
-            c.execute("""INSERT INTO books (title, author, isbn, published_year, genre, description, cover, created_date)
-                         VALUES (?, ?, ?, ?, ?, ?, ?, datetime('now'))""",
-                      (title, author, isbn, published_year, genre, description, cover))
-            conn.commit()
+            isbn13 = normalize_isbn(isbn)
+        except ValueError as e:
+            flash(f"Invalid ISBN: {e}", "danger")
+            return render_template('add_book.html')
+        try:
+            run_write(lambda c: c.execute("""INSERT INTO books (title, author, isbn, isbn13, published_year, genre, description, cover, created_date)
+                                             VALUES (?, ?, ?, ?, ?, ?, ?, ?, datetime('now'))""",
+                                          (title, author, isbn, isbn13, published_year, genre, description, cover)))
+            warm_cover_thumbnails(cover)
+            catalog_changed(get_db())
             flash("Book added successfully!", "success")
             return redirect(url_for('books'))
         except sqlite3.IntegrityError:
             flash("ISBN already exists.", "danger")
-        finally:
-            conn.close()
 
     return render_template('add_book.html')
 
@@ -264,44 +4031,78 @@ def edit_book(book_id):
         isbn = request.form.get('isbn', '').strip() or None
         published_year = request.form.get('published_year') or None
         genre = request.form.get('genre', '').strip()
-        status = request.form.get('status', 'Available')
+        status = request.form.get('status', AVAILABLE_STATUS)
         description = request.form.get('description', '').strip()
         cover = request.form.get('cover', '').strip() or 'default.jpg'
 
-        try:
+        def update(c):
+            # 'Checked Out' belongs to circulation: a book on loan keeps it, and no edit sets it.
+            # A checkout recorded before loans were tracked may stay as it is.
+            c.execute("SELECT 1 FROM borrowings WHERE book_id = ? AND returned_date IS NULL", (book_id,))
+            on_loan = c.fetchone() is not None
+            c.execute("SELECT status FROM books WHERE id = ?", (book_id,))
+            current = c.fetchone()
+            legacy = current is not None and current['status'] == ON_LOAN_STATUS
+            if status == ON_LOAN_STATUS and not on_loan and not legacy:
+                return "Books are checked out through circulation, not by editing their status."
             c.execute("""UPDATE books
-                         SET title=?, author=?, isbn=?, published_year=?, genre=?, status=?, description=?, cover=?
+                         SET title=?, author=?, isbn=?, isbn13=?, published_year=?, genre=?, status=?, description=?, cover=?
                          WHERE id=?""",
-                      (title, author, isbn, published_year, genre, status, description, cover, book_id))
-            conn.commit()
-            flash("Book updated.", "success")
-            return redirect(url_for('books'))
-        except sqlite3.IntegrityError:
-            flash("ISBN already exists for another book.", "danger")
+                      (title, author, isbn, isbn13, published_year, genre, ON_LOAN_STATUS if on_loan else status,
+                       description, cover, book_id))
+            return None
+
+        try:
+            isbn13 = normalize_isbn(isbn)
+        except ValueError as e:
+            flash(f"Invalid ISBN: {e}", "danger")
+        else:
+            try:
+                error = f"Unknown status: {status}" if status not in BOOK_STATUSES else run_write(update)
+                if error:
+                    flash(error, "danger")
+                else:
+                    warm_cover_thumbnails(cover)
+                    catalog_changed(conn)
+                    flash("Book updated.", "success")
+                    return redirect(url_for('books'))
+            except sqlite3.IntegrityError:
+                flash("ISBN already exists for another book.", "danger")
 
     c.execute("SELECT * FROM books WHERE id=?", (book_id,))
     book = c.fetchone()
-    conn.close()
     if not book:
         flash("Book not found.", "danger")
         return redirect(url_for('books'))
+    c.execute("SELECT due_date FROM borrowings WHERE book_id = ? AND returned_date IS NULL", (book_id,))
+    loan = c.fetchone()
 
-    return render_template('edit_book.html', book=book)
+    return render_template('edit_book.html', book=book, loan=loan)
 
 @app.route('/delete_book/<int:book_id>')
 def delete_book(book_id):
     if not login_required():
         return redirect(url_for('login'))
 
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("DELETE FROM books WHERE id=?", (book_id,))
-    conn.commit()
-    conn.close()
+    run_write(lambda c: c.execute("DELETE FROM books WHERE id=?", (book_id,)))
+    catalog_changed(get_db())
     flash("Book deleted.", "info")
     return redirect(url_for('books'))
 
 # -------------------- Enhanced Search Route --------------------
+def search_filters_from(source):
+    """Read search filters from a form or query-string MultiDict"""
+    sort_by = source.get('sort_by', 'title')
+    return {
+        'search_term': source.get('search_term', '').strip(),
+        'search_by': source.get('search_by', 'title'),
+        'sort_by': sort_by if sort_by in SORT_ORDERS else 'title',
+        'status': source.getlist('status[]'),
+        'year_from': source.get('year_from'),
+        'year_to': source.get('year_to'),
+        'fuzzy': source.get('fuzzy') == '1',
+    }
+
 @app.route('/search', methods=['GET', 'POST'])
 def search():
     books = []
@@ -312,81 +4113,48 @@ def search():
     year_from = None
     year_to = None
     available_count = 0
+    next_cursor = None
+    cursor = None
+    fuzzy = False
+    fuzzy_fallback = False
     
     if request.method == 'POST':
-        search_term = request.form.get('search_term', '').strip()
-        search_by = request.form.get('search_by', 'title')
-        sort_by = request.form.get('sort_by', 'title')
+        filters = search_filters_from(request.form)
+        search_term = filters['search_term']
+        search_by = filters['search_by']
+        sort_by = filters['sort_by']
+        status_filters = filters['status']
+        year_from = filters['year_from']
+        year_to = filters['year_to']
+        cursor = request.form.get('cursor')
+        fuzzy = filters['fuzzy'] and search_by in FUZZY_FIELDS and bool(search_term)
         
-        # Get advanced filters
-        status_filters = request.form.getlist('status[]')
-        year_from = request.form.get('year_from')
-        year_to = request.form.get('year_to')
+        # Remember the filters so the export returns the same result set
+        session['last_search_params'] = filters
         
-        # Add to search history if user is logged in
-        if 'user_id' in session and search_term:
+        # Add to search history if user is logged in (first page only)
+        if 'user_id' in session and search_term and not cursor:
             add_search_history(session['user_id'], search_term, search_by)
         
-        query = "SELECT * FROM books WHERE 1=1"
-        params = []
-        
-        # Basic search
-        if search_term:
-            if search_by == 'title':
-                query += " AND title LIKE ?"
-                params.append(f"%{search_term}%")
-            elif search_by == 'author':
-                query += " AND author LIKE ?"
-                params.append(f"%{search_term}%")
-            elif search_by == 'genre':
-                query += " AND genre LIKE ?"
-                params.append(f"%{search_term}%")
-            elif search_by == 'year':
-                if search_term.isdigit():
-                    query += " AND published_year = ?"
-                    params.append(int(search_term))
-            elif search_by == 'isbn':
-                query += " AND isbn LIKE ?"
-                params.append(f"%{search_term}%")
-        
-        # Status filters
-        if status_filters:
-            placeholders = ','.join('?' * len(status_filters))
-            query += f" AND status IN ({placeholders})"
-            params.extend(status_filters)
-        
-        # Year range filter
-        if year_from and year_from.isdigit():
-            query += " AND published_year >= ?"
-            params.append(int(year_from))
-        if year_to and year_to.isdigit():
-            query += " AND published_year <= ?"
-            params.append(int(year_to))
-        
-        # Sorting
-        if sort_by == 'title':
-            query += " ORDER BY title ASC"
-        elif sort_by == 'title_desc':
-            query += " ORDER BY title DESC"
-        elif sort_by == 'author':
-            query += " ORDER BY author ASC, title ASC"
-        elif sort_by == 'year':
-            query += " ORDER BY published_year DESC, title ASC"
-        elif sort_by == 'year_asc':
-            query += " ORDER BY published_year ASC, title ASC"
-        elif sort_by == 'added':
-            query += " ORDER BY created_date DESC"
-        
         conn = get_db()
         c = conn.cursor()
-        c.execute(query, params)
-        books = c.fetchall()
+        page_size = page_size_arg(request.form.get('limit'))
+        if fuzzy:
+            # Ranked by similarity, so a single page and no cursor
+            books = fuzzy_search(conn, search_term, search_by, status_filters, year_from, year_to,
+                                 limit=page_size)
+        else:
+            query = BookQuery.from_filters(filters, limit=page_size, cursor=cursor)
+            books, next_cursor = query.fetch_page(c)
+            
+            # Nothing matched literally: offer close matches rather than leave the user retrying
+            if not books and not cursor and search_by in FUZZY_FIELDS and search_term:
+                books = fuzzy_search(conn, search_term, search_by, status_filters, year_from, year_to,
+                                     limit=page_size)
+                fuzzy_fallback = bool(books)
         
         # Get available count for stats
-        c.execute("SELECT COUNT(*) as cnt FROM books WHERE status = 'Available'")
-        available_count = c.fetchone()['cnt']
-        
-        conn.close()
+        available_count = read_catalog_stats(conn)['available']
     
     # Get search history if logged in
     search_history = []
@@ -402,11 +4170,16 @@ def search():
                          year_from=year_from,
                          year_to=year_to,
                          available_count=available_count,
-                         search_history=search_history)
+                         search_history=search_history,
+                         next_cursor=next_cursor,
+                         is_first_page=not cursor,
+                         fuzzy=fuzzy,
+                         fuzzy_fallback=fuzzy_fallback)
 
 # -------------------- AJAX Endpoints for Enhanced Features --------------------
 
 @app.route('/api/book/<int:book_id>')
+@catalog_cached(per_user=True)
 def get_book_details(book_id):
     """Get book details for modal view"""
     if not login_required():
@@ -416,7 +4189,6 @@ def get_book_details(book_id):
     c = conn.cursor()
     c.execute("SELECT * FROM books WHERE id=?", (book_id,))
     book = c.fetchone()
-    conn.close()
     
     if book:
         book_dict = dict(book)
@@ -424,129 +4196,311 @@ def get_book_details(book_id):
     else:
         return jsonify({'error': 'Book not found'}), 404
 
+@app.route('/api/book/<int:book_id>/similar')
+@catalog_cached(per_user=True)
+def similar_book_list(book_id):
+    """Readers who borrowed this book also borrowed... (from `flask recommendations`)"""
+    if not login_required():
+        return jsonify({'error': 'Login required'}), 401
+    
+    limit = min(max(request.args.get('limit', 10, type=int), 1), app.config['RECOMMEND_TOP_K'])
+    conn = get_db()
+    if conn.execute("SELECT 1 FROM books WHERE id = ?", (book_id,)).fetchone() is None:
+        return jsonify({'error': 'Book not found'}), 404
+    rows = similar_books(conn, book_id, limit, columns=BOOK_LIST_COLUMNS)
+    return jsonify({'book_id': book_id, 'similar': [dict(row) for row in rows]})
+
 @app.route('/api/quick_search/<search_type>')
+@catalog_cached()
 def quick_search(search_type):
     """Handle quick search buttons"""
     conn = get_db()
     c = conn.cursor()
     
-    if search_type == 'available':
-        c.execute("SELECT * FROM books WHERE status='Available' ORDER BY title ASC LIMIT 20")
+    if search_type == 'text':
+        # Ranked free-text search across every indexed column
+        query = BookQuery(search_term=request.args.get('q', ''), search_by='all', sort_by='relevance',
+                          columns=BOOK_CARD_COLUMNS, limit=20)
+        if not query.term_mode:
+            return jsonify([])
+    elif search_type == 'available':
+        query = BookQuery(status=['Available'], sort_by='title', columns=BOOK_CARD_COLUMNS, limit=20)
     elif search_type == 'recent':
-        c.execute("SELECT * FROM books ORDER BY created_date DESC LIMIT 10")
+        query = BookQuery(sort_by='added', columns=BOOK_CARD_COLUMNS, limit=10)
     elif search_type == 'fiction':
-        c.execute("SELECT * FROM books WHERE genre LIKE '%Fiction%' OR genre LIKE '%Novel%' ORDER BY title ASC LIMIT 20")
+        query = BookQuery(genre_terms=['Fiction', 'Novel'], sort_by='title', columns=BOOK_CARD_COLUMNS, limit=20)
     elif search_type == 'popular':
-        c.execute("SELECT * FROM books WHERE genre IN ('Fantasy', 'Mystery', 'Thriller', 'Romance') ORDER BY RANDOM() LIMIT 8")
+        return jsonify([dict(book) for book in most_borrowed_books(conn, 8, genres=POPULAR_GENRES)])
     elif search_type == 'new':
         current_year = datetime.now().year
-        c.execute("SELECT * FROM books WHERE published_year >= ? ORDER BY published_year DESC LIMIT 10", (current_year - 5,))
+        query = BookQuery(year_from=current_year - 5, sort_by='year', columns=BOOK_CARD_COLUMNS, limit=10)
     else:
-        conn.close()
         return jsonify({'error': 'Invalid search type'}), 400
     
-    books = c.fetchall()
-    conn.close()
+    books, _ = query.fetch_page(c)
     
     # Convert to list of dicts
-    books_list = [dict(book) for book in books]
+    books_list = []
+    for book in books:
+        book = book_dict(book)
+        if 'title_hl' in book:
+            book['title_hl'] = str(highlight_filter(book['title_hl']))
+            book['snippet'] = str(highlight_filter(book['snippet']))
+        books_list.append(book)
     return jsonify(books_list)
 
+@app.route('/api/suggest')
+def suggest():
+    """Typeahead suggestions for a prefix, from the in-memory index once this worker has built it"""
+    field = request.args.get('field', 'title')
+    if field not in SUGGEST_FIELDS + ('all',):
+        return jsonify({'error': f"field must be one of {', '.join(SUGGEST_FIELDS)} or all"}), 400
+    q = request.args.get('q', '')
+    try:
+        limit = max(1, min(int(request.args.get('limit', 8)), SUGGEST_TOP))
+    except ValueError:
+        limit = 8
+    
+    conn = get_db()
+    _suggest_index.refresh(conn)
+    if _suggest_index.built_at:
+        suggestions = _suggest_index.suggest(q, field, limit)
+    else:
+        suggestions = sql_suggestions(conn, q, field, limit)
+    response = jsonify({'q': q, 'field': field, 'suggestions': suggestions})
+    response.cache_control.public = True
+    response.cache_control.max_age = 30
+    return response
+
 @app.route('/api/search_stats')
+@catalog_cached()
 def get_search_stats():
     """Get search statistics"""
-    conn = get_db()
-    c = conn.cursor()
-    
-    # Total books
-    c.execute("SELECT COUNT(*) as total FROM books")
-    total = c.fetchone()['total']
-    
-    # Available books
-    c.execute("SELECT COUNT(*) as available FROM books WHERE status='Available'")
-    available = c.fetchone()['available']
-    
-    # Genres count
-    c.execute("SELECT COUNT(DISTINCT genre) as genres FROM books WHERE genre IS NOT NULL AND genre != ''")
-    genres = c.fetchone()['genres']
-    
-    # Authors count
-    c.execute("SELECT COUNT(DISTINCT author) as authors FROM books")
-    authors = c.fetchone()['authors']
-    
-    # Year range
-    c.execute("SELECT MIN(published_year) as min_year, MAX(published_year) as max_year FROM books WHERE published_year IS NOT NULL")
-    year_range = c.fetchone()
-    
-    conn.close()
+    stats = read_catalog_stats(get_db())
     
     return jsonify({
-        'total': total,
-        'available': available,
-        'genres': genres,
-        'authors': authors,
-        'min_year': year_range['min_year'] if year_range['min_year'] else 0,
-        'max_year': year_range['max_year'] if year_range['max_year'] else datetime.now().year
+        'total': stats['total'],
+        'available': stats['available'],
+        'genres': stats['genres'],
+        'authors': stats['authors'],
+        'min_year': stats['min_year'] if stats['min_year'] else 0,
+        'max_year': stats['max_year'] if stats['max_year'] else datetime.now().year
     })
 
+EXPORT_COLUMNS = 'id, title, author, isbn, published_year, genre, status, description'
+EXPORT_FLUSH_BYTES = 64 * 1024
+
+def export_rows(c, fmt, stats):
+    """Yield the export body in ~64KB chunks while stepping the cursor (or a list of rows) row by row"""
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    if fmt == 'csv':
+        writer.writerow(['ID', 'Title', 'Author', 'ISBN', 'Year', 'Genre', 'Status', 'Description'])
+
+    for book in c:
+        stats['rows'] += 1
+        if fmt == 'csv':
+            writer.writerow([
+                book['id'],
+                book['title'],
+                book['author'],
+                book['isbn'] or '',
+                book['published_year'] or '',
+                book['genre'] or '',
+                book['status'],
+                (book['description'] or '')[:100]  # First 100 chars
+            ])
+        else:
+            buffer.write(json.dumps({
+                'id': book['id'],
+                'title': book['title'],
+                'author': book['author'],
+                'isbn': book['isbn'],
+                'published_year': book['published_year'],
+                'genre': book['genre'],
+                'status': book['status'],
+                'description': book['description'],
+            }, ensure_ascii=False) + '\n')
+        if buffer.tell() >= EXPORT_FLUSH_BYTES:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+def gzip_stream(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 writes a gzip header
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
 @app.route('/export/search_results')
 def export_search_results():
-    """Export search results as CSV"""
+    """Stream the last search's results as CSV or JSON Lines (?format=csv|jsonl&gzip=1)"""
     if not login_required():
         return redirect(url_for('login'))
     
-    # Get search parameters from session or request
-    search_params = session.get('last_search_params', {})
-    
-    conn = get_db()
-    c = conn.cursor()
-    
-    # Basic query
-    query = "SELECT * FROM books"
-    params = []
-    
-    # Add filters if they exist
-    if search_params:
-        query += " WHERE 1=1"
-        if search_params.get('search_term'):
-            if search_params.get('search_by') == 'title':
-                query += " AND title LIKE ?"
-                params.append(f"%{search_params['search_term']}%")
+    fmt = request.args.get('format', 'csv')
+    if fmt not in ('csv', 'jsonl'):
+        return jsonify({'error': 'Invalid export format'}), 400
+    use_gzip = request.args.get('gzip') == '1'
     
-    query += " ORDER BY title ASC"
-    
-    c.execute(query, params)
-    books = c.fetchall()
-    conn.close()
+    # Filters from the query string win; otherwise export what the user last searched
+    if request.args.get('search_term') is not None:
+        filters = search_filters_from(request.args)
+    else:
+        filters = session.get('last_search_params', {})
     
-    # Create CSV
-    output = StringIO()
-    writer = csv.writer(output)
+    query = BookQuery.from_filters(filters, columns=EXPORT_COLUMNS)
+    search_term, search_by = filters.get('search_term'), filters.get('search_by')
+    # Same choice as /search: close matches when asked for, or when nothing matched literally
+    can_fuzzy = search_by in FUZZY_FIELDS and bool(search_term)
     
-    # Write header
-    writer.writerow(['ID', 'Title', 'Author', 'ISBN', 'Year', 'Genre', 'Status', 'Description'])
+    def generate():
+        stats = {'rows': 0}
+        started = time.perf_counter()
+        conn = get_db()
+        c = conn.cursor()
+        try:
+            fuzzy = can_fuzzy and (filters.get('fuzzy') or not BookQuery.from_filters(filters, limit=1).fetch_page(c)[0])
+            if fuzzy:
+                # At most FUZZY_CANDIDATES books, ranked by similarity as on the page
+                rows = fuzzy_search(conn, search_term, search_by, filters.get('status'), filters.get('year_from'),
+                                    filters.get('year_to'), columns=EXPORT_COLUMNS, limit=FUZZY_CANDIDATES)
+            else:
+                # Iterating the cursor steps SQLite one row at a time; nothing is materialised
+                query.execute(c)
+                rows = c
+            chunks = export_rows(rows, fmt, stats)
+            yield from (gzip_stream(chunks) if use_gzip else chunks)
+        finally:
+            c.close()
+            elapsed = time.perf_counter() - started
+            app.logger.info("Exported %d rows as %s in %.2fs (%.0f rows/sec)",
+                            stats['rows'], fmt, elapsed, stats['rows'] / elapsed if elapsed else 0)
     
-    # Write data
-    for book in books:
-        writer.writerow([
-            book['id'],
-            book['title'],
-            book['author'],
-            book['isbn'] or '',
-            book['published_year'] or '',
-            book['genre'] or '',
-            book['status'],
-            (book['description'] or '')[:100]  # First 100 chars
-        ])
-    
-    output.seek(0)
+    filename = f"search_results.{fmt}"
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    if use_gzip:
+        filename += '.gz'
+        mimetype = 'application/gzip'
     
     return Response(
-        output,
-        mimetype="text/csv",
-        headers={"Content-Disposition": "attachment;filename=search_results.csv"}
+        stream_with_context(generate()),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment;filename={filename}"}
     )
 
+# -------------------- Batch Book Details --------------------
+# Details for a whole results grid in one indexed query instead of one /api/book/<id>
+# round trip per book. Every item carries an etag over exactly what was returned
+# (fields and embeds); clients send back the etags they hold and get a stub for
+# each book that hasn't changed.
+BOOK_BATCH_MAX = 500
+BOOK_FIELDS = ('title', 'author', 'isbn', 'isbn13', 'published_year', 'genre', 'status',
+               'description', 'cover', 'created_date')
+BOOK_EMBEDS = ('availability', 'borrow_count')
+
+def batch_list_arg(value):
+    """Comma-separated string or list of them (JSON, repeated query/form keys) as one flat list"""
+    values = value if isinstance(value, list) else [value]
+    return [part.strip() for v in values if v is not None for part in str(v).split(',') if part.strip()]
+
+def batch_etags_arg(value):
+    """{book_id: etag} from a JSON object or "id:etag,id:etag"; malformed pairs are ignored"""
+    pairs = value.items() if isinstance(value, dict) else (part.partition(':')[::2] for part in batch_list_arg(value))
+    known = {}
+    for book_id, etag in pairs:
+        try:
+            known[int(book_id)] = str(etag)
+        except (TypeError, ValueError):
+            continue
+    return known
+
+def book_etag(item):
+    return hashlib.sha1(json.dumps(item, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+def fetch_book_batch(conn, ids, fields, embed):
+    """{book_id: item} for the ids that exist, with only the requested fields and embeds"""
+    columns = ['books.id'] + [f'books.{field}' for field in fields]
+    joins = []
+    if 'availability' in embed:
+        # idx_borrowings_open_book: at most one open loan per book, found by index
+        columns += ['books.status AS availability_status', 'loan.due_date AS availability_due_date']
+        joins.append("LEFT JOIN borrowings loan ON loan.book_id = books.id AND loan.returned_date IS NULL")
+    if 'borrow_count' in embed:
+        columns.append('IFNULL(bc.cnt, 0) AS borrow_count')
+        joins.append("LEFT JOIN book_borrow_counts bc ON bc.book_id = books.id")
+    c = conn.cursor()
+    c.execute(f"""SELECT {', '.join(columns)} FROM books {' '.join(joins)}
+                  WHERE books.id IN (SELECT value FROM json_each(?))""", (json.dumps(ids),))
+    books = {}
+    for row in c.fetchall():
+        item = {'id': row['id']}
+        item.update((field, row[field]) for field in fields)
+        if 'cover' in fields:
+            item['cover_url'] = cover_url(row['cover'])
+        if 'availability' in embed:
+            item['availability'] = {'available': row['availability_status'] == AVAILABLE_STATUS,
+                                    'status': row['availability_status'],
+                                    'due_date': row['availability_due_date']}
+        if 'borrow_count' in embed:
+            item['borrow_count'] = row['borrow_count']
+        item['etag'] = book_etag(item)
+        books[item['id']] = item
+    return books
+
+@app.route('/api/books/batch', methods=['GET', 'POST'])
+@catalog_cached(per_user=True)
+def book_batch():
+    """Details for many books: ?ids=1,2,3&fields=title,author&embed=availability,borrow_count&etags=1:<etag>
+
+    POST takes the same keys as JSON (lists or comma-separated strings; "etags" may be
+    an object) or as a form, for id lists too long for a URL.
+    """
+    if not login_required():
+        return jsonify({'error': 'Login required'}), 401
+    if request.method == 'POST':
+        payload = request.get_json(silent=True)
+        if not isinstance(payload, dict):
+            payload = {key: request.form.getlist(key) for key in request.form}
+    else:
+        payload = {key: request.args.getlist(key) for key in request.args}
+    
+    ids = book_ids_arg(batch_list_arg(payload.get('ids')))
+    if not ids:
+        return jsonify({'error': 'ids is required'}), 400
+    ids = list(dict.fromkeys(ids))
+    if len(ids) > BOOK_BATCH_MAX:
+        return jsonify({'error': f'At most {BOOK_BATCH_MAX} ids per batch'}), 400
+    conn = get_db()
+    available_fields = [f for f in BOOK_FIELDS if f != 'isbn13' or isbn13_enabled(conn)]
+    fields = [f for f in batch_list_arg(payload.get('fields')) if f != 'id'] or available_fields
+    unknown = [f for f in fields if f not in available_fields]
+    if unknown:
+        return jsonify({'error': f"Unknown field: {', '.join(unknown)}", 'fields': available_fields}), 400
+    embed = batch_list_arg(payload.get('embed'))
+    unknown = [e for e in embed if e not in BOOK_EMBEDS]
+    if unknown:
+        return jsonify({'error': f"Unknown embed: {', '.join(unknown)}", 'embed': list(BOOK_EMBEDS)}), 400
+    known = batch_etags_arg(payload.get('etags'))
+    
+    books = fetch_book_batch(conn, ids, list(dict.fromkeys(fields)), set(embed))
+    results, not_modified = [], 0
+    for book_id in ids:
+        item = books.get(book_id)
+        if item is None:
+            continue
+        if known.get(book_id) == item['etag']:
+            item = {'id': book_id, 'etag': item['etag'], 'not_modified': True}
+            not_modified += 1
+        results.append(item)
+    return jsonify({'books': results, 'missing': [i for i in ids if i not in books],
+                    'not_modified': not_modified})
+
 # -------------------- Auth Routes --------------------
 @app.route('/register', methods=['GET', 'POST'])
 def register():
@@ -564,18 +4518,13 @@ def register():
 
         password_hash = hashlib.sha256(raw_password.encode()).hexdigest()
 
-        conn = get_db()
-        c = conn.cursor()
         try:
-            c.execute("INSERT INTO users (username, password, email) VALUES (?, ?, ?)",
-                      (username, password_hash, email))
-            conn.commit()
+            run_write(lambda c: c.execute("INSERT INTO users (username, password, email) VALUES (?, ?, ?)",
+                                          (username, password_hash, email)))
             flash("Registration successful. Please login.", "success")
             return redirect(url_for('login'))
         except sqlite3.IntegrityError:
             flash("Username already exists.", "danger")
-        finally:
-            conn.close()
 
     return render_template('register.html')
 
@@ -593,7 +4542,6 @@ def login():
         c = conn.cursor()
         c.execute("SELECT * FROM users WHERE username=? AND password=?", (username, password_hash))
         user = c.fetchone()
-        conn.close()
 
         if user:
             session['user_id'] = user['id']
@@ -648,8 +4596,6 @@ def get_card_stats(user_id):
     c.execute("SELECT * FROM library_cards WHERE user_id=?", (user_id,))
     card = c.fetchone()
     
-    conn.close()
-    
     return jsonify({
         'books_borrowed': books_borrowed,
         'active_reservations': active_reservations,
@@ -660,77 +4606,120 @@ def get_card_stats(user_id):
         'valid_until': (datetime.now() + timedelta(days=365*2)).strftime('%Y-%m-%d') if card else 'N/A'
     })
 
-@app.route('/generate_qr/<int:user_id>')
-def generate_qr(user_id):
-    """Generate QR code for user's library card"""
-    if not login_required():
-        return jsonify({'error': 'Login required'}), 401
-    
-    # Create card data
-    conn = get_db()
-    c = conn.cursor()
+QR_FORMATS = {'png': 'image/png', 'svg': 'image/svg+xml'}
+
+def card_qr_payload(user_id):
+    """The JSON string encoded in a user's card QR code, or (None, error, status)"""
+    c = get_db().cursor()
     c.execute("SELECT * FROM library_cards WHERE user_id=?", (user_id,))
     card = c.fetchone()
     
     if not card:
-        conn.close()
-        return jsonify({'error': 'No library card found for this user'}), 404
+        return None, 'No library card found for this user', 404
     
     c.execute("SELECT * FROM users WHERE id=?", (user_id,))
     user = c.fetchone()
     
     if not user:
-        conn.close()
-        return jsonify({'error': 'User not found'}), 404
+        return None, 'User not found', 404
     
-    conn.close()
-    
-    # Create data string for QR code
+    # Parse issue date safely
+    issue_date = card['issue_date']
     try:
-        # Parse issue date safely
-        issue_date = card['issue_date']
+        issue_date_obj = datetime.strptime(issue_date, '%Y-%m-%d')
+        valid_until = (issue_date_obj + timedelta(days=365*2)).strftime('%Y-%m-%d')
+    except:
+        valid_until = "Permanent"
+    
+    card_data = {
+        'user_id': user_id,
+        'username': user['username'],
+        'card_number': card['card_number'],
+        'issue_date': issue_date,
+        'valid_until': valid_until
+    }
+    return json.dumps(card_data), None, 200
+
+def qr_digest(data_string):
+    return hashlib.sha256(data_string.encode()).hexdigest()[:20]
+
+@lru_cache(maxsize=512)
+def render_qr(data_string, fmt):
+    """QR image bytes for a payload: in-process LRU in front of a content-addressed disk store"""
+    qr_dir = app.config['QR_CACHE_DIR']
+    path = os.path.join(qr_dir, f"{qr_digest(data_string)}.{fmt}")
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    import qrcode
+    import qrcode.image.svg
+
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=10,
+        border=4,
+    )
+    qr.add_data(data_string)
+    qr.make(fit=True)
+    
+    buffer = io.BytesIO()
+    if fmt == 'svg':
+        # Pure-Python vector output, no PIL rasterisation
+        qr.make_image(image_factory=qrcode.image.svg.SvgPathImage).save(buffer)
+    else:
+        qr.make_image(fill_color="black", back_color="white").save(buffer, format="PNG")
+    data = buffer.getvalue()
+
+    os.makedirs(qr_dir, exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+    return data
+
+@app.route('/card_qr/<int:user_id>.<fmt>')
+def card_qr_image(user_id, fmt):
+    """QR code for a user's library card as a PNG or SVG image, with ETag revalidation"""
+    if not login_required():
+        return jsonify({'error': 'Login required'}), 401
+    if fmt not in QR_FORMATS:
+        return jsonify({'error': 'Unsupported QR format'}), 404
+    
+    data_string, error, status = card_qr_payload(user_id)
+    if error:
+        return jsonify({'error': error}), status
+    
+    etag = f"{qr_digest(data_string)}-{fmt}"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
         try:
-            issue_date_obj = datetime.strptime(issue_date, '%Y-%m-%d')
-            valid_until = (issue_date_obj + timedelta(days=365*2)).strftime('%Y-%m-%d')
-        except:
-            valid_until = "Permanent"
-        
-        card_data = {
-            'user_id': user_id,
-            'username': user['username'],
-            'card_number': card['card_number'],
-            'issue_date': issue_date,
-            'valid_until': valid_until
-        }
-    except Exception as e:
-        return jsonify({'error': f'Error processing card data: {str(e)}'}), 500
+            response = Response(render_qr(data_string, fmt), mimetype=QR_FORMATS[fmt])
+        except Exception as e:
+            return jsonify({'error': f'Error generating QR code: {str(e)}'}), 500
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.max_age = 3600
+    return response
+
+@app.route('/generate_qr/<int:user_id>')
+def generate_qr(user_id):
+    """Generate QR code for user's library card (base64 JSON; prefer /card_qr/<id>.png)"""
+    if not login_required():
+        return jsonify({'error': 'Login required'}), 401
     
-    data_string = json.dumps(card_data)
+    data_string, error, status = card_qr_payload(user_id)
+    if error:
+        return jsonify({'error': error}), status
     
-    # Generate QR code
     try:
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_L,
-            box_size=10,
-            border=4,
-        )
-        qr.add_data(data_string)
-        qr.make(fit=True)
-        
-        # Create image
-        img = qr.make_image(fill_color="black", back_color="white")
-        
-        # Convert to base64
-        buffer = io.BytesIO()
-        img.save(buffer, format="PNG")
-        buffer.seek(0)
-        
-        img_str = base64.b64encode(buffer.getvalue()).decode()
+        img_str = base64.b64encode(render_qr(data_string, 'png')).decode()
         
         return jsonify({
             'qr_code': f'data:image/png;base64,{img_str}',
-            'card_data': card_data
+            'card_data': json.loads(data_string)
         })
     except Exception as e:
         return jsonify({'error': f'Error generating QR code: {str(e)}'}), 500
@@ -749,7 +4738,6 @@ def download_card_pdf(user_id):
     c.execute("SELECT * FROM users WHERE id=?", (user_id,))
     user = c.fetchone()
     
-    conn.close()
     
     if not card or not user:
         flash("No card found", "error")
@@ -813,7 +4801,6 @@ def library_card():
     user = c.fetchone()
     
     if not user:
-        conn.close()
         flash("User not found in database", "error")
         return redirect(url_for('index'))
     
@@ -825,14 +4812,13 @@ def library_card():
         # issue a new card with better format
         card_number = "LIB" + datetime.now().strftime("%y%m%d") + str(session['user_id']).zfill(4)
         issue_date = datetime.now().strftime("%Y-%m-%d")
+        user_id = session['user_id']
         try:
-            c.execute("INSERT INTO library_cards (user_id, card_number, issue_date) VALUES (?, ?, ?)",
-                      (session['user_id'], card_number, issue_date))
-            conn.commit()
+            run_write(lambda w: w.execute("INSERT INTO library_cards (user_id, card_number, issue_date) VALUES (?, ?, ?)",
+                                          (user_id, card_number, issue_date)))
             c.execute("SELECT * FROM library_cards WHERE user_id=?", (session['user_id'],))
             card = c.fetchone()
         except Exception as e:
-            conn.close()
             flash(f"Error creating library card: {str(e)}", "error")
             return redirect(url_for('index'))
     
@@ -845,8 +4831,6 @@ def library_card():
         except:
             valid_until = "N/A"
     
-    conn.close()
-    
     return render_template('library_card.html', 
                          card=card,
                          valid_until=valid_until,
@@ -870,8 +4854,6 @@ def debug_user_status():
     c.execute("SELECT * FROM library_cards WHERE user_id=?", (session['user_id'],))
     card = c.fetchone()
     
-    conn.close()
-    
     return jsonify({
         'session_user_id': session['user_id'],
         'session_username': session.get('username'),
@@ -879,7 +4861,487 @@ def debug_user_status():
         'card_in_db': dict(card) if card else None
     })
 
+# -------------------- Database Pool Stats --------------------
+@app.route('/api/db_pool_stats')
+def db_pool_stats():
+    """Connection pool hit/miss counters for this worker"""
+    stats = get_pool().snapshot()
+    stats['pid'] = os.getpid()
+    stats['read_pool'] = get_pool(readonly=True).snapshot()
+    stats['writer'] = get_write_queue().snapshot()
+    shapes = compile_book_query.cache_info()
+    stats['query_shapes'] = {'hits': shapes.hits, 'misses': shapes.misses, 'size': shapes.currsize}
+    stats['search_history'] = get_history_writer().snapshot()
+    stats['suggest'] = _suggest_index.snapshot()
+    stats['response_cache'] = response_cache_snapshot()
+    return jsonify(stats)
+
+# -------------------- Request Metrics --------------------
+# Statements on connect_db() connections are counted and timed for the worker. Statements
+# that run through get_db() are also charged to the current request. Each worker writes
+# its totals to METRICS_DIR, and /metrics adds up the files so a scrape covers the whole
+# gunicorn pool. The master clears the directory on start and folds each exited worker's
+# file into METRICS_ARCHIVE, so a reused PID never overwrites a dead worker's totals.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+EXPLAIN_PREFIXES = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+POOL_COUNTERS = ('hits', 'misses', 'waits', 'timeouts', 'discarded')
+POOL_SNAPSHOTS = (('rw', 'pool'), ('ro', 'read_pool'))
+WRITE_WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+WRITER_COUNTERS = ('units', 'failed_units', 'transactions', 'failed_transactions', 'timeouts')
+METRICS_ARCHIVE = 'exited-workers.json'
+
+
+class QueryStats:
+    """Statements, database time and rows fetched for one request"""
+    __slots__ = ('queries', 'seconds', 'rows', 'slow')
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+        self.rows = 0
+        self.slow = 0
+
+
+_cursor_next = sqlite3.Cursor.__next__
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor that reports statement time and fetched rows to its connection
+
+    A statement's time is execute() plus the fetch calls after it: SQLite does
+    much of its work stepping through rows (a filtered index scan, a correlated
+    subquery), not just in the first step. SLOW_QUERY_MS applies to that total.
+    """
+    _statement = ('', None)
+    _elapsed = 0.0
+    _slow = False
+
+    def _timed(self, elapsed, rows=None):
+        conn = self.connection
+        (conn.metrics or conn.worker_metrics()).record(elapsed, rows is None)
+        stats = conn.observer
+        if stats is not None:
+            stats.seconds += elapsed
+            if rows is None:
+                stats.queries += 1
+            else:
+                stats.rows += rows
+        self._elapsed += elapsed
+        if not self._slow and self._elapsed * 1000.0 >= app.config['SLOW_QUERY_MS']:
+            self._slow = True
+            conn.record_slow(*self._statement, self._elapsed)
+
+    def execute(self, sql, parameters=()):
+        self._statement, self._elapsed, self._slow = (sql, parameters), 0.0, False
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._timed(time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        self._statement, self._elapsed, self._slow = (sql, None), 0.0, False
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._timed(time.perf_counter() - started)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._timed(time.perf_counter() - started, row is not None)
+        return row
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._timed(time.perf_counter() - started, len(rows))
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._timed(time.perf_counter() - started, len(rows))
+        return rows
+
+    # Row-by-row iteration (exports) is counted but not timed, to keep it cheap
+    def __next__(self):
+        # Called per row when iterating, so skip the super() lookup
+        row = _cursor_next(self)
+        observer = self.connection.observer
+        if observer is not None:
+            observer.rows += 1
+        return row
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Connection whose cursors are instrumented; `observer` is the request's QueryStats"""
+    observer = None
+    metrics = None
+    readonly = False
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    # The C shortcuts bypass cursor(), so route them through it
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            elapsed = time.perf_counter() - started
+            (self.metrics or self.worker_metrics()).record(elapsed, 1)
+            if self.observer is not None:
+                self.observer.queries += 1
+                self.observer.seconds += elapsed
+            if elapsed * 1000.0 >= app.config['SLOW_QUERY_MS']:
+                self.record_slow('COMMIT', None, elapsed)
+
+    def worker_metrics(self):
+        # Connections never cross a fork (the pool is rebuilt), so look this up once
+        self.metrics = get_metrics()
+        return self.metrics
+
+    def record_slow(self, sql, parameters, elapsed):
+        (self.metrics or self.worker_metrics()).record(0.0, slow=1)
+        if self.observer is not None:
+            self.observer.slow += 1
+        log_slow_query(self, sql, parameters, elapsed)
+
+
+def log_slow_query(conn, sql, parameters, elapsed):
+    """Log a statement over SLOW_QUERY_MS together with its query plan"""
+    statement = ' '.join(sql.split())
+    plan = []
+    if parameters is not None and statement.upper().startswith(EXPLAIN_PREFIXES):
+        try:
+            # A plain cursor, so the EXPLAIN is not itself counted
+            explain = conn.cursor(sqlite3.Cursor)
+            explain.execute('EXPLAIN QUERY PLAN ' + sql, parameters)
+            plan = [f"  {row[3]}" for row in explain.fetchall()]
+        except sqlite3.Error:
+            pass
+    endpoint = request.endpoint if has_request_context() else None
+    app.logger.warning("Slow query (%.1f ms, %s): %s%s", elapsed * 1000.0, endpoint or 'background',
+                       statement[:1000], ''.join('\n' + line for line in plan))
+
+
+def _observe(histograms, key, buckets, value):
+    # One slot per bucket, one for +Inf, then the running sum
+    counts = histograms.get(key)
+    if counts is None:
+        counts = histograms[key] = [0] * (len(buckets) + 2)
+    counts[bisect.bisect_left(buckets, value)] += 1
+    counts[-1] += value
+
+
+class RequestMetrics:
+    """Per-worker request and database counters"""
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.flushed = 0.0
+        self._lock = threading.Lock()
+        self.requests = {}              # "route\tmethod\tstatus" -> count
+        self.latency = {}               # route -> LATENCY_BUCKETS histogram
+        self.queries = {}               # route -> QUERY_COUNT_BUCKETS histogram
+        self.db = {}                    # route -> [seconds, rows, slow queries]
+        self.statements = [0, 0.0, 0]   # every connection in the worker: count, seconds, slow
+
+    def record(self, elapsed, statements=0, slow=0):
+        with self._lock:
+            self.statements[0] += statements
+            self.statements[1] += elapsed
+            self.statements[2] += slow
+
+    def observe_request(self, route, method, status, elapsed, stats):
+        with self._lock:
+            key = f"{route}\t{method}\t{status}"
+            self.requests[key] = self.requests.get(key, 0) + 1
+            _observe(self.latency, route, LATENCY_BUCKETS, elapsed)
+            if stats is not None:
+                _observe(self.queries, route, QUERY_COUNT_BUCKETS, stats.queries)
+                db = self.db.setdefault(route, [0.0, 0, 0])
+                db[0] += stats.seconds
+                db[1] += stats.rows
+                db[2] += stats.slow
+
+    def dumps(self):
+        with self._lock:
+            return json.dumps({'pid': self.pid, 'requests': self.requests, 'latency': self.latency,
+                               'queries': self.queries, 'db': self.db, 'statements': self.statements,
+                               'pool': get_pool().snapshot(), 'read_pool': get_pool(readonly=True).snapshot(),
+                               'writer': get_write_queue().snapshot()})
+
+
+_metrics = None
+
+def get_metrics():
+    """Return this process's metrics, starting afresh after a fork like the pool"""
+    global _metrics
+    if _metrics is None or _metrics.pid != os.getpid():
+        with _pool_lock:
+            if _metrics is None or _metrics.pid != os.getpid():
+                _metrics = RequestMetrics()
+    return _metrics
+
+def flush_metrics(force=False):
+    """Write this worker's totals to METRICS_DIR, at most every METRICS_FLUSH_MS"""
+    metrics = get_metrics()
+    now = time.monotonic()
+    if not force and now - metrics.flushed < app.config['METRICS_FLUSH_MS'] / 1000.0:
+        return
+    metrics.flushed = now
+    path = os.path.join(app.config['METRICS_DIR'], f'worker-{metrics.pid}.json')
+    try:
+        os.makedirs(app.config['METRICS_DIR'], exist_ok=True)
+        with open(path + '.tmp', 'w') as f:
+            f.write(metrics.dumps())
+        os.replace(path + '.tmp', path)
+    except OSError as e:
+        app.logger.warning("could not write metrics to %s: %s", path, e)
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def reset_metrics_dir():
+    """Remove metrics left by a previous run; gunicorn's on_starting calls this before forking"""
+    directory = app.config['METRICS_DIR']
+    if not os.path.isdir(directory):
+        return
+    for name in os.listdir(directory):
+        if name.endswith(('.json', '.tmp')):
+            try:
+                os.remove(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+
+def _fold_counters(total, snap):
+    # Counters only: an exited worker has no open connections or queued writes
+    for key, count in snap['requests'].items():
+        total['requests'][key] = total['requests'].get(key, 0) + count
+    for field in ('latency', 'queries', 'db'):
+        _sum_into(total[field], snap[field])
+    total['statements'] = [a + b for a, b in zip(total['statements'], snap['statements'])]
+    for _, key in POOL_SNAPSHOTS:
+        if key in snap:
+            for name in POOL_COUNTERS:
+                total[key][name] += snap[key][name]
+    if 'writer' in snap:
+        for name in WRITER_COUNTERS:
+            total['writer'][name] += snap['writer'][name]
+        _sum_into(total['writer']['waits'], snap['writer']['waits'])
+
+def archive_worker_metrics(pid):
+    """Fold an exited worker's file into METRICS_ARCHIVE and remove it
+
+    Called from gunicorn's child_exit hook in the master, after the worker's final flush.
+    """
+    directory = app.config['METRICS_DIR']
+    path = os.path.join(directory, f'worker-{pid}.json')
+    archive = os.path.join(directory, METRICS_ARCHIVE)
+    try:
+        with open(path) as f:
+            snap = json.load(f)
+    except (OSError, ValueError):
+        return
+    try:
+        with open(archive) as f:
+            total = json.load(f)
+    except (OSError, ValueError):
+        total = {'pid': None, 'requests': {}, 'latency': {}, 'queries': {}, 'db': {},
+                 'statements': [0, 0.0, 0], 'writer': dict.fromkeys(WRITER_COUNTERS, 0)}
+        total['writer']['waits'] = {}
+        for _, key in POOL_SNAPSHOTS:
+            total[key] = dict.fromkeys(POOL_COUNTERS, 0)
+    _fold_counters(total, snap)
+    try:
+        with open(archive + '.tmp', 'w') as f:
+            json.dump(total, f)
+        os.replace(archive + '.tmp', archive)
+        os.remove(path)
+    except OSError as e:
+        app.logger.warning("could not archive metrics of worker %s: %s", pid, e)
+
+def collect_worker_metrics():
+    """Snapshots of every worker that has written to METRICS_DIR, plus exited workers' totals"""
+    flush_metrics(force=True)
+    snapshots = []
+    try:
+        names = sorted(os.listdir(app.config['METRICS_DIR']))
+    except FileNotFoundError:
+        # Nothing flushed yet, or the flush above could not create the directory
+        names = []
+    for name in names:
+        if name == METRICS_ARCHIVE or (name.startswith('worker-') and name.endswith('.json')):
+            try:
+                with open(os.path.join(app.config['METRICS_DIR'], name)) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+    return snapshots
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _sum_into(target, source):
+    for key, values in source.items():
+        if key in target:
+            target[key] = [a + b for a, b in zip(target[key], values)]
+        else:
+            target[key] = list(values)
+
+def render_prometheus(snapshots):
+    """Prometheus text exposition for the folded worker snapshots"""
+    requests_total, latency, queries, db = {}, {}, {}, {}
+    statements = [0, 0.0, 0]
+    pools = {label: dict.fromkeys(POOL_COUNTERS, 0) for label, _ in POOL_SNAPSHOTS}
+    live = {label: {'open': 0, 'idle': 0, 'size': 0} for label, _ in POOL_SNAPSHOTS}
+    writer, write_waits, write_pending = dict.fromkeys(WRITER_COUNTERS, 0), {}, 0
+    workers = 0
+    for snap in snapshots:
+        for key, count in snap['requests'].items():
+            requests_total[key] = requests_total.get(key, 0) + count
+        _sum_into(latency, snap['latency'])
+        _sum_into(queries, snap['queries'])
+        _sum_into(db, snap['db'])
+        statements = [a + b for a, b in zip(statements, snap['statements'])]
+        alive = snap['pid'] is not None and pid_alive(snap['pid'])
+        for label, key in POOL_SNAPSHOTS:
+            if key not in snap:
+                continue
+            for name in POOL_COUNTERS:
+                pools[label][name] += snap[key][name]
+            # Counters of exited workers still count; their gauges do not
+            if alive:
+                for name in live[label]:
+                    live[label][name] += snap[key][name]
+        if 'writer' in snap:
+            for name in WRITER_COUNTERS:
+                writer[name] += snap['writer'][name]
+            _sum_into(write_waits, snap['writer']['waits'])
+            if alive:
+                write_pending += snap['writer']['pending']
+        if alive:
+            workers += 1
+
+    lines = []
+    def metric(name, kind, help_text):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+
+    def histogram(name, buckets, data, label='route'):
+        for key, counts in sorted(data.items()):
+            cumulative = 0
+            for bound, count in zip(buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{label}="{_label(key)}",le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_sum{{{label}="{_label(key)}"}} {counts[-1]}')
+            lines.append(f'{name}_count{{{label}="{_label(key)}"}} {cumulative}')
+
+    metric('library_http_requests_total', 'counter', 'Requests by route, method and status')
+    for key, count in sorted(requests_total.items()):
+        route, method, status = key.split('\t')
+        lines.append(f'library_http_requests_total{{route="{_label(route)}",method="{method}",status="{status}"}} {count}')
+    metric('library_http_request_duration_seconds', 'histogram', 'Request latency by route')
+    histogram('library_http_request_duration_seconds', LATENCY_BUCKETS, latency)
+    metric('library_db_queries_per_request', 'histogram', 'SQL statements issued per request')
+    histogram('library_db_queries_per_request', QUERY_COUNT_BUCKETS, queries)
+    for index, (name, help_text) in enumerate((
+            ('library_db_request_seconds_total', 'Time spent in SQLite per route'),
+            ('library_db_rows_total', 'Rows fetched per route'),
+            ('library_db_slow_queries_total', 'Statements over SLOW_QUERY_MS per route'))):
+        metric(name, 'counter', help_text)
+        for route, values in sorted(db.items()):
+            lines.append(f'{name}{{route="{_label(route)}"}} {values[index]}')
+    for value, (name, help_text) in zip(statements, (
+            ('library_db_statements_total', 'Statements on all connections, including background work'),
+            ('library_db_statement_seconds_total', 'Time spent in those statements'),
+            ('library_db_slow_statements_total', 'Of those, statements over SLOW_QUERY_MS'))):
+        metric(name, 'counter', help_text)
+        lines.append(f'{name} {value}')
+    for name in POOL_COUNTERS:
+        metric(f'library_db_pool_{name}_total', 'counter', f'Connection pool {name}')
+        for label, _ in POOL_SNAPSHOTS:
+            lines.append(f'library_db_pool_{name}_total{{pool="{label}"}} {pools[label][name]}')
+    metric('library_db_pool_connections', 'gauge', 'Pooled connections across live workers')
+    for label, _ in POOL_SNAPSHOTS:
+        for state, key in (('open', 'open'), ('idle', 'idle'), ('limit', 'size')):
+            lines.append(f'library_db_pool_connections{{pool="{label}",state="{state}"}} {live[label][key]}')
+    for name, help_text in (
+            ('units', 'Writes run by the per-worker writer'),
+            ('failed_units', 'Of those, writes that raised or were rolled back'),
+            ('transactions', 'Group-commit transactions'),
+            ('failed_transactions', 'Transactions that could not begin or commit'),
+            ('timeouts', 'Writes that gave up waiting in the queue')):
+        metric(f'library_db_write_{name}_total', 'counter', help_text)
+        lines.append(f'library_db_write_{name}_total {writer[name]}')
+    metric('library_db_write_wait_seconds', 'histogram',
+           'Write wait: queue = waiting for the writer, lock = BEGIN IMMEDIATE waiting for the database lock')
+    histogram('library_db_write_wait_seconds', WRITE_WAIT_BUCKETS, write_waits, label='phase')
+    metric('library_db_write_pending', 'gauge', 'Writes queued in live workers')
+    lines.append(f'library_db_write_pending {write_pending}')
+    metric('library_workers', 'gauge', 'Workers reporting metrics')
+    lines.append(f'library_workers {workers}')
+    return '\n'.join(lines) + '\n'
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    g.query_stats = QueryStats()
+
+@app.after_request
+def query_timing_headers(response):
+    g.response_status = response.status_code
+    stats = g.get('query_stats')
+    if app.debug and stats is not None:
+        elapsed = time.perf_counter() - g.request_started
+        response.headers['X-Query-Count'] = str(stats.queries)
+        response.headers['Server-Timing'] = (f'db;dur={stats.seconds * 1000.0:.2f};desc="{stats.queries} queries, '
+                                             f'{stats.rows} rows", total;dur={elapsed * 1000.0:.2f}')
+    return response
+
+@app.teardown_request
+def record_request_metrics(exc):
+    # Runs after streamed bodies finish, so their queries are included
+    started = g.pop('request_started', None)
+    if started is None:
+        return
+    status = 500 if exc is not None else g.get('response_status', 500)
+    get_metrics().observe_request(request.endpoint or 'unmatched', request.method, status,
+                                  time.perf_counter() - started, g.get('query_stats'))
+    flush_metrics()
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus scrape endpoint, covering every worker sharing METRICS_DIR"""
+    return Response(render_prometheus(collect_worker_metrics()),
+                    mimetype='text/plain; version=0.0.4')
+
 # -------------------- Error Handlers --------------------
+@app.errorhandler(sqlite3.OperationalError)
+def database_busy_error(error):
+    # Busy timeout expired or the pool ran dry; let the client retry
+    if 'locked' in str(error) or 'busy' in str(error):
+        response = jsonify({'error': 'Database is busy, please retry'})
+        response.headers['Retry-After'] = '1'
+        return response, 503
+    return jsonify({'error': 'Internal server error'}), 500
+
 @app.errorhandler(404)
 def not_found_error(error):
     return jsonify({'error': 'Page not found'}), 404
@@ -888,16 +5350,64 @@ def not_found_error(error):
 def internal_error(error):
     return jsonify({'error': 'Internal server error'}), 500
 
+# -------------------- Application Factory --------------------
+def upgrade_database():
+    """Create the database on first run, otherwise apply pending migrations
+
+    Run once per deploy, before workers start: `flask db upgrade`, as in the Procfile's
+    release step, or gunicorn's on_starting hook when DB_UPGRADE_ON_START=1. Leaves
+    no connection open, so the caller can fork safely afterwards.
+    """
+    with app.app_context():
+        c = get_db().cursor()
+        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='books'")
+        if c.fetchone() is None:
+            print("Creating new database...")
+            init_db()
+        else:
+            migrate_database()
+        version = schema_version()
+    close_pool()
+    return version
+
+@app.cli.group('db')
+def db_cli():
+    """Database schema commands"""
+
+@db_cli.command('upgrade')
+def db_upgrade_command():
+    """Create the database or apply pending migrations"""
+    print(f"✓ Database at schema version {upgrade_database()}")
+
+@db_cli.command('version')
+def db_version_command():
+    """Show the applied schema version and any pending migrations"""
+    current = schema_version()
+    print(f"Schema version {current}")
+    for version, name, _ in MIGRATIONS:
+        if version > current:
+            print(f"  pending {version}: {name}")
+
+def create_app(config=None):
+    """Entry point for `gunicorn 'app:create_app()'` and `flask --app app`
+
+    Not a real factory: routes, pools and caches belong to the one module-level app,
+    so every call returns that same object and config overrides change it for the
+    whole process. Call it once per process; tests that need other settings need a
+    separate process. It deliberately touches neither the database nor qrcode/Pillow,
+    so importing is all a worker pays at boot; schema changes are `flask db upgrade`.
+    """
+    if config:
+        app.config.update(config)
+    return app
+
 # -------------------- Main --------------------
 if __name__ == '__main__':
-    # Check if database exists, if not create it
-    if not os.path.exists('library.db'):
-        print("Creating new database...")
-        init_db()
-    else:
-        print("Database exists, checking for migrations...")
-        # Run migrations to add missing columns
-        migrate_database()
+    # The dev server has no release step, so create or migrate the database here
+    upgrade_database()
+    if os.environ.get('INDEX_ADVISOR') == '1':
+        with app.app_context():
+            print_index_report(explain_route_queries())
     
     print("Starting Library Management System...")
     print("Visit http://localhost:5000 in your browser")
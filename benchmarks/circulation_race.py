@@ -0,0 +1,172 @@
+"""Hammer one book from many threads and processes and check circulation never double-lends it.
+
+    python benchmarks/circulation_race.py [--threads 16] [--rounds 50] [--processes 8]
+
+Runs against a scratch copy of library.db (or $LIBRARY_DB). Each round every
+thread tries to borrow the same book; exactly one must win. Half the rounds
+then return it from every thread (exactly one return must succeed) and half
+use a single batch return, with one retried idempotency key per round.
+
+Threads in one process share its writer, so their borrows reach SQLite one at a
+time. The process rounds fork --processes workers, each with its own writer and
+connections like gunicorn workers, and have them borrow one book at once, so
+BEGIN IMMEDIATE and the status compare-and-set are really contended. Exactly
+one borrow must succeed and exactly one loan may be open.
+Exits non-zero on any violation.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--rounds', type=int, default=50)
+    parser.add_argument('--processes', type=int, default=8, help='Forked workers for the process rounds (0 to skip)')
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix='circulation-race-')
+    source = os.environ.get('LIBRARY_DB', os.path.join(ROOT, 'library.db'))
+    os.environ['LIBRARY_DB'] = os.path.join(scratch, 'library.db')
+    shutil.copy(source, os.environ['LIBRARY_DB'])
+    sys.path.insert(0, ROOT)
+    import app as appmod
+
+    app = appmod.app
+    with app.app_context():
+        appmod.migrate_database()
+        conn = appmod.get_db()
+        conn.execute("INSERT INTO users (username, password) VALUES ('race-librarian', ?)",
+                     (appmod.hashlib.sha256(b'race').hexdigest(),))
+        user_id = conn.execute("SELECT id FROM users WHERE username = 'race-librarian'").fetchone()[0]
+        conn.execute("INSERT INTO books (title, author, status) VALUES ('Race Copy', 'Nobody', 'Available')")
+        book_id = conn.execute("SELECT id FROM books WHERE title = 'Race Copy'").fetchone()[0]
+        conn.commit()
+
+    clients = []
+    for _ in range(args.threads):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess['user_id'] = user_id
+            sess['username'] = 'race-librarian'
+        clients.append(client)
+
+    failures = []
+    status_counts = {}
+
+    def hammer(path, payload_for):
+        barrier = threading.Barrier(len(clients))
+        statuses = [None] * len(clients)
+
+        def run(i):
+            barrier.wait()
+            response = clients[i].post(path, json=payload_for(i))
+            statuses[i] = response.status_code
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(len(clients))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for status in statuses:
+            status_counts[f'{path} {status}'] = status_counts.get(f'{path} {status}', 0) + 1
+        return statuses
+
+    started = time.perf_counter()
+    for round_no in range(args.rounds):
+        statuses = hammer('/api/borrow', lambda i: {'book_id': book_id})
+        if statuses.count(201) != 1 or statuses.count(409) != len(clients) - 1:
+            failures.append(f'round {round_no}: borrow statuses {sorted(statuses)}')
+
+        if round_no % 2:
+            statuses = hammer('/api/return', lambda i: {'book_id': book_id})
+            if statuses.count(200) != 1:
+                failures.append(f'round {round_no}: return statuses {sorted(statuses)}')
+        else:
+            key = f'bin-{round_no}'
+            first = clients[0].post('/api/return', json={'book_ids': [book_id, book_id]},
+                                    headers={'Idempotency-Key': key})
+            retry = clients[0].post('/api/return', json={'book_ids': [book_id, book_id]},
+                                    headers={'Idempotency-Key': key})
+            if first.json['returned'] != 1 or retry.json != first.json \
+                    or retry.headers.get('Idempotent-Replayed') != 'true':
+                failures.append(f'round {round_no}: batch return {first.json} / retry {retry.json}')
+    elapsed = time.perf_counter() - started
+
+    db = sqlite3.connect(os.environ['LIBRARY_DB'])
+    loans = db.execute("SELECT COUNT(*), SUM(returned_date IS NULL) FROM borrowings WHERE book_id = ?",
+                       (book_id,)).fetchone()
+    status = db.execute("SELECT status FROM books WHERE id = ?", (book_id,)).fetchone()[0]
+    if loans != (args.rounds, 0) or status != 'Available':
+        failures.append(f'final state: loans={loans} status={status}')
+
+    process_seconds = 0.0
+    if args.processes:
+        started = time.perf_counter()
+        race_processes(appmod, args.processes, args.rounds, book_id, user_id, db, failures, status_counts)
+        process_seconds = time.perf_counter() - started
+    db.close()
+    shutil.rmtree(scratch, ignore_errors=True)
+
+    print(json.dumps({'threads': args.threads, 'processes': args.processes, 'rounds': args.rounds,
+                      'seconds': round(elapsed, 2), 'process_seconds': round(process_seconds, 2),
+                      'statuses': status_counts, 'failures': failures}, indent=2))
+    return 1 if failures else 0
+
+
+def borrow_worker(appmod, rounds, book_id, user_id, barrier, results):
+    # A forked worker: its pool and writer are rebuilt for this pid, as in gunicorn
+    client = appmod.app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = user_id
+        sess['username'] = 'race-librarian'
+    for _ in range(rounds):
+        barrier.wait()
+        results.put(client.post('/api/borrow', json={'book_id': book_id}).status_code)
+        barrier.wait()
+    appmod.close_write_queue()
+
+
+def race_processes(appmod, processes, rounds, book_id, user_id, db, failures, status_counts):
+    """Every round, all workers borrow the book at once; then it is returned directly"""
+    appmod.close_pool()  # nothing open crosses the fork
+    ctx = multiprocessing.get_context('fork')
+    barrier = ctx.Barrier(processes + 1)
+    results = ctx.Queue()
+    workers = [ctx.Process(target=borrow_worker, args=(appmod, rounds, book_id, user_id, barrier, results))
+               for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    for round_no in range(rounds):
+        barrier.wait()
+        statuses = sorted(results.get(timeout=60) for _ in range(processes))
+        for status in statuses:
+            key = f'/api/borrow (processes) {status}'
+            status_counts[key] = status_counts.get(key, 0) + 1
+        open_loans = db.execute("SELECT COUNT(*) FROM borrowings WHERE book_id = ? AND returned_date IS NULL",
+                                (book_id,)).fetchone()[0]
+        if statuses.count(201) != 1 or statuses.count(409) != processes - 1 or open_loans != 1:
+            failures.append(f'process round {round_no}: borrow statuses {statuses}, open loans {open_loans}')
+        db.execute("UPDATE borrowings SET returned_date = date('now') WHERE book_id = ? AND returned_date IS NULL",
+                   (book_id,))
+        db.execute("UPDATE books SET status = 'Available' WHERE id = ?", (book_id,))
+        db.commit()
+        barrier.wait()
+    for worker in workers:
+        worker.join()
+        if worker.exitcode:
+            failures.append(f'worker exited with {worker.exitcode}')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
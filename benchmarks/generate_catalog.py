@@ -0,0 +1,275 @@
+"""Generate a synthetic library database at a chosen scale.
+
+    python benchmarks/generate_catalog.py [--books 100k] [--out PATH] [--seed 42] [--force]
+
+Books are loaded through import_books(), the same deferred-trigger path as
+`flask import-books`, so FTS, catalogue statistics, trigrams and suggestions are
+consistent. Genres, authors, borrowing popularity and reader activity are all
+Zipf-skewed, and authors mostly stay within one genre. Users, library cards,
+borrowings (returned, open and overdue) and search history scale with the
+catalogue. The same --books/--seed always gives the same data.
+Every generated user has the password BENCH_PASSWORD.
+Prints one JSON summary line.
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import random
+import sys
+import time
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_PASSWORD = 'bench'
+
+GENRES = ('Fiction', 'Mystery', 'Fantasy', 'Romance', 'Thriller', 'Science Fiction', 'Historical',
+          'Biography', 'Self-Help', 'Young Adult', 'Horror', 'Classic', 'Dystopian', 'Poetry',
+          'Travel', 'Cooking', 'History', 'Science', 'Philosophy', 'Children', 'Graphic Novel',
+          'Religion', 'Business', 'Art', 'Drama', 'Humor', 'Sports', 'Music', 'Nature', 'Novel')
+FIRST_NAMES = ('James', 'Mary', 'John', 'Patricia', 'Robert', 'Jennifer', 'Michael', 'Linda', 'David',
+               'Elizabeth', 'William', 'Barbara', 'Richard', 'Susan', 'Joseph', 'Jessica', 'Thomas',
+               'Sarah', 'Charles', 'Karen', 'Daniel', 'Nancy', 'Matthew', 'Lisa', 'Anthony', 'Betty',
+               'Mark', 'Margaret', 'Paul', 'Sandra', 'Steven', 'Ashley', 'Andrew', 'Emily', 'Kenneth',
+               'Donna', 'Joshua', 'Michelle', 'Kevin', 'Carol', 'Brian', 'Amanda', 'George', 'Melissa',
+               'Edward', 'Deborah', 'Ronald', 'Stephanie', 'Timothy', 'Rebecca', 'Haruki', 'Chimamanda',
+               'Gabriel', 'Isabel', 'Orhan', 'Elena', 'Kazuo', 'Zadie', 'Salman', 'Arundhati')
+LAST_NAMES = ('Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller', 'Davis', 'Rodriguez',
+              'Martinez', 'Hernandez', 'Lopez', 'Gonzalez', 'Wilson', 'Anderson', 'Thomas', 'Taylor',
+              'Moore', 'Jackson', 'Martin', 'Lee', 'Perez', 'Thompson', 'White', 'Harris', 'Sanchez',
+              'Clark', 'Ramirez', 'Lewis', 'Robinson', 'Walker', 'Young', 'Allen', 'King', 'Wright',
+              'Scott', 'Torres', 'Nguyen', 'Hill', 'Flores', 'Green', 'Adams', 'Nelson', 'Baker', 'Hall',
+              'Rivera', 'Campbell', 'Mitchell', 'Carter', 'Roberts', 'Okafor', 'Murakami', 'Pamuk',
+              'Ishiguro', 'Allende', 'Ferrante', 'Adichie', 'Rushdie', 'Roy', 'Marquez', 'Tolstoy',
+              'Austen', 'Dickens', 'Orwell', 'Woolf', 'Hemingway', 'Faulkner', 'Steinbeck', 'Morrison',
+              'Atwood', 'Le Guin', 'Pratchett', 'Gaiman', 'Christie', 'Sayers', 'Chandler', 'Hammett',
+              'Highsmith', 'Tartt', 'Franzen')
+ADJECTIVES = ('Silent', 'Hidden', 'Lost', 'Golden', 'Broken', 'Secret', 'Last', 'Dark', 'Burning',
+              'Forgotten', 'Crimson', 'Silver', 'Wild', 'Distant', 'Bitter', 'Quiet', 'Endless',
+              'Fallen', 'Frozen', 'Painted', 'Invisible', 'Shattered', 'Sacred', 'Wandering', 'Midnight',
+              'Hollow', 'Gentle', 'Restless', 'Electric', 'Ancient', 'Little', 'Savage', 'Velvet',
+              'Scarlet', 'Iron', 'Glass', 'Paper', 'Northern', 'Southern', 'Drowned')
+NOUNS = ('River', 'Garden', 'Empire', 'Winter', 'House', 'Storm', 'Queen', 'Letter', 'Island', 'Fire',
+         'City', 'Light', 'Stone', 'Dream', 'Wolf', 'Ocean', 'Crown', 'Forest', 'Song', 'War', 'Bridge',
+         'Memory', 'Road', 'Star', 'Mirror', 'Heart', 'King', 'Shadow', 'Night', 'Sea', 'Mountain',
+         'Daughter', 'Son', 'Station', 'Library', 'Orchard', 'Harbor', 'Kingdom', 'Clock', 'Map',
+         'Tide', 'Feather', 'Lantern', 'Voyage', 'Promise', 'Secret', 'Sister', 'Thief', 'Witness',
+         'Machine', 'Summer', 'Valley', 'Tower', 'Dragon', 'Ghost', 'Garden', 'Journey', 'Echo',
+         'Silence', 'Storm')
+TITLE_TEMPLATES = ('The {a} {n}', '{a} {n}', 'The {n} of {n2}', 'A {n} in {n2}', '{n} and {n2}',
+                   'The {a} {n} of {n2}', 'Where the {n} {v}', 'The {n2}\'s {n}', '{a} {n}s')
+VERBS = ('Falls', 'Sleeps', 'Burns', 'Waits', 'Sings', 'Breaks', 'Ends', 'Begins', 'Remembers', 'Returns')
+COVERS = tuple(f'book{i}.png' for i in range(1, 16))
+SEARCH_BY = ('title', 'title', 'title', 'author', 'author', 'genre', 'all', 'isbn')
+
+
+def parse_count(value):
+    """'10k', '2.5M', '1000' -> int"""
+    text = str(value).strip().lower().replace('_', '')
+    scale = {'k': 1000, 'm': 1000000}.get(text[-1:], 1)
+    return int(float(text.rstrip('km')) * scale)
+
+
+def count_label(n):
+    if n >= 1000000 and n % 1000000 == 0:
+        return f'{n // 1000000}m'
+    if n >= 1000 and n % 1000 == 0:
+        return f'{n // 1000}k'
+    return str(n)
+
+
+def zipf_cum_weights(n, s=1.0):
+    total, cum = 0.0, []
+    for rank in range(1, n + 1):
+        total += 1.0 / rank ** s
+        cum.append(total)
+    return cum
+
+
+def isbn13(n):
+    # 979 prefix keeps synthetic ISBNs clear of the 978 seed books
+    digits = f'979{n:09d}'
+    return digits + str(-sum(int(ch) * (3 if i % 2 else 1) for i, ch in enumerate(digits)) % 10)
+
+
+def author_names(count, rng):
+    names = [f'{first} {last}' for first, last in itertools.product(FIRST_NAMES, LAST_NAMES)]
+    if count > len(names):
+        names += [f'{first} {chr(65 + i)}. {last}'
+                  for i, first, last in itertools.product(range(26), FIRST_NAMES, LAST_NAMES)]
+    rng.shuffle(names)
+    return names[:count]
+
+
+def book_records(n, rng, today):
+    """(line_no, record, None) tuples in import_books() form"""
+    genre_cum = zipf_cum_weights(len(GENRES), 1.1)
+    authors = author_names(max(50, min(n // 8, 125000)), rng)
+    author_cum = zipf_cum_weights(len(authors), 0.9)
+    home_genre = [rng.choices(GENRES, cum_weights=genre_cum)[0] for _ in authors]
+    for i in range(n):
+        a = rng.choices(range(len(authors)), cum_weights=author_cum)[0]
+        genre = home_genre[a] if rng.random() < 0.8 else rng.choices(GENRES, cum_weights=genre_cum)[0]
+        title = rng.choice(TITLE_TEMPLATES).format(a=rng.choice(ADJECTIVES), n=rng.choice(NOUNS),
+                                                  n2=rng.choice(NOUNS), v=rng.choice(VERBS))
+        roll = rng.random()
+        yield i + 1, {
+            'title': title,
+            'author': authors[a],
+            'isbn': isbn13(i) if rng.random() < 0.95 else None,
+            'published_year': None if rng.random() < 0.03 else max(1450, today.year - int(rng.expovariate(1 / 25))),
+            'genre': genre,
+            'status': 'Reserved' if roll < 0.02 else 'Lost' if roll < 0.025 else 'Available',
+            'description': f'A {genre.lower()} story of {title.lower()}, by {authors[a]}.',
+            'cover': rng.choice(COVERS),
+        }, None
+
+
+def generate(path, books, seed=42, progress=None):
+    os.environ['LIBRARY_DB'] = path
+    # Bulk statements are slow by design here; don't log each one
+    os.environ.setdefault('SLOW_QUERY_MS', '600000')
+    sys.path.insert(0, ROOT)
+    import app as appmod
+
+    app = appmod.app
+    rng = random.Random(seed)
+    today = date.today()
+    summary = {'books': books, 'seed': seed}
+    started = time.perf_counter()
+
+    with app.app_context():
+        appmod.init_db()
+        stats = appmod.import_books(book_records(books, rng, today), progress=progress)
+    summary['import'] = stats
+
+    conn = appmod.connect_db()
+    conn.execute("PRAGMA synchronous=OFF")
+    c = conn.cursor()
+    start_id = stats['start_id']
+    # Spread created_date over ~2 years so the "recent" listings have an order
+    c.execute("""UPDATE books SET created_date = datetime('now', printf('-%d minutes', (id * 7919) % 1051200))
+                 WHERE id > ?""", (start_id,))
+    c.execute("SELECT id, status FROM books WHERE id > ? ORDER BY id", (start_id,))
+    book_rows = c.fetchall()
+    book_ids = [row['id'] for row in book_rows]
+    available = [row['id'] for row in book_rows if row['status'] == 'Available']
+
+    users = max(50, books // 20)
+    password = hashlib.sha256(BENCH_PASSWORD.encode()).hexdigest()
+    c.execute("SELECT COALESCE(MAX(id), 0) FROM users")
+    first_user = c.fetchone()[0] + 1
+    c.executemany("INSERT INTO users (username, password, email) VALUES (?, ?, ?)",
+                  ((f'reader{i:06d}', password, f'reader{i:06d}@example.org') for i in range(1, users + 1)))
+    user_ids = list(range(first_user, first_user + users))
+    summary['users'] = users
+    summary['login'] = {'username': 'reader000001', 'password': BENCH_PASSWORD, 'user_id': first_user}
+
+    cards = []
+    for i, user_id in enumerate(user_ids):
+        if i == 0 or rng.random() < 0.8:
+            issued = today - timedelta(days=rng.randint(0, 1500))
+            cards.append((user_id, 'LIB' + issued.strftime('%y%m%d') + str(user_id).zfill(4), issued.isoformat()))
+    c.executemany("INSERT INTO library_cards (user_id, card_number, issue_date) VALUES (?, ?, ?)", cards)
+    summary['library_cards'] = len(cards)
+
+    # A few books get most of the loans, a few readers do most of the borrowing
+    book_order = book_ids[:]
+    rng.shuffle(book_order)
+    book_cum = zipf_cum_weights(len(book_order), 0.8)
+    reader_order = user_ids[:]
+    rng.shuffle(reader_order)
+    reader_cum = zipf_cum_weights(len(reader_order), 0.7)
+    loan_days = app.config['LOAN_DAYS']
+
+    def history_loans(n):
+        for _ in range(n):
+            borrowed = today - timedelta(days=rng.randint(30, 1095))
+            due = borrowed + timedelta(days=loan_days)
+            returned = borrowed + timedelta(days=min(int(rng.expovariate(1 / 12)) + 1, 90))
+            fine = appmod.overdue_fine(due.isoformat(), returned)
+            yield (rng.choices(reader_order, cum_weights=reader_cum)[0],
+                   rng.choices(book_order, cum_weights=book_cum)[0],
+                   borrowed.isoformat(), due.isoformat(), returned.isoformat(), fine)
+
+    history = books * 2
+    c.executemany("""INSERT INTO borrowings (user_id, book_id, borrowed_date, due_date, returned_date, fine_amount)
+                     VALUES (?, ?, ?, ?, ?, ?)""", history_loans(history))
+
+    # Open loans: distinct books (one open loan per book), some already overdue
+    on_loan = rng.sample(available, min(len(available), max(1, books * 3 // 100)))
+    open_loans = []
+    for book_id in on_loan:
+        borrowed = today - timedelta(days=rng.randint(0, 40))
+        open_loans.append((rng.choices(reader_order, cum_weights=reader_cum)[0], book_id,
+                           borrowed.isoformat(), (borrowed + timedelta(days=loan_days)).isoformat()))
+    c.executemany("""INSERT INTO borrowings (user_id, book_id, borrowed_date, due_date)
+                     VALUES (?, ?, ?, ?)""", open_loans)
+    c.executemany("UPDATE books SET status = ? WHERE id = ?", ((appmod.ON_LOAN_STATUS, b) for b in on_loan))
+    summary['borrowings'] = {'returned': history, 'open': len(open_loans),
+                             'overdue': sum(1 for loan in open_loans if loan[3] < today.isoformat())}
+
+    # Search history: title words, author surnames, genres and the odd ISBN
+    c.execute("SELECT title, author, isbn FROM books WHERE id IN (SELECT value FROM json_each(?))",
+              (json.dumps(rng.sample(book_ids, min(len(book_ids), 2000))),))
+    sample = c.fetchall()
+    genre_cum = zipf_cum_weights(len(GENRES), 1.1)
+
+    def searches(n):
+        for _ in range(n):
+            by = rng.choice(SEARCH_BY)
+            row = rng.choice(sample)
+            if by == 'author':
+                term = row['author'].split()[-1]
+            elif by == 'genre':
+                term = rng.choices(GENRES, cum_weights=genre_cum)[0]
+            elif by == 'isbn':
+                term = row['isbn'] or ''
+            else:
+                term = ' '.join(row['title'].split()[-rng.randint(1, 2):])
+            when = f'{today - timedelta(days=rng.randint(0, 89))} {rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:00'
+            yield rng.choices(reader_order, cum_weights=reader_cum)[0], term, by, when
+
+    c.executemany("INSERT INTO search_history (user_id, search_term, search_by, search_date) VALUES (?, ?, ?, ?)",
+                  searches(books))
+    summary['search_history'] = books
+    conn.commit()
+    c.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+
+    summary['seconds'] = round(time.perf_counter() - started, 1)
+    summary['db_bytes'] = os.path.getsize(path)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--books', default='10k', help='catalogue size, e.g. 10k, 100k, 1m')
+    parser.add_argument('--out', help='database path (default cache/bench/library-<books>.db)')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--force', action='store_true', help='overwrite an existing database')
+    args = parser.parse_args()
+
+    books = parse_count(args.books)
+    path = os.path.abspath(args.out or os.path.join(ROOT, 'cache', 'bench', f'library-{count_label(books)}.db'))
+    if os.path.exists(path):
+        if not args.force:
+            print(f'{path} exists; use --force to overwrite', file=sys.stderr)
+            return 1
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def progress(stats, elapsed):
+        print(f'  {stats["read"]:,} books in {elapsed:.0f}s', file=sys.stderr)
+
+    summary = generate(path, books, args.seed, progress)
+    summary['path'] = path
+    print(json.dumps(summary))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,182 @@
+"""Mixed read/write load: do writes stall reads or fail with "database is locked"?
+
+    python benchmarks/mixed_load.py [--books 10k] [--write-ratio 0.05] [--duration 20]
+                                    [--workers 4] [--threads 4] [--concurrency 16]
+
+Runs gunicorn (gthread workers, so requests inside one worker overlap) against a
+scratch copy of the synthetic catalogue. --concurrency driver processes run for
+--duration seconds. Each request is a write with probability --write-ratio: a checkout
+of a random book, or a return of one the driver holds. Every other request is a
+read from the cheap listing/search scenarios in run_suite.py.
+
+The JSON printed at the end has:
+- reads and writes: latency summaries;
+- busy: 503 "database is busy" responses;
+- errors: other 5xx responses and failed connections. A 409 for a book that is
+  already out is a normal answer and does not count;
+- writer: group-commit counters and lock/queue wait totals scraped from /metrics.
+  These are missing on trees that predate the writer queue.
+
+Run it on two checkouts to compare them.
+"""
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import urlencode
+
+from generate_catalog import ROOT, count_label, parse_count
+from run_suite import SCENARIOS, catalogue_context, free_port, login_cookie, start_gunicorn, summarize
+
+READS = ('books', 'api_books_title', 'book_details', 'quick_search', 'search_stats', 'suggest', 'search_title')
+
+
+def request(conn, port, method, path, body, headers):
+    """Send one request on a kept-alive connection; returns (conn, status or None)"""
+    try:
+        if conn is None:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+        conn.request(method, path, body=body, headers=headers)
+        response = conn.getresponse()
+        response.read()
+        if response.will_close:
+            conn.close()
+            conn = None
+        return conn, response.status
+    except (OSError, http.client.HTTPException):
+        if conn is not None:
+            conn.close()
+        return None, None
+
+
+def drive(job):
+    port, cookie, ctx, seconds, write_ratio, seed = job
+    rng = random.Random(seed)
+    held = []
+    out = {'reads': [], 'writes': [], 'busy': 0, 'errors': 0, 'conflicts': 0}
+    conn = None
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        headers = {'Cookie': cookie}
+        if rng.random() < write_ratio:
+            kind = 'writes'
+            if held and rng.random() < 0.5:
+                book_id = held.pop(rng.randrange(len(held)))
+                method, path, body = 'POST', '/api/return', json.dumps({'book_id': book_id})
+            else:
+                book_id = rng.randint(1, ctx['max_book_id'])
+                method, path, body = 'POST', '/api/borrow', json.dumps({'book_id': book_id})
+            headers['Content-Type'] = 'application/json'
+        else:
+            kind = 'reads'
+            method, path, form = SCENARIOS[rng.choice(READS)][0](ctx, rng)
+            body = None
+            if form is not None:
+                body = urlencode(form, doseq=True)
+                headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        started = time.perf_counter()
+        conn, status = request(conn, port, method, path, body, headers)
+        elapsed = time.perf_counter() - started
+        if status == 503:
+            out['busy'] += 1
+        elif status is None or status >= 500:
+            out['errors'] += 1
+        elif status == 409:
+            out['conflicts'] += 1
+        else:
+            out[kind].append(elapsed)
+            if path == '/api/borrow' and status == 201:
+                held.append(book_id)
+    if conn is not None:
+        conn.close()
+    return out
+
+
+def scrape_writer(port):
+    """Writer counters and wait totals from /metrics, or None before the writer queue existed"""
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    conn.request('GET', '/metrics')
+    text = conn.getresponse().read().decode()
+    found = {}
+    for name, phase, value in re.findall(r'^library_db_write_(\w+?)(?:\{phase="(\w+)"\})? (\S+)$', text, re.M):
+        found[f'{name}[{phase}]' if phase else name] = float(value)
+    if not found:
+        return None
+    for phase in ('queue', 'lock'):
+        count = found.get(f'wait_seconds_count[{phase}]', 0)
+        if count:
+            found[f'{phase}_wait_mean_ms'] = round(found[f'wait_seconds_sum[{phase}]'] / count * 1000, 3)
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--books', default='10k')
+    parser.add_argument('--db', help='use this database instead of a generated one')
+    parser.add_argument('--write-ratio', type=float, default=0.05)
+    parser.add_argument('--duration', type=float, default=20.0)
+    parser.add_argument('--warmup-seconds', type=float, default=2.0)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=4, help='gthread threads per worker')
+    parser.add_argument('--concurrency', type=int, default=16, help='driver processes')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    label = count_label(parse_count(args.books))
+    source = args.db or os.path.join(ROOT, 'cache', 'bench', f'library-{label}.db')
+    if not os.path.exists(source):
+        print(f'Generating {label} catalogue at {source}', file=sys.stderr)
+        subprocess.run([sys.executable, os.path.join(ROOT, 'benchmarks', 'generate_catalog.py'),
+                        '--books', args.books, '--seed', str(args.seed), '--out', source], check=True)
+
+    scratch = tempfile.mkdtemp(prefix='bench-mixed-')
+    try:
+        db = os.path.join(scratch, 'library.db')
+        shutil.copy(source, db)
+        ctx = catalogue_context(db)
+        port = free_port()
+        server = start_gunicorn(scratch, db, args.workers, port,
+                                extra_args=('--worker-class', 'gthread', '--threads', str(args.threads)))
+        try:
+            cookie = login_cookie(port, ctx['username'])
+            with multiprocessing.Pool(args.concurrency) as pool:
+                jobs = [(port, cookie, ctx, args.warmup_seconds, 0.0, args.seed + i) for i in range(args.concurrency)]
+                pool.map(drive, jobs)
+                started = time.perf_counter()
+                jobs = [(port, cookie, ctx, args.duration, args.write_ratio, args.seed + i)
+                        for i in range(args.concurrency)]
+                outcomes = pool.map(drive, jobs)
+                elapsed = time.perf_counter() - started
+            writer = scrape_writer(port)
+        finally:
+            server.terminate()
+            server.wait(timeout=30)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    busy = sum(o['busy'] for o in outcomes)
+    errors = sum(o['errors'] for o in outcomes)
+    results = {
+        'settings': {'books': ctx['books'], 'write_ratio': args.write_ratio, 'duration': args.duration,
+                     'workers': args.workers, 'threads': args.threads, 'concurrency': args.concurrency},
+        'reads': summarize([v for o in outcomes for v in o['reads']], 0, elapsed),
+        'writes': summarize([v for o in outcomes for v in o['writes']], 0, elapsed),
+        'conflicts': sum(o['conflicts'] for o in outcomes),
+        'busy': busy,
+        'errors': errors,
+        'writer': writer,
+    }
+    print(json.dumps(results, indent=2))
+    return 1 if busy or errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,406 @@
+"""Benchmark the real app against a synthetic catalogue and store the results as JSON.
+
+    python benchmarks/run_suite.py [--books 10k] [--mode client|http|both] [--only NAMES]
+                                   [--requests 200] [--duration 10] [--workers 4] [--concurrency 8]
+                                   [--out FILE] [--baseline FILE] [--tolerance 0.15]
+    python benchmarks/run_suite.py --compare OLD.json NEW.json
+
+The catalogue comes from generate_catalog.py. It is built on first use and cached as
+cache/bench/library-<books>.db. Every run works on a scratch copy with its own
+cache directories, so results do not depend on the runs before it.
+
+client  Flask test client, in process, one request at a time. Measures app and
+        database time without HTTP or process overhead.
+http    gunicorn with --workers on a free local port. --concurrency driver processes
+        send requests for --duration seconds per scenario, after a short warm-up.
+
+Both modes log in as the first generated reader. Each scenario reports requests, errors,
+throughput and p50/p90/p99/max latency. Results go to
+benchmarks/results/<commit>[-dirty]-<books>.json. With --baseline, each scenario is
+compared with the baseline, and the script exits 1 if p50 or throughput got worse
+by more than --tolerance.
+"""
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from urllib.parse import quote, urlencode
+
+from generate_catalog import BENCH_PASSWORD, ROOT, count_label, parse_count
+
+QUICK_TYPES = ('available', 'recent', 'fiction', 'popular', 'new')
+
+
+def typo(word, rng):
+    """Swap two neighbouring letters or drop one, like a hurried search"""
+    i = rng.randrange(len(word) - 1)
+    if rng.random() < 0.5:
+        return word[:i] + word[i + 1] + word[i] + word[i + 2:]
+    return word[:i] + word[i + 1:]
+
+
+def search(**form):
+    return 'POST', '/search', form
+
+
+# name -> (request builder, heavy); heavy scenarios get a tenth of --requests in client mode
+SCENARIOS = {
+    'home': (lambda ctx, rng: ('GET', '/', None), False),
+    'books': (lambda ctx, rng: ('GET', '/books', None), False),
+    'api_books_title': (lambda ctx, rng: ('GET', '/api/books?sort=title&limit=50', None), False),
+    'search_title': (lambda ctx, rng: search(search_term=rng.choice(ctx['words']), search_by='title'), False),
+    'search_author': (lambda ctx, rng: search(search_term=rng.choice(ctx['surnames']), search_by='author'), False),
+    'search_all_by_year': (lambda ctx, rng: search(search_term=rng.choice(ctx['words']), search_by='all',
+                                                   sort_by='year'), False),
+    'search_filtered': (lambda ctx, rng: search(search_term=rng.choice(ctx['genres']), search_by='genre',
+                                                **{'status[]': ['Available']}, year_from='1990',
+                                                year_to='2020', sort_by='title'), False),
+    'search_fuzzy': (lambda ctx, rng: search(search_term=typo(rng.choice(ctx['words']), rng), search_by='title',
+                                             fuzzy='1'), False),
+    'suggest': (lambda ctx, rng: ('GET', '/api/suggest?q=' + quote(rng.choice(ctx['words'])[:rng.randint(2, 4)]),
+                                  None), False),
+    'quick_search': (lambda ctx, rng: ('GET', f'/api/quick_search/{rng.choice(QUICK_TYPES)}', None), False),
+    'quick_search_text': (lambda ctx, rng: ('GET', '/api/quick_search/text?q=' + quote(rng.choice(ctx['words'])),
+                                            None), False),
+    'search_stats': (lambda ctx, rng: ('GET', '/api/search_stats', None), False),
+    'book_details': (lambda ctx, rng: ('GET', f'/api/book/{rng.randint(1, ctx["max_book_id"])}', None), False),
+    'book_batch_20': (lambda ctx, rng: ('GET', '/api/books/batch?fields=title,author,cover&embed=availability&ids='
+                                        + ','.join(str(rng.randint(1, ctx['max_book_id'])) for _ in range(20)),
+                                        None), False),
+    'export_csv': (lambda ctx, rng: ('GET', '/export/search_results?format=csv&search_by=genre&search_term='
+                                     + quote(rng.choice(ctx['genres'])), None), True),
+    'export_jsonl_gzip': (lambda ctx, rng: ('GET', '/export/search_results?format=jsonl&gzip=1&search_by=title'
+                                            '&search_term=' + quote(rng.choice(ctx['words'])), None), True),
+    'card_qr_png': (lambda ctx, rng: ('GET', f'/card_qr/{rng.choice(ctx["card_users"])}.png', None), False),
+    'generate_qr': (lambda ctx, rng: ('GET', f'/generate_qr/{rng.choice(ctx["card_users"])}', None), False),
+}
+
+
+def catalogue_context(db):
+    """Search terms, ids and the login drawn deterministically from the database"""
+    conn = sqlite3.connect(db)
+    max_id = conn.execute("SELECT MAX(id) FROM books").fetchone()[0]
+    step = max(1, max_id // 500)
+    rows = conn.execute("SELECT title, author FROM books WHERE id % ? = 0 LIMIT 500", (step,)).fetchall()
+    words = sorted({w.strip("'s,.:").lower() for title, _ in rows for w in title.split() if len(w) >= 4})
+    ctx = {
+        'max_book_id': max_id,
+        'words': words,
+        'surnames': sorted({author.split()[-1] for _, author in rows}),
+        'genres': [g for (g,) in conn.execute("SELECT DISTINCT genre FROM books WHERE genre IS NOT NULL ORDER BY genre")],
+        'card_users': [u for (u,) in conn.execute("SELECT user_id FROM library_cards ORDER BY user_id LIMIT 20")],
+        'username': conn.execute("SELECT username FROM users WHERE username LIKE 'reader%' ORDER BY id LIMIT 1")
+                        .fetchone()[0],
+        'books': conn.execute("SELECT COUNT(*) FROM books").fetchone()[0],
+    }
+    conn.close()
+    return ctx
+
+
+def percentile(samples, pct):
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))] if samples else 0.0
+
+
+def summarize(latencies, errors, seconds):
+    latencies.sort()
+    ms = lambda v: round(v * 1000.0, 3)  # noqa: E731
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'seconds': round(seconds, 3),
+        'rps': round(len(latencies) / seconds, 1) if seconds else 0.0,
+        'mean_ms': ms(sum(latencies) / len(latencies)) if latencies else 0.0,
+        'p50_ms': ms(percentile(latencies, 50)),
+        'p90_ms': ms(percentile(latencies, 90)),
+        'p99_ms': ms(percentile(latencies, 99)),
+        'max_ms': ms(latencies[-1]) if latencies else 0.0,
+    }
+
+
+def report(mode, name, result):
+    print(f"  {mode:6} {name:20} {result['requests']:7d} req {result['errors']:5d} err "
+          f"{result['rps']:9.1f}/s  p50 {result['p50_ms']:8.2f}  p99 {result['p99_ms']:8.2f} ms", file=sys.stderr)
+
+
+def scratch_env(scratch, db):
+    return {'LIBRARY_DB': db,
+            'QR_CACHE_DIR': os.path.join(scratch, 'qr'),
+            'THUMBNAIL_DIR': os.path.join(scratch, 'thumbnails'),
+            'IMPORT_DIR': os.path.join(scratch, 'imports'),
+            'METRICS_DIR': os.path.join(scratch, 'metrics'),
+            'SLOW_QUERY_MS': os.environ.get('SLOW_QUERY_MS', '1000'),
+            'LOG_LEVEL': os.environ.get('LOG_LEVEL', 'WARNING')}
+
+
+def run_client(scratch, db, ctx, names, requests, warmup, seed):
+    os.environ.update(scratch_env(scratch, db))
+    sys.path.insert(0, ROOT)
+    import app as appmod
+
+    client = appmod.app.test_client()
+    response = client.post('/login', data={'username': ctx['username'], 'password': BENCH_PASSWORD})
+    if response.status_code != 302:
+        raise SystemExit(f'login failed: {response.status_code}')
+    results = {}
+    for name in names:
+        build, heavy = SCENARIOS[name]
+        rng = random.Random(seed)
+        count = max(5, requests // 10) if heavy else requests
+        latencies, errors, total = [], 0, 0.0
+        for i in range(warmup + count):
+            method, path, form = build(ctx, rng)
+            started = time.perf_counter()
+            response = client.open(path, method=method, data=form)
+            response.get_data()
+            response.close()
+            elapsed = time.perf_counter() - started
+            if i < warmup:
+                continue
+            total += elapsed
+            if response.status_code >= 400:
+                errors += 1
+            else:
+                latencies.append(elapsed)
+        results[name] = summarize(latencies, errors, total)
+        report('client', name, results[name])
+    appmod.flush_search_history()
+    return results
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_gunicorn(scratch, db, workers, port, timeout=180, extra_args=()):
+    env = dict(os.environ, **scratch_env(scratch, db))
+    proc = subprocess.Popen([sys.executable, '-m', 'gunicorn', 'app:app', '--workers', str(workers),
+                             '--bind', f'127.0.0.1:{port}', '--log-level', 'warning', *extra_args],
+                            cwd=ROOT, env=env)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f'gunicorn exited with {proc.returncode}')
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            conn.request('GET', '/api/search_stats')
+            if conn.getresponse().status == 200:
+                return proc
+        except OSError:
+            pass
+        time.sleep(0.2)
+    proc.terminate()
+    raise SystemExit('gunicorn did not come up')
+
+
+def login_cookie(port, username):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    conn.request('POST', '/login', body=urlencode({'username': username, 'password': BENCH_PASSWORD}),
+                 headers={'Content-Type': 'application/x-www-form-urlencoded'})
+    response = conn.getresponse()
+    response.read()
+    cookie = response.getheader('Set-Cookie')
+    if response.status != 302 or not cookie:
+        raise SystemExit(f'login failed: {response.status}')
+    return cookie.split(';', 1)[0]
+
+
+def drive(job):
+    """One driver process: send requests for `seconds`, return (latencies, errors)"""
+    name, port, cookie, ctx, seconds, seed = job
+    build = SCENARIOS[name][0]
+    rng = random.Random(seed)
+    latencies, errors, conn = [], 0, None
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        method, path, form = build(ctx, rng)
+        headers = {'Cookie': cookie}
+        body = None
+        if form is not None:
+            body = urlencode(form, doseq=True)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        started = time.perf_counter()
+        try:
+            if conn is None:
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            ok = response.status < 400
+            # gunicorn's sync workers close after every response
+            if response.will_close:
+                conn.close()
+                conn = None
+        except (OSError, http.client.HTTPException):
+            ok = False
+            if conn is not None:
+                conn.close()
+            conn = None
+        if ok:
+            latencies.append(time.perf_counter() - started)
+        else:
+            errors += 1
+    if conn is not None:
+        conn.close()
+    return latencies, errors
+
+
+def run_http(scratch, db, ctx, names, workers, concurrency, duration, warmup, seed):
+    port = free_port()
+    server = start_gunicorn(scratch, db, workers, port)
+    results = {}
+    try:
+        cookie = login_cookie(port, ctx['username'])
+        with multiprocessing.Pool(concurrency) as pool:
+            for name in names:
+                if warmup:
+                    pool.map(drive, [(name, port, cookie, ctx, warmup, seed + i) for i in range(concurrency)])
+                started = time.perf_counter()
+                outcomes = pool.map(drive, [(name, port, cookie, ctx, duration, seed + i) for i in range(concurrency)])
+                elapsed = time.perf_counter() - started
+                latencies = [v for lat, _ in outcomes for v in lat]
+                results[name] = summarize(latencies, sum(err for _, err in outcomes), elapsed)
+                report('http', name, results[name])
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+    return results
+
+
+def git_state():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short=12', 'HEAD'], cwd=ROOT, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT,
+                                    capture_output=True, text=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        commit, dirty = 'unknown', False
+    return commit, dirty
+
+
+def compare(baseline, current, tolerance):
+    """Print per-scenario deltas; return the regressed scenarios"""
+    regressions = []
+    for mode, run in current['runs'].items():
+        old_run = baseline.get('runs', {}).get(mode)
+        if not old_run:
+            continue
+        for name, new in run['scenarios'].items():
+            old = old_run['scenarios'].get(name)
+            if not old or not old['requests'] or not new['requests']:
+                continue
+            p50 = new['p50_ms'] / old['p50_ms'] - 1 if old['p50_ms'] else 0.0
+            rps = new['rps'] / old['rps'] - 1 if old['rps'] else 0.0
+            regressed = p50 > tolerance or rps < -tolerance
+            if regressed:
+                regressions.append(f'{mode}/{name}')
+            print(f"{mode:6} {name:20} p50 {old['p50_ms']:8.2f} -> {new['p50_ms']:8.2f} ms ({p50:+6.1%})  "
+                  f"rps {old['rps']:9.1f} -> {new['rps']:9.1f} ({rps:+6.1%}){'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--books', default='10k', help='catalogue size, e.g. 10k, 100k, 1m')
+    parser.add_argument('--db', help='use this database instead of a generated one')
+    parser.add_argument('--mode', choices=('client', 'http', 'both'), default='both')
+    parser.add_argument('--only', help='comma-separated scenarios (default: all)')
+    parser.add_argument('--requests', type=int, default=200, help='client mode: requests per scenario')
+    parser.add_argument('--warmup', type=int, default=10, help='client mode: unmeasured requests per scenario')
+    parser.add_argument('--duration', type=float, default=10.0, help='http mode: seconds per scenario')
+    parser.add_argument('--warmup-seconds', type=float, default=1.0, help='http mode: warm-up per scenario')
+    parser.add_argument('--workers', type=int, default=4, help='http mode: gunicorn workers')
+    parser.add_argument('--concurrency', type=int, default=8, help='http mode: driver processes')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--out', help='results file (default benchmarks/results/<commit>-<books>.json)')
+    parser.add_argument('--baseline', help='earlier results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='allowed p50/throughput regression')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two results files and exit')
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            baseline = json.load(f)
+        with open(args.compare[1]) as f:
+            current = json.load(f)
+        return 1 if compare(baseline, current, args.tolerance) else 0
+
+    names = args.only.split(',') if args.only else list(SCENARIOS)
+    unknown = [n for n in names if n not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)} (choose from {', '.join(SCENARIOS)})")
+
+    books = parse_count(args.books)
+    label = count_label(books)
+    source = args.db or os.path.join(ROOT, 'cache', 'bench', f'library-{label}.db')
+    if not os.path.exists(source):
+        print(f'Generating {label} catalogue at {source}', file=sys.stderr)
+        subprocess.run([sys.executable, os.path.join(ROOT, 'benchmarks', 'generate_catalog.py'),
+                        '--books', str(books), '--seed', str(args.seed), '--out', source], check=True)
+
+    scratch = tempfile.mkdtemp(prefix='bench-suite-')
+    try:
+        runs = {}
+        ctx = catalogue_context(source)
+        modes = ('client', 'http') if args.mode == 'both' else (args.mode,)
+        for mode in modes:
+            # Fresh copy per mode: searches append to history and must not carry over
+            db = os.path.join(scratch, mode, 'library.db')
+            os.makedirs(os.path.dirname(db))
+            shutil.copy(source, db)
+            if mode == 'client':
+                settings = {'requests': args.requests, 'warmup': args.warmup}
+                # Separate process so the app module is imported against this copy only
+                with multiprocessing.get_context('spawn').Pool(1) as pool:
+                    scenarios = pool.apply(run_client, (os.path.join(scratch, mode), db, ctx, names,
+                                                        args.requests, args.warmup, args.seed))
+            else:
+                settings = {'workers': args.workers, 'concurrency': args.concurrency,
+                            'duration': args.duration, 'warmup_seconds': args.warmup_seconds}
+                scenarios = run_http(os.path.join(scratch, mode), db, ctx, names, args.workers,
+                                     args.concurrency, args.duration, args.warmup_seconds, args.seed)
+            runs[mode] = {'settings': settings, 'scenarios': scenarios}
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    commit, dirty = git_state()
+    results = {
+        'commit': commit,
+        'dirty': dirty,
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'catalogue': {'books': ctx['books'], 'source': os.path.basename(source), 'seed': args.seed},
+        'runs': runs,
+    }
+    out = args.out or os.path.join(ROOT, 'benchmarks', 'results', f"{commit}{'-dirty' if dirty else ''}-{label}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(out)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(json.load(f), results, args.tolerance)
+        if regressions:
+            print(f"Regressed beyond {args.tolerance:.0%}: {', '.join(regressions)}", file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
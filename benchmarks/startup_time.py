@@ -0,0 +1,164 @@
+"""Measure import time, first-request latency and gunicorn boot with and without --preload.
+
+    python benchmarks/startup_time.py [--runs 5] [--workers 4] [--db PATH]
+
+Runs against a scratch copy of library.db (or $LIBRARY_DB / --db). It measures:
+- import: fresh interpreters timing `import app`, and whether qrcode/PIL got loaded;
+- first_request: in one fresh interpreter, the first /, /api/search_stats and
+  /card_qr/<id>.png (the QR request pays the lazy qrcode/Pillow import);
+- gunicorn: seconds from spawn to the first 200, plus total PSS (proportional set
+  size) of master and workers. PSS splits shared pages between processes, so
+  preload shows up as the lower total.
+Prints one JSON document.
+"""
+import argparse
+import http.client
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_PROBE = """
+import sys, time, json
+started = time.perf_counter()
+import app
+print(json.dumps({'seconds': time.perf_counter() - started,
+                  'qrcode': 'qrcode' in sys.modules, 'PIL': 'PIL' in sys.modules}))
+"""
+
+FIRST_REQUEST_PROBE = """
+import sys, time, json
+import app as appmod
+app = appmod.create_app({'TESTING': True})
+with app.app_context():
+    conn = appmod.get_db()
+    user_id = conn.execute("SELECT user_id FROM library_cards ORDER BY user_id LIMIT 1").fetchone()
+client = app.test_client()
+timings = {}
+for path in ('/', '/api/search_stats'):
+    started = time.perf_counter()
+    status = client.get(path).status_code
+    timings[path] = (status, time.perf_counter() - started)
+if user_id is not None:
+    with client.session_transaction() as sess:
+        sess['user_id'] = user_id[0]
+        sess['username'] = 'startup'
+    path = f'/card_qr/{user_id[0]}.png'
+    started = time.perf_counter()
+    status = client.get(path).status_code
+    timings['/card_qr/<id>.png'] = (status, time.perf_counter() - started)
+timings['qrcode_loaded'] = 'qrcode' in sys.modules
+print(json.dumps(timings))
+"""
+
+
+def run_probe(code, env):
+    out = subprocess.run([sys.executable, '-c', code], cwd=ROOT, env=env, capture_output=True, text=True,
+                         check=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def pss_kb(pid):
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            for line in f:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def children(pid):
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            return [int(p) for p in f.read().split()]
+    except OSError:
+        return []
+
+
+def gunicorn_boot(env, workers, preload):
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    env = dict(env, PRELOAD_APP='1' if preload else '0')
+    started = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, '-m', 'gunicorn', 'app:create_app()', '--workers', str(workers),
+                             '--bind', f'127.0.0.1:{port}', '--log-level', 'warning'],
+                            cwd=ROOT, env=env, stdout=subprocess.DEVNULL)
+    try:
+        ready = None
+        while time.perf_counter() - started < 120 and proc.poll() is None:
+            try:
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+                conn.request('GET', '/api/search_stats')
+                if conn.getresponse().status == 200:
+                    ready = time.perf_counter() - started
+                    break
+            except OSError:
+                time.sleep(0.02)
+        # Let every worker finish booting and serve once before sampling memory
+        deadline = time.perf_counter() + 10
+        while len(children(proc.pid)) < workers and time.perf_counter() < deadline:
+            time.sleep(0.1)
+        for _ in range(workers * 4):
+            try:
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+                conn.request('GET', '/')
+                conn.getresponse().read()
+            except OSError:
+                pass
+        pids = [proc.pid] + children(proc.pid)
+        pss = [pss_kb(pid) for pid in pids]
+        return {'ready_seconds': round(ready, 3) if ready else None,
+                'processes': len(pids),
+                'pss_total_mb': round(sum(p for p in pss if p) / 1024, 1) if any(pss) else None}
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--db', help='database to copy (default $LIBRARY_DB or library.db)')
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix='startup-time-')
+    try:
+        db = os.path.join(scratch, 'library.db')
+        shutil.copy(args.db or os.environ.get('LIBRARY_DB', os.path.join(ROOT, 'library.db')), db)
+        env = dict(os.environ, LIBRARY_DB=db, LOG_LEVEL='WARNING',
+                   QR_CACHE_DIR=os.path.join(scratch, 'qr'), METRICS_DIR=os.path.join(scratch, 'metrics'))
+        subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'db', 'upgrade'], cwd=ROOT, env=env,
+                       check=True, stdout=subprocess.DEVNULL)
+
+        imports = [run_probe(IMPORT_PROBE, env) for _ in range(args.runs)]
+        first = run_probe(FIRST_REQUEST_PROBE, env)
+        results = {
+            'import': {'median_ms': round(statistics.median(r['seconds'] for r in imports) * 1000, 1),
+                       'min_ms': round(min(r['seconds'] for r in imports) * 1000, 1),
+                       'qrcode_loaded': imports[0]['qrcode'], 'pil_loaded': imports[0]['PIL']},
+            'first_request_ms': {path: {'status': status, 'ms': round(seconds * 1000, 1)}
+                                 for path, (status, seconds) in
+                                 ((k, v) for k, v in first.items() if k != 'qrcode_loaded')},
+            'gunicorn': {'workers': args.workers,
+                         'preload': gunicorn_boot(env, args.workers, True),
+                         'no_preload': gunicorn_boot(env, args.workers, False)},
+        }
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    print(json.dumps(results, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,103 @@
+"""Build the typeahead prefix index over a synthetic catalogue and time lookups.
+
+    python benchmarks/suggest_1m.py [--titles 1000000] [--queries 100000] [--max-mb 320]
+
+Prints one JSON line: build time, estimated and measured index size, p50/p99 latency.
+Exits non-zero if the measured size is over the --max-mb budget (default
+SUGGEST_FIELD_MAX_MB); lower it to see the heaviest terms kept and the rest
+counted as over_budget.
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import PrefixIndex, suggest_term, app  # noqa: E402
+
+WORDS = ('shadow', 'river', 'night', 'garden', 'empire', 'secret', 'winter', 'silver', 'house',
+         'storm', 'queen', 'last', 'letter', 'island', 'fire', 'glass', 'city', 'light', 'stone',
+         'dream', 'wolf', 'ocean', 'crown', 'forest', 'song', 'war', 'bridge', 'memory', 'road',
+         'star', 'mirror', 'heart', 'iron', 'lost', 'golden', 'dark', 'hidden', 'broken', 'king')
+ARTICLES = ('The ', 'A ', '', '', '')
+
+
+def synthetic_titles(n, seed):
+    rng = random.Random(seed)
+    values = {}
+    for i in range(n):
+        title = rng.choice(ARTICLES) + ' '.join(rng.choice(WORDS).title()
+                                                for _ in range(rng.randint(1, 4)))
+        # Suffix keeps titles mostly distinct, like a real catalogue
+        if rng.random() < 0.9:
+            title += f' {i}'
+        term = suggest_term(title)
+        entry = values.get(term)
+        if entry is None:
+            values[term] = [title, 1]
+        else:
+            entry[1] += 1
+    # Zipf-ish search popularity on a slice of titles
+    terms = list(values)
+    searches = {rng.choice(terms): int(1000 / rank) for rank in range(1, 5000)}
+    return values, searches
+
+
+def percentile(samples, pct):
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--titles', type=int, default=1000000)
+    parser.add_argument('--queries', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--max-mb', type=int, default=app.config['SUGGEST_FIELD_MAX_MB'])
+    args = parser.parse_args()
+
+    values, searches = synthetic_titles(args.titles, args.seed)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    started = time.perf_counter()
+    max_bytes = args.max_mb * 2**20
+    index = PrefixIndex.build('title', values, searches, max_bytes)
+    build_seconds = time.perf_counter() - started
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    rng = random.Random(args.seed + 1)
+    keys = index._keys
+    prefixes = [keys[rng.randrange(len(keys))][:rng.randint(1, 8)] for _ in range(args.queries)]
+    latencies = []
+    for prefix in prefixes:
+        t = time.perf_counter()
+        index.suggest(prefix, 8)
+        latencies.append(time.perf_counter() - t)
+    latencies.sort()
+    measured = index.approx_bytes()
+
+    print(json.dumps({
+        'titles': args.titles,
+        'terms': len(index.books),
+        'keys': len(index._keys),
+        'build_seconds': round(build_seconds, 2),
+        'over_budget': index.over_budget,
+        'max_mb': args.max_mb,
+        'estimated_index_mb': round(index.bytes / 2**20, 1),
+        'approx_index_mb': round(measured / 2**20, 1),
+        'max_rss_growth_mb': round((rss_after - rss_before) / 1024, 1),
+        'queries': args.queries,
+        'p50_us': round(percentile(latencies, 50) * 1e6, 1),
+        'p99_us': round(percentile(latencies, 99) * 1e6, 1),
+        'max_us': round(latencies[-1] * 1e6, 1),
+    }))
+
+
+    return 1 if measured > max_bytes else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,39 @@
+# Picked up automatically by `gunicorn 'app:create_app()'` from the project directory
+import os
+
+# Import the app once in the master so workers share its pages copy-on-write.
+# Safe because connections, pools and background threads are created per process.
+preload_app = os.environ.get('PRELOAD_APP', '1') != '0'
+
+
+def on_starting(server):
+    # Migrations belong to the release step (`flask db upgrade` in the Procfile). Set
+    # DB_UPGRADE_ON_START=1 where there is none; runs in the master before any fork.
+    if os.environ.get('DB_UPGRADE_ON_START') == '1':
+        from app import upgrade_database
+        upgrade_database()
+    # Counters restart with the server; drop files left by the previous run's workers
+    from app import reset_metrics_dir
+    reset_metrics_dir()
+
+
+def post_worker_init(worker):
+    # Build the suggestion index in the background; /api/suggest reads SQL until it is ready
+    from app import warm_suggestions
+    warm_suggestions()
+
+
+def worker_exit(server, worker):
+    # Write out buffered search history, queued writes and metrics before the worker goes away
+    from app import close_write_queue, flush_metrics, flush_search_history
+    flush_search_history()
+    close_write_queue()
+    # Final totals for /metrics, which keeps counting exited workers
+    flush_metrics(force=True)
+
+
+def child_exit(server, worker):
+    # Master side, after worker_exit's final flush: keep the totals under the archive so
+    # a new worker that gets the same PID starts its own file
+    from app import archive_worker_metrics
+    archive_worker_metrics(worker.pid)
@@ -0,0 +1,60 @@
+import itertools
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+# app.py reads its settings from the environment at import time, so point it at a
+# scratch copy of the demo database before it is imported
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORK_DIR = tempfile.mkdtemp(prefix='library-tests-')
+shutil.copy(os.path.join(ROOT, 'library.db'), WORK_DIR)
+os.environ['LIBRARY_DB'] = os.path.join(WORK_DIR, 'library.db')
+for name, subdir in (('METRICS_DIR', 'metrics'), ('THUMBNAIL_DIR', 'thumbnails'),
+                     ('QR_CACHE_DIR', 'qr'), ('IMPORT_DIR', 'imports')):
+    os.environ[name] = os.path.join(WORK_DIR, subdir)
+sys.path.insert(0, ROOT)
+
+import app as library  # noqa: E402
+
+_users = itertools.count(1)
+
+
+@pytest.fixture(scope='session')
+def app():
+    library.app.config['TESTING'] = True
+    library.upgrade_database()
+    yield library.app
+    library.flush_search_history()
+    library.close_write_queue()
+    library.close_pool()
+    shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+
+@pytest.fixture
+def client(app):
+    """A test client logged in as a new user"""
+    client = app.test_client()
+    username = f"tester{next(_users)}"
+    client.post('/register', data={'username': username, 'password': 'secret'})
+    client.post('/login', data={'username': username, 'password': 'secret'})
+    return client
+
+
+@pytest.fixture
+def db(app):
+    """A read-write connection of its own, outside the worker's write queue"""
+    conn = library.connect_db()
+    yield conn
+    conn.close()
+
+
+def add_book(db, title, **fields):
+    """Insert a book directly and return its id"""
+    fields = dict({'author': 'Test Author', 'status': 'Available'}, title=title, **fields)
+    cur = db.execute(f"INSERT INTO books ({', '.join(fields)}) VALUES ({', '.join('?' * len(fields))})",
+                     tuple(fields.values()))
+    db.commit()
+    return cur.lastrowid
@@ -0,0 +1,28 @@
+import csv
+import io
+import json
+
+
+def export(client, fmt='csv'):
+    response = client.get(f'/export/search_results?format={fmt}')
+    assert response.status_code == 200
+    return response.get_data(as_text=True)
+
+
+def test_export_matches_a_plain_search(client):
+    client.post('/search', data={'search_term': 'Orwell', 'search_by': 'author'})
+    rows = list(csv.DictReader(io.StringIO(export(client))))
+    assert rows and all('Orwell' in row['Author'] for row in rows)
+
+
+def test_export_of_a_misspelled_search_has_the_close_matches_shown(client):
+    page = client.post('/search', data={'search_term': 'tolkein', 'search_by': 'author'})
+    assert b'Tolkien' in page.data
+    rows = list(csv.DictReader(io.StringIO(export(client))))
+    assert rows and all(row['Author'] == 'J.R.R. Tolkien' for row in rows)
+
+
+def test_export_of_a_fuzzy_search(client):
+    client.post('/search', data={'search_term': 'hobit', 'search_by': 'title', 'fuzzy': '1'})
+    books = [json.loads(line) for line in export(client, 'jsonl').splitlines()]
+    assert books[0]['title'] == 'The Hobbit'
@@ -0,0 +1,22 @@
+import io
+
+
+def upload(client, body):
+    response = client.post('/api/import_books', data={'file': (io.BytesIO(body.encode()), 'books.csv')},
+                           content_type='multipart/form-data')
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def test_upload_keeps_the_isbn_as_given(client, db):
+    stats = upload(client, 'title,author,isbn\nHand Keyed,Some One,0-306-40615-2\nAgain,Some One,978-0306406157\n')
+    assert (stats['inserted'], stats['duplicates']) == (1, 1)
+    row = db.execute("SELECT isbn, isbn13 FROM books WHERE title = 'Hand Keyed'").fetchone()
+    assert tuple(row) == ('0-306-40615-2', '9780306406157')
+
+
+def test_upload_skips_isbns_entered_by_hand(client, db):
+    client.post('/add_book', data={'title': 'Typed In', 'author': 'Some One', 'isbn': '0 14 044913 2'})
+    assert db.execute("SELECT isbn FROM books WHERE title = 'Typed In'").fetchone()[0] == '0 14 044913 2'
+    stats = upload(client, 'title,author,isbn\nTyped Twice,Some One,9780140449136\n')
+    assert (stats['inserted'], stats['rejected']) == (0, 1)
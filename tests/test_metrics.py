@@ -0,0 +1,16 @@
+import os
+
+import app as library
+
+
+def test_metrics_without_a_metrics_directory(app, tmp_path, monkeypatch):
+    def read_only(*args, **kwargs):
+        raise OSError('read-only file system')
+
+    monkeypatch.setitem(app.config, 'METRICS_DIR', str(tmp_path / 'missing' / 'metrics'))
+    # Flushing cannot create the directory either, so /metrics has to cope without it
+    monkeypatch.setattr(library.os, 'makedirs', read_only)
+    response = app.test_client().get('/metrics')
+    assert response.status_code == 200
+    assert 'library_workers 0' in response.get_data(as_text=True)
+    assert not os.path.exists(tmp_path / 'missing')
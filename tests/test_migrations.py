@@ -0,0 +1,52 @@
+import shutil
+import sqlite3
+
+import pytest
+
+import app as library
+from conftest import ROOT, WORK_DIR
+
+
+@pytest.fixture
+def fresh_db():
+    """A read-write connection to an unmigrated copy of the demo database"""
+    conn = sqlite3.connect(shutil.copy(f'{ROOT}/library.db', f'{WORK_DIR}/fresh.db'))
+    conn.row_factory = sqlite3.Row
+    yield conn
+    conn.close()
+
+
+def table_exists(conn, name):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (name,)).fetchone() is not None
+
+
+def test_fts_index_is_part_of_the_callers_transaction(app, fresh_db):
+    fresh_db.execute("BEGIN")
+    with app.app_context():
+        library.ensure_fts_index(fresh_db)
+    fresh_db.rollback()
+    assert not table_exists(fresh_db, 'books_fts')
+
+
+def test_failed_migration_leaves_no_schema_behind(app, monkeypatch):
+    def broken(conn):
+        conn.execute("CREATE TABLE half_done (id INTEGER)")
+        raise RuntimeError('boom')
+    monkeypatch.setattr(library, 'MIGRATIONS', [(999, 'broken', broken)])
+    with app.app_context():
+        with pytest.raises(RuntimeError):
+            library.migrate_database()
+        conn = library.get_db()
+        assert not table_exists(conn, 'half_done')
+        assert conn.execute("SELECT 1 FROM schema_version WHERE version = 999").fetchone() is None
+
+
+def test_catalog_stats_rebuild_is_part_of_the_callers_transaction(app, fresh_db):
+    with app.app_context():
+        library.migrate_catalog_stats(fresh_db)
+        fresh_db.commit()
+        fresh_db.execute("BEGIN")
+        fresh_db.execute("DELETE FROM books")
+        library.rebuild_catalog_stats(fresh_db)
+    fresh_db.rollback()
+    assert fresh_db.execute("SELECT total FROM catalog_stats").fetchone()[0] == 15
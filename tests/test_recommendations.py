@@ -0,0 +1,46 @@
+import app as library
+from conftest import add_book
+
+
+def lend(db, user_id, book_id, day):
+    db.execute("""INSERT INTO borrowings (user_id, book_id, borrowed_date, due_date, returned_date)
+                  VALUES (?, ?, ?, ?, ?)""", (user_id, book_id, day, day, day))
+    db.commit()
+
+
+def add_reader(db, name):
+    return db.execute("INSERT INTO users (username, password) VALUES (?, 'x')", (name,)).lastrowid
+
+
+def test_incremental_run_after_a_book_is_deleted(app, client, db):
+    books = [add_book(db, f'Shelf Mate {i}') for i in range(3)]
+    readers = [add_reader(db, f'shelf-reader-{i}') for i in range(3)]
+    for reader in readers:
+        for book_id in books:
+            lend(db, reader, book_id, '2026-01-05')
+    with app.app_context():
+        library.update_recommendations(library.get_db(), 100, rebuild=True)
+    gone = books[0]
+    assert db.execute("SELECT COUNT(*) FROM book_recommendations WHERE recommended_id = ?", (gone,)).fetchone()[0]
+
+    assert client.get(f'/delete_book/{gone}').status_code == 302
+    # A reader of the deleted book borrows something new: its old loan must not count
+    newcomer = add_book(db, 'Shelf Mate New')
+    lend(db, readers[0], newcomer, '2026-02-01')
+    lend(db, readers[1], newcomer, '2026-02-01')
+    with app.app_context():
+        stats = library.update_recommendations(library.get_db(), 100)
+    assert stats['mode'] == 'incremental'
+    for table, column in (('book_readers', 'book_id'), ('book_cooccurrence', 'book_id'),
+                          ('book_cooccurrence', 'other_id'), ('book_recommendations', 'book_id'),
+                          ('book_recommendations', 'recommended_id')):
+        assert db.execute(f"SELECT COUNT(*) FROM {table} WHERE {column} = ?", (gone,)).fetchone()[0] == 0
+    similar = db.execute("SELECT recommended_id FROM book_recommendations WHERE book_id = ?", (newcomer,)).fetchall()
+    assert {row[0] for row in similar} == set(books[1:])
+
+
+def test_rerank_skips_books_without_counts(app, db):
+    with app.app_context():
+        conn = library.get_db()
+        library.rerank_books(conn.cursor(), [10 ** 9], 5, 1)
+        conn.commit()
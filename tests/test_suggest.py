@@ -0,0 +1,34 @@
+import time
+
+import app as library
+
+
+def test_suggest_answers_from_sql_before_the_index_is_built(app):
+    with app.app_context():
+        found = library.sql_suggestions(library.get_db(), 'hobb', 'title', 5)
+    assert [s['text'] for s in found] == ['The Hobbit']
+
+
+def test_suggest_builds_the_index_in_the_background(app):
+    client = app.test_client()
+    response = client.get('/api/suggest?q=the&field=all')
+    assert response.status_code == 200
+    deadline = time.monotonic() + 10
+    while not library._suggest_index.built_at and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert library._suggest_index.snapshot()['ready']
+    texts = [s['text'] for s in client.get('/api/suggest?q=hobb').get_json()['suggestions']]
+    assert texts == ['The Hobbit']
+
+
+def test_index_stays_within_its_byte_budget():
+    values = {f'title {i}': [f'Title {i}', 1 + i % 7] for i in range(5000)}
+    full = library.PrefixIndex.build('title', values, {}, 2**30)
+    budget = full.bytes // 2
+    index = library.PrefixIndex.build('title', values, {}, budget)
+    assert 0 < index.over_budget < len(values)
+    assert index.approx_bytes() <= budget
+    # The heaviest terms are the ones kept
+    assert min(index.books.values()) >= max(n for t, (_, n) in values.items() if t not in index.books)
+    index.add('Title New')
+    assert index.bytes <= budget